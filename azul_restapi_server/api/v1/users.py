@@ -1,10 +1,11 @@
 """User based API routes."""
 
-import copy
-
 from azul_bedrock.exceptions import BaseError
 from azul_bedrock.models_auth import UserInfo
 from fastapi import APIRouter, Request
+from starlette.responses import Response
+
+from azul_restapi_server.security import user_context
 
 router = APIRouter()
 
@@ -14,10 +15,7 @@ router = APIRouter()
     response_model=UserInfo,
     responses={500: {"model": BaseError, "description": "Something went wrong"}},
 )
-async def read_users_me(request: Request):
+async def read_users_me(request: Request) -> Response:
     """Return parsed info for for current user."""
-    user_info: UserInfo = copy.deepcopy(request.state.user_info)
-    # do not send back user credentials
-    user_info.credentials = None
-
-    return user_info
+    # serialised once per verified token, and never includes user credentials
+    return Response(user_context.from_request(request).public_json(), media_type="application/json")
@@ -0,0 +1,179 @@
+"""Serve the bundled static assets used by the API documentation, from memory and precompressed.
+
+Each asset is available under its plain name and under a content hashed name, i.e. `swagger-ui.<hash>.css`.
+Hashed names never change content, so they are cached by browsers for a year without revalidating.
+Plain names are revalidated with their ETag on every use.
+
+Compressed variants are loaded from `<name>.gz` and `<name>.br` files next to the asset when they were built
+with the package, or otherwise compressed in memory the first time the asset is requested.
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+
+import anyio.to_thread
+from starlette.datastructures import Headers
+from starlette.responses import PlainTextResponse, Response
+from starlette.types import Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# a year, as hashed names are never reused for different content
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+# suffixes of precompressed variants, by content encoding
+_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+# variants that don't save at least this much are not worth decompressing
+_MIN_SAVING = 0.1
+
+
+def _compress(encoding: str, content: bytes) -> bytes:
+    """Compress content with the given content encoding."""
+    if encoding == "br":
+        return brotli.compress(content)
+    return gzip.compress(content, compresslevel=9, mtime=0)
+
+
+def parse_accept_encoding(header: str) -> dict[str, float]:
+    """Return the quality of each encoding in an Accept-Encoding header."""
+    accepted = {}
+    for item in header.split(","):
+        encoding, _, params = item.partition(";")
+        encoding = encoding.strip().lower()
+        if not encoding:
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[encoding] = quality
+    return accepted
+
+
+def choose_encoding(header: str, available: list[str]) -> str:
+    """Return the preferred available encoding accepted by the client, or 'identity'."""
+    accepted = parse_accept_encoding(header)
+    best, best_quality = "identity", 0.0
+    # available is in order of preference, so ties keep the earlier one
+    for encoding in available:
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+class Asset:
+    """Content held in memory, with its compressed variants."""
+
+    def __init__(self, content: bytes, media_type: str, path: str = ""):
+        """Hold content, which may have precompressed variants next to the file at path."""
+        self.content = content
+        self.media_type = media_type
+        self.path = path
+        self.digest = hashlib.sha256(content).hexdigest()[:16]
+        # encoding -> compressed content, in order of preference once loaded
+        self.variants: dict[str, bytes] | None = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path: str) -> "Asset":
+        """Read an asset from a file."""
+        with open(path, "rb") as f:
+            content = f.read()
+        return cls(content, mimetypes.guess_type(path)[0] or "application/octet-stream", path)
+
+    def load_variants(self) -> dict[str, bytes]:
+        """Load or compute the compressed variants of the asset."""
+        with self._lock:
+            if self.variants is not None:
+                return self.variants
+            variants = {}
+            for encoding, suffix in _SUFFIXES.items():
+                if encoding == "br" and brotli is None:
+                    continue
+                if self.path and os.path.exists(self.path + suffix):
+                    with open(self.path + suffix, "rb") as f:
+                        compressed = f.read()
+                else:
+                    compressed = _compress(encoding, self.content)
+                if len(compressed) <= len(self.content) * (1 - _MIN_SAVING):
+                    variants[encoding] = compressed
+            self.variants = variants
+            return variants
+
+    def etag(self, encoding: str) -> str:
+        """Return the ETag of one representation of the asset."""
+        return f'"{self.digest}-{encoding}"'
+
+    async def response(self, request_headers: Headers, cache_control: str) -> Response:
+        """Return the best representation of the asset for a request, or a 304 if the client has it."""
+        variants = self.variants
+        if variants is None:
+            # compression of large content would otherwise hold up the event loop
+            variants = await anyio.to_thread.run_sync(self.load_variants)
+        encoding = choose_encoding(request_headers.get("accept-encoding", ""), list(variants))
+        headers = {"ETag": self.etag(encoding), "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+        if_none_match = request_headers.get("if-none-match")
+        if if_none_match is not None:
+            tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            if "*" in tags or headers["ETag"] in tags:
+                return Response(status_code=304, headers=headers)
+        if encoding == "identity":
+            return Response(self.content, media_type=self.media_type, headers=headers)
+        headers["Content-Encoding"] = encoding
+        return Response(variants[encoding], media_type=self.media_type, headers=headers)
+
+
+class StaticAssets:
+    """ASGI app serving the files of a directory from memory, see the module docstring."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.assets: dict[str, Asset] = {}
+        self.hashed_names: dict[str, str] = {}
+        # name in the url -> (asset, cache control)
+        self._routes: dict[str, tuple[Asset, str]] = {}
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if not os.path.isfile(path) or name.endswith((".py", *_SUFFIXES.values())):
+                continue
+            asset = Asset.from_file(path)
+            stem, suffix = os.path.splitext(name)
+            self.assets[name] = asset
+            self.hashed_names[name] = f"{stem}.{asset.digest}{suffix}"
+            self._routes[name] = (asset, REVALIDATE)
+            self._routes[self.hashed_names[name]] = (asset, IMMUTABLE)
+
+    def url_name(self, name: str) -> str:
+        """Return the content hashed name to link to an asset with."""
+        return self.hashed_names[name]
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """Serve a single asset."""
+        path = scope["path"]
+        # path includes the prefix the app is mounted at, which is added to the root path
+        root_path = scope.get("root_path", "")
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path) :]
+        name = path.lstrip("/")
+        if scope["method"] not in ("GET", "HEAD"):
+            response = PlainTextResponse("Method Not Allowed", status_code=405, headers={"Allow": "GET, HEAD"})
+        elif name not in self._routes:
+            response = PlainTextResponse("Not Found", status_code=404)
+        else:
+            asset, cache_control = self._routes[name]
+            response = await asset.response(Headers(scope=scope), cache_control)
+            if scope["method"] == "HEAD":
+                # headers, including the content length, are already set from the full body
+                response.body = b""
+        await response(scope, receive, send)
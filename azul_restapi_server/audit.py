@@ -0,0 +1,252 @@
+"""Write audit records in batches from a background thread.
+
+Records are held in a bounded buffer, so a stalled disk can't grow memory without limit.
+When the buffer is full, the configured policy decides what happens to new records:
+
+- block: wait for space in the buffer, in a thread of the writer so the event loop keeps serving other requests
+- drop: discard the record and count it
+- spill: queue the record for another thread to append to a spill file, dropping it if that falls behind too
+
+Records are text lines, unless the output mode is msgpack where each record is length prefixed bytes.
+"""
+
+import asyncio
+import atexit
+import collections
+import concurrent.futures
+import json
+import struct
+import sys
+import threading
+import time
+from typing import Any, Callable
+
+from prometheus_client import Counter, Gauge
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+POLICIES = ("block", "drop", "spill")
+OUTPUTS = ("text", "json", "msgpack")
+
+queue_depth = Gauge("azulapi_audit_queue_depth", "Audit records waiting to be written", multiprocess_mode="livesum")
+dropped = Counter("azulapi_audit_dropped", "Audit records discarded because the buffer was full")
+spilled = Counter("azulapi_audit_spilled", "Audit records sent to the spill file because the buffer was full")
+
+
+def _encode_json(record: dict[str, Any]) -> str:
+    """Encode a record as a single line of json."""
+    if orjson is not None:
+        return orjson.dumps(record).decode()
+    return json.dumps(record, separators=(",", ":"))
+
+
+def _encode_msgpack(record: dict[str, Any]) -> bytes:
+    """Encode a record as msgpack, prefixed with its length as a big endian uint32."""
+    payload = msgpack.packb(record)
+    return struct.pack(">I", len(payload)) + payload
+
+
+def get_encoder(output: str) -> Callable[[dict[str, Any]], str | bytes] | None:
+    """Return the function that encodes structured audit records, or None for the text format."""
+    if output not in OUTPUTS:
+        raise ValueError(f"unknown audit output {output}, must be one of {OUTPUTS}")
+    if output == "json":
+        return _encode_json
+    if output == "msgpack":
+        if msgpack is None:
+            raise ValueError("msgpack audit output requires the msgpack package")
+        return _encode_msgpack
+    return None
+
+
+class AuditWriter:
+    """Buffer audit records and write them in batches from a background thread."""
+
+    def __init__(
+        self,
+        sink: Callable[[str], None],
+        capacity: int = 10000,
+        batch_size: int = 500,
+        interval: float = 0.5,
+        policy: str = "block",
+        spill_file: str = "",
+        binary: bool = False,
+    ):
+        """Start the writer.
+
+        The sink is called once for each batch, with newline separated records.
+        Binary records are self delimiting and are passed to the sink concatenated.
+        """
+        if policy not in POLICIES:
+            raise ValueError(f"unknown audit buffer policy {policy}, must be one of {POLICIES}")
+        if policy == "spill" and not spill_file:
+            raise ValueError("a spill file is required for the spill policy")
+        self.sink = sink
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.interval = interval
+        self.policy = policy
+        self.spill_file = spill_file
+        self.binary = binary
+        self._buffer: collections.deque[str | bytes] = collections.deque()
+        self._cond = threading.Condition()
+        # records waiting for the spill thread, which writes them so a stalled sink doesn't hold them up
+        self._spill_buffer: collections.deque[str | bytes] = collections.deque()
+        self._spill_cond = threading.Condition()
+        # records taken from the buffers but not yet written
+        self._writing = 0
+        self._spilling = 0
+        self._flushing = 0
+        self._closed = False
+        # writes waiting for space, kept out of the handler thread pool so a stalled disk can't use it up
+        self._waiting = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="audit-wait")
+        self._threads = [threading.Thread(target=self._run, name="audit-writer", daemon=True)]
+        if policy == "spill":
+            self._threads.append(threading.Thread(target=self._run_spill, name="audit-spill", daemon=True))
+        for thread in self._threads:
+            thread.start()
+        atexit.register(self.close)
+
+    def _offer(self, record: str | bytes) -> bool:
+        """Queue a record without waiting, returning False if the buffer is full and the policy is to block."""
+        with self._cond:
+            if self._closed:
+                # nothing is left to drain the buffer
+                self.sink(record)
+                return True
+            if len(self._buffer) < self.capacity:
+                self._buffer.append(record)
+                queue_depth.inc()
+                # wake the writer to start timing a batch, or because a batch is ready
+                if len(self._buffer) == 1 or len(self._buffer) >= self.batch_size:
+                    self._cond.notify_all()
+                return True
+            if self.policy == "block":
+                return False
+            if self.policy == "drop":
+                dropped.inc()
+                return True
+        with self._spill_cond:
+            if len(self._spill_buffer) >= self.capacity:
+                dropped.inc()
+                return True
+            self._spill_buffer.append(record)
+            spilled.inc()
+            self._spill_cond.notify_all()
+        return True
+
+    def write(self, record: str | bytes):
+        """Queue a record to be written, blocking the calling thread while waiting for space.
+
+        Code running on the event loop must use write_async instead.
+        """
+        while not self._offer(record):
+            with self._cond:
+                while len(self._buffer) >= self.capacity and not self._closed:
+                    self._cond.wait()
+
+    async def write_async(self, record: str | bytes):
+        """Queue a record to be written, waiting for space in the writer's own thread rather than on the event loop."""
+        if not self._offer(record):
+            await asyncio.get_running_loop().run_in_executor(self._waiting, self.write, record)
+
+    def _join(self, batch: list[str | bytes]) -> str | bytes:
+        """Return the batch of records as a single value for the sink."""
+        return b"".join(batch) if self.binary else "\n".join(batch)
+
+    def _run_spill(self):
+        """Append records to the spill file until closed and the spill buffer is empty."""
+        while True:
+            with self._spill_cond:
+                while not self._spill_buffer and not self._closed:
+                    self._spill_cond.wait()
+                if not self._spill_buffer:
+                    return
+                batch = list(self._spill_buffer)
+                self._spill_buffer.clear()
+                self._spilling = len(batch)
+            try:
+                with open(self.spill_file, "ab" if self.binary else "a") as f:
+                    f.write(self._join(batch) if self.binary else self._join(batch) + "\n")
+            except Exception as e:
+                print(f"failed to spill {len(batch)} audit records: {e!r}", file=sys.stderr)
+            with self._spill_cond:
+                self._spilling = 0
+                self._spill_cond.notify_all()
+
+    def _next_batch(self) -> list[str | bytes]:
+        """Wait for a full batch, or for the interval to pass since the first waiting record."""
+        with self._cond:
+            deadline = None
+            while not self._closed and not self._flushing and len(self._buffer) < self.batch_size:
+                if not self._buffer:
+                    deadline = None
+                    self._cond.wait()
+                    continue
+                if deadline is None:
+                    deadline = time.monotonic() + self.interval
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = [self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))]
+            queue_depth.dec(len(batch))
+            self._writing = len(batch)
+            # wake any writers blocked on a full buffer
+            self._cond.notify_all()
+            return batch
+
+    def _run(self):
+        """Write batches until closed and the buffer is empty."""
+        while True:
+            batch = self._next_batch()
+            if batch:
+                try:
+                    self.sink(self._join(batch))
+                except Exception as e:
+                    print(f"failed to write {len(batch)} audit records: {e!r}", file=sys.stderr)
+            with self._cond:
+                self._writing = 0
+                self._cond.notify_all()
+                if self._closed and not self._buffer:
+                    return
+
+    def flush(self, timeout: float = 10.0):
+        """Wait until every queued record has been written."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._flushing += 1
+            self._cond.notify_all()
+            try:
+                while self._buffer or self._writing:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self._threads[0].is_alive():
+                        return
+                    self._cond.wait(remaining)
+            finally:
+                self._flushing -= 1
+        with self._spill_cond:
+            while self._spill_buffer or self._spilling:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._threads[-1].is_alive():
+                    return
+                self._spill_cond.wait(remaining)
+
+    def close(self, timeout: float = 10.0):
+        """Write any queued records and stop the background threads."""
+        for cond in (self._cond, self._spill_cond):
+            with cond:
+                self._closed = True
+                cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        # waiting writes were released by closing
+        self._waiting.shutdown(wait=False)
@@ -1,38 +1,78 @@
 """CLI entry to run the server."""
 
+import asyncio
+import json
 from functools import partial
 
 import click
 import uvicorn
 
-from azul_restapi_server import settings
+# other modules are imported as needed, as prometheus_client must not be imported before metrics are set up
+from azul_restapi_server import prefork, settings
 
 # always show default
 click.option = partial(click.option, show_default=True)
 
 
-@click.command()
+@click.group(invoke_without_command=True)
 @click.option("--host", default=settings.restapi.host)
 @click.option("--port", default=settings.restapi.port)
 @click.option("--workers", default=settings.restapi.workers)
 @click.option("--reload/--no-reload", default=settings.restapi.reload)
-def run(host, port, workers, reload):
+@click.option("--preload/--no-preload", default=settings.restapi.preload)
+@click.pass_context
+def run(ctx: click.Context, host, port, workers, reload, preload):
     """Start the Azul API server."""
+    if ctx.invoked_subcommand is not None:
+        return
     headers: list[str, str] = []
     for header_label, header_val in settings.restapi.headers.items():
         headers.append((header_label.strip(), header_val.strip()))
 
     # access log is disabled, as we are using our own middleware to log access
-    uvicorn.run(
-        "azul_restapi_server.main:app",
-        forwarded_allow_ips="*",
-        host=host,
-        port=port,
-        workers=workers,
-        reload=reload,
-        access_log=False,
-        headers=headers,
-    )
+    options = dict(forwarded_allow_ips="*", host=host, port=port, access_log=False, headers=headers)
+    if preload and not reload:
+        if workers > 1:
+            # only forked workers have their live gauges dropped when they exit, uvicorn's are left to go stale
+            prefork.prepare_metrics()
+        from azul_restapi_server import plugins, security
+
+        plugins.preload()
+        if workers > 1:
+            # fetched once here, rather than by every worker
+            security.warm()
+            prefork.serve(uvicorn.Config("azul_restapi_server.main:app", **options), workers)
+            return
+    uvicorn.run("azul_restapi_server.main:app", workers=workers, reload=reload, **options)
+
+
+@run.command()
+@click.argument("path", type=click.Path(dir_okay=False, writable=True))
+def openapi(path):
+    """Write the OpenAPI document of the installed plugins to PATH, to serve with RESTAPI_OPENAPI_FILE."""
+    # loads every plugin, so only import when needed
+    from azul_restapi_server import main, security
+
+    # lifespan isn't run, but the document describes the auth flow discovered during startup
+    asyncio.run(security.startup())
+    main.openapi_document.write(path)
+    click.echo(f"wrote openapi document to {path}")
+
+
+@run.command()
+@click.option("--budget", default=settings.restapi.startup_budget, help="fail if startup takes longer, in seconds")
+@click.option("--top", default=20, help="number of slowest modules and plugins to report")
+def profile_startup(budget, top):
+    """Import the app in a new interpreter and report where the startup time goes, as json."""
+    from azul_restapi_server import startup
+
+    try:
+        result = startup.profile(top)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    click.echo(json.dumps(result, indent=2))
+    if budget and result["total"] > budget:
+        raise click.ClickException(f"startup took {result['total']:.2f}s, over the budget of {budget}s")
 
 
 if __name__ == "__main__":
@@ -1,12 +1,18 @@
 """Provide logging."""
 
 import logging
+import os
+import re
 import sys
 
 from loguru import logger
 
+from azul_restapi_server.audit import AuditWriter
 from azul_restapi_server.settings import logging as config
 
+# loguru record fields that are found by walking back to the frame of the caller
+_CALLER_FIELDS = re.compile(r"\{(name|function|line|module|file)\b")
+
 
 class InterceptHandler(logging.Handler):
     """Default handler from examples in loguru documentation.
@@ -14,26 +20,44 @@ class InterceptHandler(logging.Handler):
     See https://loguru.readthedocs.io/en/stable/overview.html#entirely-compatible-with-standard-logging
 
     Use to redirect standard logging messages towards loguru sink
+
+    Records below the configured level are dropped before the message is formatted,
+    and the frame of the caller is only searched for if the log format shows where a message came from.
     """
 
+    def __init__(self, level: str | None = None, log_format: str | None = None):
+        """Init."""
+        super().__init__()
+        self.min_levelno = logger.level((level or config.log_level).upper()).no
+        self.find_caller = bool(_CALLER_FIELDS.search(config.log_format if log_format is None else log_format))
+        # stdlib level name -> loguru level name, or the level number if loguru has no such level
+        self._levels: dict[str, str | int] = {}
+
     def emit(self, record):
         """Emit a record."""
+        if record.levelno < self.min_levelno:
+            return
         if record.name == "uvicorn.access":
             # we already log access using middleware
             # don't log anything from uvicorn.access since its difficult to stop it logging any other way
             # i.e. guvicorn seems to add a handler, which breaks the config option 'access_log'
             return
         # Get corresponding Loguru level if it exists
-        try:
-            level = logger.level(record.levelname).name
-        except ValueError:
-            level = record.levelno
+        level = self._levels.get(record.levelname)
+        if level is None:
+            try:
+                level = logger.level(record.levelname).name
+            except ValueError:
+                level = record.levelno
+            self._levels[record.levelname] = level
 
         # Find caller from where originated the logged message.
-        frame, depth = logging.currentframe(), 0
-        while frame and (depth == 0 or frame.f_code.co_filename == logging.__file__):
-            frame = frame.f_back
-            depth += 1
+        depth = 0
+        if self.find_caller:
+            frame = logging.currentframe()
+            while frame and (depth == 0 or frame.f_code.co_filename == logging.__file__):
+                frame = frame.f_back
+                depth += 1
 
         logger.opt(depth=depth, exception=record.exc_info).log(level, record.getMessage())
 
@@ -43,18 +67,33 @@ class RestAPILogger:
 
     def __init__(self):
         """Init."""
+        binary = config.audit_output == "msgpack"
+        if binary and not config.audit_file:
+            # binary records would be mixed in with the text logs on stdout
+            raise ValueError("msgpack audit output requires an audit file")
         logger.remove()
 
         self.logger = logger.bind(feed="log")
         self.audit_logger = logger.bind(feed="audit")
 
-        # log all to stdout
+        # log all to stdout, except batches from the audit writer
         logger.add(
             sys.stdout,
             enqueue=True,
             backtrace=config.log_backtrace,
             level=config.log_level.upper(),
             format=config.log_format,
+            filter=lambda record: record["extra"].get("feed") not in ("audit_batch", "audit_stdout"),
+            diagnose=False,
+        )
+        # batches of audit records are formatted like other logs and written to stdout at once,
+        # they are already written from a background thread, so don't enqueue again
+        logger.add(
+            sys.stdout,
+            enqueue=False,
+            level="INFO",
+            format=self.format_audit_batch,
+            filter=lambda record: record["extra"].get("feed") == "audit_stdout",
             diagnose=False,
         )
 
@@ -73,21 +112,73 @@ class RestAPILogger:
             )
 
         # audit file
-        if config.audit_file:
+        # batches are already written from a background thread, so don't enqueue again
+        if binary:
+            # loguru only writes text, so binary records are appended to the audit file without rotation
+            audit_sink = self._binary_sink(config.audit_file)
+        elif config.audit_file:
             logger.add(
                 config.audit_file,
                 rotation=config.audit_rotation,
                 retention=config.audit_retention,
-                enqueue=True,
+                enqueue=False,
                 level="INFO",
                 format="{message}",
-                filter=lambda record: record["extra"].get("feed") == "audit",
+                filter=lambda record: record["extra"].get("feed") in ("audit", "audit_batch"),
                 diagnose=False,
             )
+            audit_sink = self._audit_sink(to_file=True)
+        else:
+            audit_sink = self._audit_sink(to_file=False)
+        self.audit_writer = AuditWriter(
+            audit_sink,
+            capacity=config.audit_buffer_size,
+            batch_size=config.audit_batch_size,
+            interval=config.audit_flush_interval,
+            policy=config.audit_full_policy,
+            spill_file=config.audit_spill_file or (config.audit_file and config.audit_file + ".spill"),
+            binary=binary,
+        )
 
         # redirect logging to loguru sink
         # eg: 'uvicorn', 'uvicorn.error', 'uvicorn.access', 'fastapi',
+        # records below the log level are never created by loggers that inherit the root level
         handler = InterceptHandler()
-        logging.basicConfig(handlers=[handler], level=0)
+        logging.basicConfig(handlers=[handler], level=handler.min_levelno)
         for name in logging.root.manager.loggerDict:
             logging.getLogger(name).handlers = [handler]
+
+    @staticmethod
+    def format_audit_batch(record: dict) -> str:
+        """Return the log format once for each audit record in a batch, so the batch is written to stdout at once."""
+        records = record["extra"]["audit_records"]
+        return "".join(
+            config.log_format.replace("{message}", f"{{extra[audit_records][{i}]}}") + "\n"
+            for i in range(len(records))
+        )
+
+    @staticmethod
+    def _audit_sink(to_file: bool):
+        """Return a sink that writes batches of audit records to stdout, and to the audit file if there is one."""
+        write_file = logger.bind(feed="audit_batch").info
+        write_stdout = logger.bind(feed="audit_stdout")
+
+        def write(text: str):
+            if to_file:
+                write_file(text)
+            # one write and flush for the batch, with a log line per record as before batching
+            write_stdout.bind(audit_records=text.split("\n")).info("")
+
+        return write
+
+    @staticmethod
+    def _binary_sink(path: str):
+        """Return a sink that appends batches of binary audit records to the file."""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        f = open(path, "ab")
+
+        def write(data: bytes):
+            f.write(data)
+            f.flush()
+
+        return write
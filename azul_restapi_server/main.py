@@ -3,42 +3,53 @@
 Main setup of the FastAPI server app and basic routes.
 """
 
-import asyncio
+import contextlib
+import functools
 import importlib.resources
 import sys
 import traceback
-from concurrent.futures import ThreadPoolExecutor
 
+import anyio.to_thread
 from azul_bedrock.exceptions import ApiException, DispatcherApiException
-from fastapi import FastAPI, Request
+from fastapi import Depends, FastAPI, Request
+from fastapi.datastructures import Default
 from fastapi.openapi.docs import (
     get_redoc_html,
     get_swagger_ui_html,
     get_swagger_ui_oauth2_redirect_html,
 )
 from starlette.middleware.cors import CORSMiddleware
-from starlette.responses import HTMLResponse, JSONResponse, RedirectResponse
-from starlette.staticfiles import StaticFiles
+from starlette.responses import HTMLResponse, RedirectResponse, Response
 from starlette_exporter import PrometheusMiddleware, handle_metrics
 
 from azul_restapi_server import settings
 
-from . import __version__, plugins, static
+from . import (
+    __version__,
+    plugins,
+    response_cache,
+    responses,
+    security,
+    startup,
+    static,
+    threadpool,
+)
+from .assets import StaticAssets
 from .logging import RestAPILogger
+from .middleware import profiling
+from .middleware.compression import CompressionMiddleware
 from .middleware.logging import AuditMiddleware
+from .middleware.shedding import LoadSheddingMiddleware
+from .middleware.stages import StageTimingMiddleware
+from .openapi import OpenAPIDocument
+from .security import oidc_shared, validate_token
 
 root_path = settings.restapi.root_path.rstrip("/")
 api_prefix = settings.restapi.prefix.rstrip("/").lstrip("/")
-
-# patch asyncio to limit threads in kubernetes to not use cpu_count() which is inaccurate
-try:
-    loop = asyncio.get_running_loop()
-except RuntimeError:
-    pass
-else:
-    print(f"limiting asyncio workers to {settings.restapi.asyncio_workers}")
-    loop.set_default_executor(ThreadPoolExecutor(max_workers=settings.restapi.asyncio_workers))
-
+# talks to the IdP while the rest of the app and plugins load
+security.begin_startup()
+openapi_url = f"/{api_prefix}/openapi.json"
+response_class = responses.get_response_class(settings.restapi.json_renderer)
 
 # Optional settings to pass into App setup
 optional_settings = {}
@@ -57,23 +68,79 @@ api_description = """This is the Azul swagger RestAPI used for developing and te
 <b>IMPORTANT</b>: Ensure you Authorize (green padlock) before attempting to use the restapi.<br/>
 You'll need to click Authorize within the menu that pops up to Authorize with the OIDC provider."""
 
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Manage resources that live as long as the server."""
+    with startup.phase("lifespan"):
+        # limit threads in kubernetes to not use cpu_count() which is inaccurate
+        threadpool.configure()
+        # patches anyio for the whole process, so only while serving
+        threadpool.install()
+        print(
+            f"limiting threads: asyncio workers={settings.restapi.asyncio_workers} "
+            f"handlers={settings.restapi.handler_threads} auth={settings.restapi.auth_threads}"
+        )
+        # the openapi document describes the discovered auth flow, so finish this first
+        await security.startup()
+        if settings.restapi.openapi_prebuild or settings.restapi.openapi_file:
+            await anyio.to_thread.run_sync(openapi_document.build)
+    yield
+    await oidc_shared.aclose_async_client()
+    app.audit_writer.flush()
+    threadpool.uninstall()
+
+
 app = FastAPI(
     title="Azul",
     description=api_description,
     version=str(__version__),
-    openapi_url=f"/{api_prefix}/openapi.json",
+    # served from the prebuilt document below
+    openapi_url=None,
     root_path=root_path,
     docs_url=None,
     redoc_url=None,
+    lifespan=lifespan,
+    default_response_class=Default(response_class),
     **optional_settings,
 )
-app.mount(
-    f"/{api_prefix}/static",
-    StaticFiles(directory=str(importlib.resources.files(static))),
-)
-
+static_assets = StaticAssets(directory=str(importlib.resources.files(static)))
+app.mount(f"/{api_prefix}/static", static_assets)
+openapi_document = OpenAPIDocument(app, settings.restapi.openapi_file)
+
+# innermost, as it sends cached and shared responses in place of the rest of the app
+# plugins are loaded later, so it is always added in case they opt in
+app.add_middleware(response_cache.ResponseCacheMiddleware)
+# innermost but for the cache, so stage timings only cover the app itself
+app.add_middleware(StageTimingMiddleware, server_timing=settings.restapi.server_timing)
+if settings.restapi.shed_max_in_flight or settings.restapi.shed_max_loop_lag:
+    # inside of audit, so refused requests are still audited
+    app.add_middleware(
+        LoadSheddingMiddleware,
+        max_in_flight=settings.restapi.shed_max_in_flight,
+        max_loop_lag=settings.restapi.shed_max_loop_lag,
+        exempt_paths=settings.restapi.shed_exempt_paths,
+        priority_paths=settings.restapi.shed_priority_paths,
+    )
 # This needs to go first in order to access unencoded bodies
 app.add_middleware(AuditMiddleware)
+if settings.restapi.compression:
+    # outside of audit, so it can report the body size before and after compression
+    app.add_middleware(
+        CompressionMiddleware,
+        minimum_size=settings.restapi.compression_min_size,
+        levels=settings.restapi.compression_levels,
+        exclude_paths=settings.restapi.compression_exclude_paths,
+        exclude_types=settings.restapi.compression_exclude_types,
+    )
+if settings.restapi.profile_interval or settings.restapi.profile_token:
+    # outside of audit and compression, so the memory they hold on to is included
+    app.add_middleware(
+        profiling.ProfilingMiddleware,
+        interval=settings.restapi.profile_interval,
+        token=settings.restapi.profile_token,
+        frames=settings.restapi.profile_frames,
+    )
 app.add_middleware(
     CORSMiddleware,
     allow_origins=settings.cors.allow_origins,
@@ -109,9 +176,11 @@ app.add_middleware(
     ),
 )
 
-_logger = RestAPILogger()
+with startup.phase("logging"):
+    _logger = RestAPILogger()
 app.logger = _logger.logger
 app.audit_logger = _logger.audit_logger
+app.audit_writer = _logger.audit_writer
 
 
 try:
@@ -125,13 +194,13 @@ else:
     async def os_authc_exception_handler(request: Request, exc: elexc.AuthenticationException):
         """Capture elasticsearch authc exceptions."""
         traceback.print_exc()
-        return JSONResponse(status_code=401, content=dict(detail="Opensearch authentication failed"))
+        return response_class(status_code=401, content=dict(detail="Opensearch authentication failed"))
 
     @app.exception_handler(elexc.AuthorizationException)
     async def os_authz_exception_handler(request: Request, exc: elexc.AuthenticationException):
         """Capture elasticsearch authz exceptions."""
         traceback.print_exc()
-        return JSONResponse(status_code=403, content=dict(detail="Opensearch authorization failed"))
+        return response_class(status_code=403, content=dict(detail="Opensearch authorization failed"))
 
 
 def base_api_exception_handler(request, exc: ApiException | DispatcherApiException):
@@ -148,7 +217,7 @@ def base_api_exception_handler(request, exc: ApiException | DispatcherApiExcepti
         "ref": exc.detail.get("ref", "no ref supplied"),
         "message": exc.detail.get("external", "no message supplied"),
     }
-    return JSONResponse(status_code=exc.status_code, content=content)
+    return response_class(status_code=exc.status_code, content=content)
 
 
 @app.exception_handler(DispatcherApiException)
@@ -163,6 +232,12 @@ async def api_exception_handler(request, exc: ApiException):
     return base_api_exception_handler(request, exc)
 
 
+@app.get(openapi_url, include_in_schema=False)
+async def openapi(req: Request) -> Response:
+    """Provide the OpenAPI document, built once."""
+    return await openapi_document.response(req.headers)
+
+
 @app.get("/", include_in_schema=False)
 @app.get("/docs", include_in_schema=False)
 async def read_root(req: Request):
@@ -171,6 +246,11 @@ async def read_root(req: Request):
     return RedirectResponse(f"{root}/{api_prefix}")
 
 
+def static_url(root: str, name: str) -> str:
+    """Return the content hashed url of a static asset, which can be cached indefinitely."""
+    return f"{root}/{api_prefix}/static/{static_assets.url_name(name)}"
+
+
 # provide offline access to swagger doc and redoc instead of via a cdn
 # customise favicon
 @app.get(f"/{api_prefix}", include_in_schema=False)
@@ -178,12 +258,12 @@ async def custom_swagger_ui_html(req: Request) -> HTMLResponse:
     """Show the API documentation via Swagger."""
     root = req.scope.get("root_path")
     return get_swagger_ui_html(
-        openapi_url=f"{root}{app.openapi_url}",
+        openapi_url=f"{root}{openapi_url}",
         title=app.title + " - Swagger UI",
         oauth2_redirect_url=app.swagger_ui_oauth2_redirect_url,
-        swagger_js_url=f"{root}/{api_prefix}/static/swagger-ui-bundle.js",
-        swagger_css_url=f"{root}/{api_prefix}/static/swagger-ui.css",
-        swagger_favicon_url=f"{root}/{api_prefix}/static/azul-ico.r.32.png",
+        swagger_js_url=static_url(root, "swagger-ui-bundle.js"),
+        swagger_css_url=static_url(root, "swagger-ui.css"),
+        swagger_favicon_url=static_url(root, "azul-ico.r.32.png"),
         **get_ui_optional_settings,
     )
 
@@ -202,16 +282,33 @@ async def redoc_html(req: Request) -> HTMLResponse:
     root = req.scope.get("root_path")
 
     return get_redoc_html(
-        openapi_url=f"{root}{app.openapi_url}",
+        openapi_url=f"{root}{openapi_url}",
         title=app.title + " - ReDoc",
-        redoc_js_url=f"{root}/{api_prefix}/static/redoc.standalone.js",
-        redoc_favicon_url=f"{root}/{api_prefix}/static/azul-ico.r.32.png",
+        redoc_js_url=static_url(root, "redoc.standalone.js"),
+        redoc_favicon_url=static_url(root, "azul-ico.r.32.png"),
         with_google_fonts=False,
     )
 
 
+@app.get(f"/{api_prefix}/diagnostics/startup", include_in_schema=False, dependencies=[Depends(validate_token)])
+async def startup_diagnostics() -> dict:
+    """Report how long this worker took to start, and to import each plugin."""
+    return startup.report()
+
+
+@app.get(
+    f"/{api_prefix}/diagnostics/memory",
+    include_in_schema=False,
+    dependencies=[Depends(validate_token), Depends(profiling.require_token)],
+)
+async def memory_diagnostics(top: int = 20) -> dict:
+    """Report the memory and time used by profiled requests to each route, and where this worker holds memory."""
+    return await anyio.to_thread.run_sync(functools.partial(profiling.report, top))
+
+
 # metrics is only available at the root path (not api_prefix) - for prometheus
 app.add_route("/metrics", handle_metrics)
 
 # add extra routes after the doc routes, so they can't accidentally override
-app.include_router(plugins.get_router(), prefix=f"/{api_prefix}")
+with startup.phase("plugins"):
+    app.include_router(plugins.get_router(response_class), prefix=f"/{api_prefix}")
@@ -0,0 +1,168 @@
+"""Compress response bodies for clients that accept it.
+
+Bodies are compressed as they are streamed, so large responses are never held in memory.
+Each chunk of a streamed body is flushed, so events reach the client as they are sent rather than when the
+compressor's buffer fills.
+Responses that are small, already encoded, of an excluded content type or for an excluded path are sent as is.
+"""
+
+import zlib
+
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from azul_restapi_server.assets import choose_encoding
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# bytes sent to the client after compression, read by the audit middleware
+WIRE_BYTES = "response_wire_bytes"
+
+
+class _Brotli:
+    """Brotli compressor with the same interface as zlib."""
+
+    def __init__(self, level: int):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.finish()
+
+    def flush_chunk(self) -> bytes:
+        return self._compressor.flush()
+
+
+def available_encodings() -> list[str]:
+    """Return the supported content encodings, in order of preference."""
+    encodings = []
+    if zstandard is not None:
+        encodings.append("zstd")
+    if brotli is not None:
+        encodings.append("br")
+    encodings.append("gzip")
+    return encodings
+
+
+def get_compressor(encoding: str, level: int):
+    """Return a new compressor for the content encoding, with compress() and flush() methods."""
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    if encoding == "br":
+        return _Brotli(level)
+    # wbits of 31 writes a gzip header and trailer
+    return zlib.compressobj(level, zlib.DEFLATED, 31)
+
+
+def flush_chunk(encoding: str, compressor) -> bytes:
+    """Return the output the compressor is holding back, so everything compressed so far can be decompressed."""
+    if encoding == "zstd":
+        return compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+    if encoding == "br":
+        return compressor.flush_chunk()
+    return compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def weaken_etag(headers: MutableHeaders):
+    """Mark a strong ETag as weak, as the compressed body isn't byte for byte what it was made for.
+
+    If-None-Match is compared weakly wherever ETags are checked, so the weak tag still matches.
+    """
+    etag = headers.get("etag")
+    if etag is not None and not etag.startswith("W/"):
+        headers["ETag"] = f"W/{etag}"
+
+
+class CompressionMiddleware:
+    """Compress response bodies with gzip, zstd or brotli."""
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        minimum_size: int = 1024,
+        levels: dict[str, int] | None = None,
+        exclude_paths: list[str] = (),
+        exclude_types: list[str] = (),
+    ) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+        self.levels = {"gzip": 6, "br": 4, "zstd": 3, **(levels or {})}
+        self.exclude_paths = tuple(exclude_paths)
+        self.exclude_types = tuple(exclude_types)
+        self.encodings = available_encodings()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """Compress the response if the client accepts a supported encoding."""
+        if scope["type"] != "http" or scope["path"].startswith(self.exclude_paths):
+            await self.app(scope, receive, send)
+            return
+        accept_encoding = ""
+        for name, value in scope["headers"]:
+            if name == b"accept-encoding":
+                accept_encoding = value.decode("latin-1")
+                break
+        encoding = choose_encoding(accept_encoding, self.encodings)
+        if encoding == "identity":
+            await self.app(scope, receive, send)
+            return
+
+        state = scope.setdefault("state", {})
+        start: Message | None = None
+        compressor = None
+
+        async def compress_send(message: Message):
+            nonlocal start, compressor
+            if message["type"] == "http.response.start":
+                if message["status"] == 304:
+                    # no body, but the ETag matches the one sent with the compressed body
+                    weaken_etag(MutableHeaders(raw=message["headers"]))
+                # wait for the first body to decide whether to compress
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start is not None:
+                headers = MutableHeaders(raw=start["headers"])
+                if self.should_compress(headers, body, more_body):
+                    compressor = get_compressor(encoding, self.levels[encoding])
+                    headers["Content-Encoding"] = encoding
+                    headers.add_vary_header("Accept-Encoding")
+                    if "content-length" in headers:
+                        del headers["content-length"]
+                    weaken_etag(headers)
+                    state[WIRE_BYTES] = 0
+                await send(start)
+                start = None
+            if compressor is None:
+                await send(message)
+                return
+            data = compressor.compress(body)
+            data += flush_chunk(encoding, compressor) if more_body else compressor.flush()
+            state[WIRE_BYTES] += len(data)
+            await send({"type": "http.response.body", "body": data, "more_body": more_body})
+
+        await self.app(scope, receive, compress_send)
+        if start is not None:
+            # response had no body
+            await send(start)
+
+    def should_compress(self, headers: MutableHeaders, body: bytes, more_body: bool) -> bool:
+        """Return True if a response is worth compressing, from its headers and first body."""
+        if "content-encoding" in headers:
+            return False
+        if headers.get("content-type", "").startswith(self.exclude_types):
+            return False
+        return more_body or len(body) >= self.minimum_size
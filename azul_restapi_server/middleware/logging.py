@@ -1,90 +1,157 @@
 """Provide audit for all requests."""
 
 import datetime
+import re
+import string
 import time
-from collections import namedtuple
+import uuid
 
-from fastapi import Request
 from starlette import datastructures as s_datas
 from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
+from azul_restapi_server import audit
+from azul_restapi_server.middleware.compression import WIRE_BYTES
 from azul_restapi_server.settings import logging as log_config
 
-UnknownPath = namedtuple("UnknownPath", ["path"])
+# address reported when the server doesn't know the client
+_DEFAULT_CLIENT = ("localhost", 5000)
+# format vars that are read from a request header
+_HEADER_FIELDS = {
+    b"connection": "connection",
+    b"user-agent": "user_agent",
+    b"referer": "referer",
+    b"x-request-id": "request_id",
+}
+# values included in structured records, 'headers' is left out as it holds credentials
+_STRUCTURED_FIELDS = frozenset(_HEADER_FIELDS.values()) | {"client_ip", "generic_path", "time"}
+
+
+def template_fields(template: str) -> frozenset[str]:
+    """Return the names of the values used by a str.format template."""
+    names = set()
+    for _, field, _, _ in string.Formatter().parse(template):
+        if field:
+            # strip attribute and index access, i.e. 'headers[x-custom]' -> 'headers'
+            names.add(re.split(r"[.\[]", field, maxsplit=1)[0])
+    return frozenset(names)
 
 
 class AuditMiddleware:
-    """Provide audit for all requests."""
+    """Provide audit for all requests.
+
+    Values for the audit format are read straight from the ASGI scope.
+    Those that are costly to produce are only gathered if the configured format uses them.
+    Structured output modes encode all values except headers, instead of using the format.
+
+    Durations are to the start of the response, the record is written once the body has been sent
+    so it can include the body size before and after compression.
+    """
 
     def __init__(self, app: ASGIApp) -> None:
         self.app = app
+        self.audit_format = log_config.audit_format
+        self.path_filter = frozenset(log_config.audit_path_filter)
+        self.encode = audit.get_encoder(log_config.audit_output)
+        fields = template_fields(self.audit_format) if self.encode is None else _STRUCTURED_FIELDS
+        self.header_fields = {k: v for k, v in _HEADER_FIELDS.items() if v in fields}
+        self.use_client = not fields.isdisjoint(("client_ip", "client_port"))
+        self.use_generic_path = "generic_path" in fields
+        self.use_headers = "headers" in fields
+        self.use_time = "time" in fields
 
     async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
         """Continue processing chain with app until we need to log."""
         if scope["type"] != "http":
             await self.app(scope, receive, send)
             return
-        request = Request(scope, receive=receive)
-        start_time = time.time()
-        await self.app(scope, receive, lambda x: self.sender(request, send, start_time, x))
-
-    async def sender(self, request: Request, send: Send, start_time, message: Message):
-        """Perform logging of event."""
-        await self.log_event(request, start_time, message)
-        return await send(message)
-
-    async def log_event(self, request: Request, start_time, message: Message):
-        """Audit the request when a response is generated."""
-        if message["type"] != "http.response.start":
-            # doesn't contain status code
-            # we should have already processed the http.response.start message
-            return
-        if request.url.path in log_config.audit_path_filter:
-            return
-
-        duration_s = time.time() - start_time
-        duration_ms = duration_s * 1000
-        duration_us = duration_ms * 1000
+        start_ns = time.perf_counter_ns()
+        # shared with request.state, so the user found during validation can be read back
+        state = scope.setdefault("state", {})
+        fmt_vars = None
+        body_bytes = 0
+
+        async def audit_send(message: Message):
+            nonlocal fmt_vars, body_bytes
+            if message["type"] == "http.response.start":
+                fmt_vars = self.start_event(scope, state, start_ns, message)
+            elif message["type"] == "http.response.body":
+                body_bytes += len(message.get("body", b""))
+            await send(message)
+            if fmt_vars is not None and message["type"] == "http.response.body" and not message.get("more_body"):
+                await self.log_event(scope, state, fmt_vars, body_bytes)
+                fmt_vars = None
+
+        try:
+            await self.app(scope, receive, audit_send)
+        finally:
+            if fmt_vars is not None:
+                # body was never completed, i.e. the client disconnected
+                await self.log_event(scope, state, fmt_vars, body_bytes)
+
+    def start_event(self, scope: Scope, state: dict, start_ns: int, message: Message) -> dict | None:
+        """Gather the values to audit when the response starts, or None if the path isn't audited."""
+        if scope["path"] in self.path_filter:
+            return None
+        duration_ns = time.perf_counter_ns() - start_ns
 
         # Try to find a security label the application has emitted under the
         # "x-azul-security" header
         security_label = "-"
-
         for name, value in message["headers"]:
             if name == b"x-azul-security":
                 security_label = str(value, "UTF-8")
                 break
 
-        username = "-"
-        if hasattr(request.state, "user_info"):
-            username = request.state.user_info.username
+        user_info = state.get("user_info")
+        username = user_info.username if user_info is not None else "-"
         # add the username to the outgoing response
         message["headers"].append((b"X-Username", username.encode()))
 
-        if request.client:
-            req_host: s_datas.Address = request.client
-        else:
-            req_host: s_datas.Address = s_datas.Address(host="localhost", port=5000)
         # define simple, optional vars for format string
         fmt_vars = dict(
             username=username,
-            client_ip=req_host.host,
-            client_port=req_host.port,
-            connection=request.headers.get("connection", "-"),
-            method=request.method,
-            path=request.url.path,
-            # Generic path that doesn't contain any parameters
-            generic_path=request.scope.get("root_path", "") + request.scope.get("route", UnknownPath("")).path,
+            method=scope["method"],
+            path=scope["path"],
             status_code=message["status"],
-            # allow fall back access to header for custom, 'x-' style values
-            headers=request.headers,
-            user_agent=request.headers.get("user-agent", "-"),
-            referer=request.headers.get("referer", "-"),
-            time=datetime.datetime.now(tz=datetime.timezone.utc),
-            duration_s=duration_s,
-            duration_ms=duration_ms,
-            duration_us=duration_us,
+            duration_s=duration_ns / 1e9,
+            duration_ms=duration_ns / 1e6,
+            duration_us=duration_ns / 1e3,
             security=security_label,
         )
-
-        request.app.audit_logger.info(log_config.audit_format.format(**fmt_vars))
+        if self.use_client:
+            client = scope.get("client") or _DEFAULT_CLIENT
+            fmt_vars["client_ip"] = client[0]
+            fmt_vars["client_port"] = client[1]
+        if self.header_fields:
+            for field in self.header_fields.values():
+                fmt_vars[field] = "-"
+            for name, value in scope["headers"]:
+                field = self.header_fields.get(name)
+                # first value wins if a header is repeated
+                if field is not None and fmt_vars[field] == "-":
+                    fmt_vars[field] = value.decode("latin-1")
+            if fmt_vars.get("request_id") == "-":
+                # client did not supply an id to correlate with
+                fmt_vars["request_id"] = uuid.uuid4().hex
+        if self.use_generic_path:
+            # Generic path that doesn't contain any parameters
+            route = scope.get("route")
+            fmt_vars["generic_path"] = scope.get("root_path", "") + (route.path if route is not None else "")
+        if self.use_headers:
+            # allow fall back access to header for custom, 'x-' style values
+            fmt_vars["headers"] = s_datas.Headers(scope=scope)
+        if self.use_time:
+            fmt_vars["time"] = datetime.datetime.now(tz=datetime.timezone.utc)
+        return fmt_vars
+
+    async def log_event(self, scope: Scope, state: dict, fmt_vars: dict, body_bytes: int):
+        """Audit the request once the response has been sent."""
+        fmt_vars["body_bytes"] = body_bytes
+        # set by the compression middleware when it compressed the body
+        fmt_vars["wire_bytes"] = state.get(WIRE_BYTES, body_bytes)
+        if self.encode is None:
+            record = self.audit_format.format_map(fmt_vars)
+        else:
+            fmt_vars["time"] = fmt_vars["time"].isoformat()
+            record = self.encode(fmt_vars)
+        await scope["app"].audit_writer.write_async(record)
@@ -0,0 +1,139 @@
+"""Profile memory allocation and time of sampled requests, to find routes that leak or hog the cpu.
+
+One in every `interval` requests is profiled, as is any request with an `X-Azul-Profile` header matching the token.
+Memory is traced with tracemalloc from the first profiled request, which slows down all allocations in the worker,
+so profiling is off unless configured.
+
+Allocation and cpu time are measured for the whole worker while the request runs, including its thread pools,
+so they include other requests handled at the same time. Averaged over many samples, routes that retain memory
+still stand out.
+
+The report shows where the server holds memory, so it is only served to requests with the token.
+"""
+
+import hmac
+import os
+import threading
+import time
+import tracemalloc
+
+from fastapi import Header, HTTPException
+from prometheus_client import Gauge
+from starlette.status import HTTP_403_FORBIDDEN
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from azul_restapi_server import settings
+
+# values are per worker, as leaks are found by watching a single process grow
+sampled_requests = Gauge("azulapi_profile_requests", "Requests profiled", ["route"])
+mean_wall_seconds = Gauge("azulapi_profile_wall_seconds", "Mean wall time of profiled requests", ["route"])
+mean_cpu_seconds = Gauge("azulapi_profile_cpu_seconds", "Mean cpu time of profiled requests", ["route"])
+retained_bytes = Gauge(
+    "azulapi_profile_retained_bytes", "Memory still allocated after profiled requests finished, summed", ["route"]
+)
+traced_bytes = Gauge("azulapi_profile_traced_bytes", "Memory currently allocated, as traced by tracemalloc")
+
+# route -> totals over the profiled requests
+_routes: dict[str, dict[str, float]] = {}
+_lock = threading.Lock()
+
+
+def _route(scope: Scope) -> str:
+    """Return the method and route template of a request."""
+    route = scope.get("route")
+    # requests that didn't match a route are grouped together, to keep label cardinality down
+    path = scope.get("root_path", "") + route.path if route is not None else "unknown"
+    return f"{scope['method']} {path}"
+
+
+def record(route: str, wall: float, cpu: float, retained: int):
+    """Add a profiled request to the totals of its route."""
+    with _lock:
+        totals = _routes.setdefault(route, {"count": 0, "wall": 0.0, "cpu": 0.0, "retained": 0, "max_retained": 0})
+        totals["count"] += 1
+        totals["wall"] += wall
+        totals["cpu"] += cpu
+        totals["retained"] += retained
+        totals["max_retained"] = max(totals["max_retained"], retained)
+        sampled_requests.labels(route).set(totals["count"])
+        mean_wall_seconds.labels(route).set(totals["wall"] / totals["count"])
+        mean_cpu_seconds.labels(route).set(totals["cpu"] / totals["count"])
+        retained_bytes.labels(route).set(totals["retained"])
+
+
+def report(top: int = 20) -> dict:
+    """Return the profile of each route and the lines holding the most memory in this worker.
+
+    Taking a snapshot walks every traced allocation, so call this from a worker thread.
+    """
+    with _lock:
+        routes = {
+            route: {
+                "count": totals["count"],
+                "mean_wall_seconds": totals["wall"] / totals["count"],
+                "mean_cpu_seconds": totals["cpu"] / totals["count"],
+                "retained_bytes": totals["retained"],
+                "max_retained_bytes": totals["max_retained"],
+            }
+            for route, totals in _routes.items()
+        }
+    result = {"pid": os.getpid(), "tracing": tracemalloc.is_tracing(), "routes": routes, "top_allocations": []}
+    if not result["tracing"]:
+        return result
+    result["traced_bytes"], result["peak_traced_bytes"] = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    for stat in snapshot.statistics("lineno")[:top]:
+        frame = stat.traceback[0]
+        result["top_allocations"].append(
+            {"location": f"{frame.filename}:{frame.lineno}", "size_bytes": stat.size, "count": stat.count}
+        )
+    return result
+
+
+def require_token(x_azul_profile: str = Header("", include_in_schema=False)):
+    """Refuse requests without an X-Azul-Profile header matching the token, as a dependency of the report."""
+    token = settings.restapi.profile_token.encode()
+    if not token or not hmac.compare_digest(x_azul_profile.encode(), token):
+        raise HTTPException(
+            status_code=HTTP_403_FORBIDDEN, detail="X-Azul-Profile header must match the profile token"
+        )
+
+
+class ProfilingMiddleware:
+    """Profile memory allocation, wall and cpu time of sampled requests, by route template."""
+
+    def __init__(self, app: ASGIApp, interval: int = 0, token: str = "", frames: int = 1) -> None:  # nosec B107
+        self.app = app
+        self.interval = interval
+        self.token = token.encode()
+        self.frames = frames
+        self._requests = 0
+
+    def sampled(self, scope: Scope) -> bool:
+        """Return True if the request should be profiled."""
+        if self.interval:
+            self._requests += 1
+            if self._requests % self.interval == 0:
+                return True
+        if self.token:
+            for name, value in scope["headers"]:
+                if name == b"x-azul-profile":
+                    return hmac.compare_digest(value, self.token)
+        return False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """Profile the request if it is sampled."""
+        if scope["type"] != "http" or not self.sampled(scope):
+            await self.app(scope, receive, send)
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        allocated = tracemalloc.get_traced_memory()[0]
+        cpu = time.process_time()
+        wall = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current = tracemalloc.get_traced_memory()[0]
+            record(_route(scope), time.perf_counter() - wall, time.process_time() - cpu, current - allocated)
+            traced_bytes.set(current)
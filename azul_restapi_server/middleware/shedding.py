@@ -0,0 +1,98 @@
+"""Reject new requests early while the worker is overloaded, so admitted requests can still finish in time.
+
+A worker is overloaded while it has too many requests in progress, or while its event loop is running late,
+which happens when it has more work than it can get through. New requests are refused with a 503 until it recovers.
+Requests for exempt paths, i.e. metrics and health checks, are always let through.
+
+Requests for priority paths, i.e. the user's own details, docs and static assets, are cheap and keep the UI usable,
+so they are only refused once the worker is twice as overloaded. Everything else, i.e. plugin routes, is refused first.
+Priority paths ending in '/' match any path they start, others must match exactly.
+"""
+
+import asyncio
+import time
+
+from prometheus_client import Counter, Gauge
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+# seconds between measurements of the event loop lag
+_LAG_INTERVAL = 0.1
+# priority requests are refused at this multiple of the limits
+_PRIORITY_HEADROOM = 2
+
+shed_requests = Counter("azulapi_shed_requests", "Requests refused because the worker was overloaded", ["reason"])
+requests_in_flight = Gauge(
+    "azulapi_requests_in_flight", "Requests in progress, excluding exempt paths", multiprocess_mode="livesum"
+)
+loop_lag = Gauge("azulapi_event_loop_lag_seconds", "How late the event loop last ran a scheduled callback")
+
+
+class LoadSheddingMiddleware:
+    """Refuse new requests with a 503 while too many are in progress, or the event loop is lagging."""
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        max_in_flight: int = 0,
+        max_loop_lag: float = 0,
+        exempt_paths: list[str] = ("/metrics",),
+        priority_paths: list[str] = (),
+        retry_after: int = 1,
+    ) -> None:
+        self.app = app
+        self.max_in_flight = max_in_flight
+        self.max_loop_lag = max_loop_lag
+        self.exempt_paths = tuple(exempt_paths)
+        self.priority_paths = frozenset(p for p in priority_paths if not p.endswith("/"))
+        self.priority_prefixes = tuple(p for p in priority_paths if p.endswith("/"))
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.lag = 0.0
+        self._monitor: asyncio.Task | None = None
+
+    async def monitor_lag(self):
+        """Measure how late the event loop wakes up from a sleep, for as long as the worker runs."""
+        while True:
+            expected = time.perf_counter() + _LAG_INTERVAL
+            await asyncio.sleep(_LAG_INTERVAL)
+            self.lag = max(0.0, time.perf_counter() - expected)
+            loop_lag.set(self.lag)
+
+    def overloaded(self, headroom: float = 1) -> str | None:
+        """Return why the worker is overloaded, or None if it isn't, at a multiple of the limits."""
+        if self.max_in_flight and self.in_flight >= self.max_in_flight * headroom:
+            return "in_flight"
+        if self.max_loop_lag and self.lag >= self.max_loop_lag * headroom:
+            return "loop_lag"
+        return None
+
+    def priority(self, path: str) -> bool:
+        """Return True if requests for the path are only refused once the worker is more overloaded."""
+        return path in self.priority_paths or path.startswith(self.priority_prefixes)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """Admit or refuse the request."""
+        if scope["type"] != "http" or scope["path"].startswith(self.exempt_paths):
+            await self.app(scope, receive, send)
+            return
+        if self.max_loop_lag and (self._monitor is None or self._monitor.get_loop() is not asyncio.get_running_loop()):
+            # started by the first request, as it must run on the event loop serving requests
+            self._monitor = asyncio.create_task(self.monitor_lag())
+        reason = self.overloaded(_PRIORITY_HEADROOM if self.priority(scope["path"]) else 1)
+        if reason is not None:
+            shed_requests.labels(reason).inc()
+            response = JSONResponse(
+                {"detail": "Server is overloaded, try again later"},
+                status_code=503,
+                headers={"Retry-After": str(self.retry_after)},
+            )
+            await response(scope, receive, send)
+            return
+        self.in_flight += 1
+        requests_in_flight.inc()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.in_flight -= 1
+            requests_in_flight.dec()
@@ -0,0 +1,83 @@
+"""Provide per stage latency metrics for all requests."""
+
+import time
+
+from prometheus_client import Histogram
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from azul_restapi_server import plugins, stages
+
+stage_seconds = Histogram(
+    "azulapi_request_stage_seconds",
+    "Time spent in each stage of handling a request",
+    ["stage", "route", "plugin"],
+    buckets=(
+        0.0005,
+        0.001,
+        0.0025,
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1.0,
+        2.5,
+        5.0,
+        10.0,
+        30.0,
+        60.0,
+        float("inf"),
+    ),
+)
+
+
+class StageTimingMiddleware:
+    """Record how long each stage of a request takes, labelled by route template and plugin.
+
+    Optionally report the stages that finished before the response started in a Server-Timing header.
+    """
+
+    def __init__(self, app: ASGIApp, server_timing: bool = False) -> None:
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """Collect stage timings while the rest of the app handles the request."""
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timings = {}
+        token = stages.timings.set(timings)
+        start = time.perf_counter()
+        response_start = None
+
+        async def timing_send(message: Message):
+            nonlocal response_start
+            if message["type"] == "http.response.start":
+                response_start = time.perf_counter()
+                timings["handler"] = response_start - start - timings.get("auth", 0.0) - timings.get("queue", 0.0)
+                if self.server_timing:
+                    header = ", ".join(f"{stage};dur={seconds * 1000:.3f}" for stage, seconds in timings.items())
+                    MutableHeaders(scope=message).append("server-timing", header)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, timing_send)
+        finally:
+            stages.timings.reset(token)
+            if response_start is not None:
+                timings["send"] = time.perf_counter() - response_start
+                self.observe(scope, timings)
+
+    @staticmethod
+    def observe(scope: Scope, timings: dict[str, float]):
+        """Add the timings of a finished request to the histograms."""
+        route = scope.get("route")
+        # requests that didn't match a route are grouped together, to keep label cardinality down
+        route_path = scope.get("root_path", "") + route.path if route is not None else "unknown"
+        plugin = plugins.plugin_endpoints.get(scope.get("endpoint"), "")
+        for stage, seconds in timings.items():
+            stage_seconds.labels(stage, route_path, plugin).observe(seconds)
@@ -0,0 +1,61 @@
+"""Build the OpenAPI document once and serve it precompressed with an ETag.
+
+Building the document walks every plugin route, which takes seconds with large plugins.
+It is built on first use, during startup when `restapi_openapi_prebuild` is set,
+or read from a file written by `azul-restapi-server openapi` when `restapi_openapi_file` is set.
+"""
+
+import threading
+
+import anyio.to_thread
+from fastapi import FastAPI
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse, Response
+
+from azul_restapi_server import assets
+
+
+class OpenAPIDocument:
+    """The serialised OpenAPI document of an app."""
+
+    def __init__(self, app: FastAPI, path: str = ""):
+        """Document the app, or serve the document previously written to path if set."""
+        self.app = app
+        self.path = path
+        self._asset: assets.Asset | None = None
+        self._lock = threading.Lock()
+
+    def render(self) -> bytes:
+        """Return the OpenAPI document of the app, the same as FastAPI would serve it."""
+        root_path = self.app.root_path.rstrip("/")
+        if root_path and self.app.root_path_in_servers:
+            if root_path not in {server.get("url") for server in self.app.servers}:
+                self.app.servers.insert(0, {"url": root_path})
+        return JSONResponse(self.app.openapi()).body
+
+    def build(self) -> assets.Asset:
+        """Build the document, and its compressed variants, if that hasn't happened yet."""
+        with self._lock:
+            if self._asset is None:
+                if self.path:
+                    with open(self.path, "rb") as f:
+                        content = f.read()
+                else:
+                    content = self.render()
+                asset = assets.Asset(content, "application/json")
+                asset.load_variants()
+                self._asset = asset
+            return self._asset
+
+    def write(self, path: str):
+        """Write the document of the app to a file, to be served by later runs."""
+        with open(path, "wb") as f:
+            f.write(self.render())
+
+    async def response(self, request_headers: Headers) -> Response:
+        """Return the document for a request."""
+        asset = self._asset
+        if asset is None:
+            asset = await anyio.to_thread.run_sync(self.build)
+        # the url doesn't change when plugins do, so clients revalidate
+        return await asset.response(request_headers, assets.REVALIDATE)
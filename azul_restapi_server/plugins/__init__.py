@@ -15,22 +15,91 @@ Example Entry point for plugins:
 """
 
 import importlib.metadata
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
 
 from azul_bedrock.exceptions import BaseError
 from fastapi import APIRouter, Depends
+from fastapi.datastructures import Default, DefaultPlaceholder
+from fastapi.routing import APIRoute
+from prometheus_client import Gauge
+from starlette.responses import JSONResponse, Response
 
+from azul_restapi_server import ratelimit, response_cache, settings
 from azul_restapi_server.security import validate_token
 
+load_seconds = Gauge("azulapi_plugin_load_seconds", "Time taken to import each plugin", ["plugin"])
 
-def get_router():
-    """Search the configured entry points and load the defined routers."""
-    plugins = sorted(
-        [(ep.name, ep.load()) for ep in importlib.metadata.entry_points().select(group="azul_restapi.plugin")],
-        key=lambda x: x[0],
-    )
+# endpoint function of each plugin route -> entry point name of the plugin
+plugin_endpoints: dict[Callable, str] = {}
+# entry point name -> seconds taken to import the plugin
+load_times: dict[str, float] = {}
+# entry point name -> loaded router
+_loaded: dict[str, APIRouter] = {}
+# plugins were imported by the master process before workers were forked
+preloaded = False
+
+
+def _load(ep: importlib.metadata.EntryPoint) -> tuple[str, APIRouter]:
+    """Import a single plugin and record how long it took."""
+    start = time.perf_counter()
+    plugin = ep.load()
+    load_times[ep.name] = time.perf_counter() - start
+    load_seconds.labels(ep.name).set(load_times[ep.name])
+    print(f"loaded plugin: {ep.name} in {load_times[ep.name]:.3f}s")
+    return ep.name, plugin
+
+
+def load_plugins(workers: int = 1) -> list[tuple[str, APIRouter]]:
+    """Import the routers of all plugins, sorted by name, importing each only once.
+
+    With more than one worker, plugins are imported from a thread pool,
+    which helps when imports wait on disk or release the GIL in native code.
+    """
+    eps = [
+        ep for ep in importlib.metadata.entry_points().select(group="azul_restapi.plugin") if ep.name not in _loaded
+    ]
+    if workers > 1 and len(eps) > 1:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="plugin-loader") as pool:
+            _loaded.update(pool.map(_load, eps))
+    else:
+        _loaded.update(map(_load, eps))
+    return sorted(_loaded.items(), key=lambda x: x[0])
+
+
+def preload():
+    """Import all plugins ahead of the app, i.e. in the master process before workers are forked."""
+    global preloaded
+    load_plugins(settings.restapi.plugin_load_workers)
+    preloaded = True
+
+
+def get_router(default_response_class: type[Response] = JSONResponse):
+    """Search the configured entry points and load the defined routers.
+
+    Routes that don't set their own response class use default_response_class.
+    """
+    # require all users of an api to have a valid token
+    dependencies = [Depends(validate_token)]
+    limiter = ratelimit.get_limiter()
+    if limiter.enabled:
+        # after validation, as limits are per user
+        dependencies.append(Depends(limiter))
+    cache = response_cache.get_cache()
     router = APIRouter()
-    for name, plugin in plugins:
-        print(f"loaded plugin: {name}")
+    for name, plugin in load_plugins(settings.restapi.plugin_load_workers):
+        for route in plugin.routes:
+            if hasattr(route, "endpoint"):
+                plugin_endpoints[route.endpoint] = name
+            # FastAPI only applies the app default to routes declared on the app itself.
+            # Kept as a placeholder, so FastAPI still serialises response models straight to json.
+            if isinstance(route, APIRoute) and isinstance(route.response_class, DefaultPlaceholder):
+                route.response_class = Default(default_response_class)
+        plugin_dependencies = dependencies
+        if any(cache.uses(getattr(route, "endpoint", None)) for route in plugin.routes):
+            # after validation, as responses are kept by the roles of the user
+            plugin_dependencies = [*dependencies, Depends(cache)]
         router.include_router(
             plugin,
             tags=[name],
@@ -38,7 +107,6 @@ def get_router():
                 404: {"description": "Not found"},
                 500: {"model": BaseError, "description": "Something went wrong"},
             },
-            # require all users of an api to have a valid token
-            dependencies=[Depends(validate_token)],
+            dependencies=plugin_dependencies,
         )
     return router
@@ -0,0 +1,111 @@
+"""Run several worker processes.
+
+Uvicorn starts its workers with spawn, so each worker imports every plugin itself.
+`serve` instead forks workers from a master process that has already imported the plugins and warmed shared state,
+so workers start faster and share those pages copy-on-write.
+
+With several workers, metrics are collected from every worker by prometheus_client's multiprocess mode.
+"""
+
+import os
+import re
+import signal
+import socket
+import sys
+import tempfile
+import time
+import traceback
+
+import uvicorn
+
+# wait before replacing a worker that exited, so a crashing worker doesn't spin
+RESTART_DELAY_S = 1.0
+# files prometheus_client keeps metric values in, named after the metric type and process id
+_METRIC_FILE = re.compile(r"^(counter|histogram|summary|gauge_[a-z]+)_\d+\.db$")
+
+
+def prepare_metrics():
+    """Set up prometheus multiprocess collection, using PROMETHEUS_MULTIPROC_DIR or a new temp dir.
+
+    Must run before prometheus_client is imported, as that is when it decides where metric values are kept.
+    """
+    if "prometheus_client" in sys.modules:
+        print("prometheus_client was imported before setting up multiprocess metrics, they may be incomplete")
+    path = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if not path:
+        path = os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="azul-restapi-metrics-")
+    os.makedirs(path, exist_ok=True)
+    # values left by a previous run would be added to this one
+    for name in os.listdir(path):
+        if _METRIC_FILE.match(name):
+            os.remove(os.path.join(path, name))
+    print(f"collecting metrics from all workers in {path}")
+
+
+def _worker_exited(pid: int):
+    """Drop the live gauges of a worker that is gone."""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(pid)
+
+
+def _run_worker(config: uvicorn.Config, sock: socket.socket):
+    """Serve requests in a forked worker, never returning to the caller."""
+    # uvicorn installs its own handlers, drop the ones inherited from the master
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    code = 0
+    try:
+        uvicorn.Server(config).run(sockets=[sock])
+    except SystemExit as e:
+        # uvicorn exits when startup fails
+        code = e.code if isinstance(e.code, int) else 1
+    except Exception:
+        traceback.print_exc()
+        code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+
+def serve(config: uvicorn.Config, workers: int):
+    """Bind the socket, fork the workers and replace any that exit until told to stop."""
+    sock = config.bind_socket()
+    children: set[int] = set()
+    stopping = False
+
+    def fork():
+        pid = os.fork()
+        if pid == 0:
+            _run_worker(config, sock)
+        children.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for _ in range(workers):
+        fork()
+    print(f"forked {workers} workers from master {os.getpid()}")
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        _worker_exited(pid)
+        if not stopping:
+            print(f"worker {pid} exited with code {os.waitstatus_to_exitcode(status)}, replacing it")
+            time.sleep(RESTART_DELAY_S)
+            fork()
+    sock.close()
@@ -0,0 +1,186 @@
+"""Limit how fast, and how many requests at once, each user can make to plugin routes.
+
+Rates are token buckets per user and route template, refilled at the configured requests per second
+and holding up to the burst size. Buckets are held in memory by each worker, unless a shared backend is configured.
+A backend is any object with a `take(key, rate, burst)` method, sync or async, returning the tokens left in the
+bucket and, if there were none to take, the seconds until there will be.
+
+Requests in progress are limited per user in each worker, as a request only ties up the worker handling it.
+
+Limited requests get a 429 with a Retry-After header.
+
+Metrics are by route, not user, so the number of series doesn't grow with the number of users.
+"""
+
+import inspect
+import math
+import pkgutil
+import threading
+import time
+from typing import Any
+
+from fastapi import HTTPException, Request
+from prometheus_client import Counter, Gauge
+from starlette.status import HTTP_429_TOO_MANY_REQUESTS
+
+from azul_restapi_server import settings
+
+limited_users = Gauge(
+    "azulapi_ratelimit_limited_users",
+    "Users with an empty bucket for a route, as of the last request to it",
+    ["route"],
+    multiprocess_mode="livesum",
+)
+in_progress = Gauge(
+    "azulapi_ratelimit_in_progress",
+    "Plugin requests in progress, counted by the concurrency limit",
+    multiprocess_mode="livesum",
+)
+rejected = Counter("azulapi_ratelimit_rejected", "Requests refused by a limit", ["route", "reason"])
+
+# buckets are checked for pruning after this many requests
+_PRUNE_INTERVAL = 1024
+
+
+class MemoryBackend:
+    """Token buckets held in the memory of this worker."""
+
+    def __init__(self):
+        # key -> (tokens, time last updated, refill rate)
+        self._buckets: dict[str, tuple[float, float, float]] = {}
+        self._lock = threading.Lock()
+        self._takes = 0
+
+    def take(self, key: str, rate: float, burst: int) -> tuple[float, float]:
+        """Take a token, returning the tokens left and the seconds until one is available if there were none."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated, _ = self._buckets.get(key, (burst, now, rate))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            retry_after = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                retry_after = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now, rate)
+            self._takes += 1
+            if self._takes % _PRUNE_INTERVAL == 0:
+                self._prune(now, burst)
+        return tokens, retry_after
+
+    def _prune(self, now: float, burst: int):
+        """Forget buckets that have refilled, which are the same as a new bucket."""
+        for key, (tokens, updated, rate) in list(self._buckets.items()):
+            if tokens + (now - updated) * rate >= burst:
+                del self._buckets[key]
+
+
+def _load_backend(name: str) -> Any:
+    """Return the configured backend, from a 'module:attribute' name that is a backend or makes one."""
+    if not name:
+        return MemoryBackend()
+    backend = pkgutil.resolve_name(name)
+    return backend() if inspect.isclass(backend) else backend
+
+
+class Limiter:
+    """Apply the configured rate and concurrency limits, as a dependency of plugin routes."""
+
+    def __init__(
+        self,
+        rate: float = 0,
+        burst: int = 20,
+        route_rates: dict[str, float] | None = None,
+        concurrency: int = 0,
+        exempt_roles: list[str] = (),
+        backend: Any = None,
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.route_rates = route_rates or {}
+        self.concurrency = concurrency
+        self.exempt_roles = frozenset(exempt_roles)
+        self.backend = backend if backend is not None else MemoryBackend()
+        self._async_take = inspect.iscoroutinefunction(self.backend.take)
+        # user -> requests in progress
+        self._in_progress: dict[str, int] = {}
+        # route -> user -> when their empty bucket will have a token again
+        self._limited: dict[str, dict[str, float]] = {}
+
+    @property
+    def enabled(self) -> bool:
+        """True if any limit is set."""
+        return bool(self.rate or self.route_rates or self.concurrency)
+
+    async def take(self, user: str, route: str):
+        """Take a token from the bucket of a user and route, raising a 429 if it is empty."""
+        rate = self.route_rates.get(route, self.rate)
+        if not rate:
+            return
+        key = f"{user}\x00{route}"
+        if self._async_take:
+            tokens, retry_after = await self.backend.take(key, rate, self.burst)
+        else:
+            tokens, retry_after = self.backend.take(key, rate, self.burst)
+        self._count_limited(user, route, tokens, rate)
+        if retry_after > 0:
+            rejected.labels(route, "rate").inc()
+            raise HTTPException(
+                status_code=HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many requests, slow down",
+                headers={"Retry-After": str(math.ceil(retry_after))},
+            )
+
+    def _count_limited(self, user: str, route: str, tokens: float, rate: float):
+        """Update the users with an empty bucket for a route, after a token was taken from the bucket of one."""
+        now = time.monotonic()
+        limited = self._limited.setdefault(route, {})
+        if tokens < 1:
+            limited[user] = now + (1 - tokens) / rate
+        else:
+            limited.pop(user, None)
+        for other, refilled in list(limited.items()):
+            if refilled <= now:
+                del limited[other]
+        limited_users.labels(route).set(len(limited))
+
+    async def __call__(self, request: Request):
+        """Limit a request by the user that made it, once the token has been validated."""
+        user_info = request.state.user_info
+        if not self.exempt_roles.isdisjoint(user_info.roles):
+            yield
+            return
+        user = user_info.username
+        route = request.scope.get("root_path", "") + request.scope["route"].path
+        await self.take(user, route)
+        if not self.concurrency:
+            yield
+            return
+        if self._in_progress.get(user, 0) >= self.concurrency:
+            rejected.labels(route, "concurrency").inc()
+            raise HTTPException(
+                status_code=HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many requests in progress, wait for some to finish",
+                headers={"Retry-After": "1"},
+            )
+        self._in_progress[user] = self._in_progress.get(user, 0) + 1
+        in_progress.inc()
+        try:
+            yield
+        finally:
+            in_progress.dec()
+            self._in_progress[user] -= 1
+            if not self._in_progress[user]:
+                del self._in_progress[user]
+
+
+def get_limiter() -> Limiter:
+    """Return a limiter with the configured limits."""
+    return Limiter(
+        rate=settings.restapi.rate_limit,
+        burst=settings.restapi.rate_limit_burst,
+        route_rates=settings.restapi.rate_limit_routes,
+        concurrency=settings.restapi.concurrency_limit,
+        exempt_roles=settings.restapi.rate_limit_exempt_roles,
+        backend=_load_backend(settings.restapi.rate_limit_backend),
+    )
@@ -0,0 +1,282 @@
+"""Cache the responses of plugin GET routes that opt in, and share them between identical requests in progress.
+
+Plugins opt in by decorating an endpoint with `cached`, `coalesced` or both:
+
+    @router.get("/v0/entities/{sha256}/summary")
+    @response_cache.cached(ttl=60)
+    @response_cache.coalesced
+    def read_summary(sha256: str): ...
+
+Responses are keyed by path, query and the roles of the user, so they are never shared between users with
+different access. Only opt in routes whose response depends on nothing else about the user.
+
+Cached responses are held in the memory of each worker until their ttl passes, and get an ETag,
+so clients that already have one get a 304.
+Requests to coalesced routes wait for an identical request already in progress and are sent its response,
+so the endpoint runs once rather than once per request.
+
+Responses are looked up by a dependency that runs once the token has been validated.
+When there is one to send it raises CacheHit, which ResponseCacheMiddleware catches to send the response.
+Otherwise the middleware keeps a copy of the response as it is sent, to cache and share it.
+"""
+
+import asyncio
+import functools
+import hashlib
+import time
+from typing import Callable
+from urllib.parse import parse_qsl
+
+import cachetools
+from fastapi import Request
+from prometheus_client import Counter, Gauge
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from azul_restapi_server import settings
+
+hits = Counter("azulapi_response_cache_hits", "Responses served from the response cache", ["route"])
+misses = Counter("azulapi_response_cache_misses", "Cacheable responses that had to be made", ["route"])
+coalesced_requests = Counter(
+    "azulapi_coalesced_requests",
+    "Requests sent the response of an identical request in progress, rather than running the endpoint",
+    ["route"],
+)
+cached_bytes = Gauge("azulapi_response_cache_bytes", "Memory used by cached responses")
+
+# headers that belong to a single response, and aren't cached
+_UNCACHED_HEADERS = frozenset((b"content-length", b"date", b"etag", b"cache-control", b"set-cookie"))
+# state of a request with a response to keep, its key, cache ttl and the future waited on by identical requests
+_STATE_KEY = "response_cache"
+
+
+def cached(ttl: int) -> Callable:
+    """Mark an endpoint as having a response that can be cached for ttl seconds."""
+
+    def decorator(func: Callable) -> Callable:
+        func.response_cache_ttl = ttl
+        return func
+
+    return decorator
+
+
+def coalesced(func: Callable) -> Callable:
+    """Mark an endpoint as having a response that can be shared between identical requests in progress."""
+    func.response_coalesced = True
+    return func
+
+
+class Entry:
+    """A response kept to send to other requests."""
+
+    __slots__ = ("status", "headers", "body", "etag", "created", "ttl")
+
+    def __init__(self, status: int, headers: list[tuple[bytes, bytes]], body: bytes, ttl: int | None):
+        """Hold a response, which is only shared with requests in progress if ttl is None."""
+        self.status = status
+        # content length is set from the body, a shared response otherwise keeps its headers except cookies
+        dropped = _UNCACHED_HEADERS if ttl is not None else {b"content-length", b"set-cookie"}
+        self.headers = [(k, v) for k, v in headers if k.lower() not in dropped]
+        self.body = body
+        self.etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'.encode() if ttl is not None else b""
+        self.created = time.monotonic()
+        self.ttl = ttl
+
+    def response_headers(self) -> list[tuple[bytes, bytes]]:
+        """Return the headers that go with the body, for how long clients may reuse it."""
+        if self.ttl is None:
+            # not cached, so sent as it was made
+            return []
+        age = int(time.monotonic() - self.created)
+        return [
+            (b"etag", self.etag),
+            # private, as the response depends on the roles of the user
+            (b"cache-control", f"private, max-age={max(0, self.ttl - age)}".encode()),
+            (b"age", str(age).encode()),
+        ]
+
+    async def send(self, scope: Scope, send: Send):
+        """Send the response, or a 304 if the client already has it."""
+        headers = self.response_headers()
+        if_none_match = Headers(scope=scope).get("if-none-match")
+        if if_none_match is not None and self.ttl is not None:
+            tags = {tag.strip().removeprefix("W/").encode() for tag in if_none_match.split(",")}
+            if b"*" in tags or self.etag in tags:
+                await send({"type": "http.response.start", "status": 304, "headers": headers})
+                await send({"type": "http.response.body", "body": b""})
+                return
+        headers += self.headers
+        headers.append((b"content-length", str(len(self.body)).encode()))
+        await send({"type": "http.response.start", "status": self.status, "headers": headers})
+        await send({"type": "http.response.body", "body": self.body})
+
+
+class CacheHit(Exception):
+    """Raised to skip the endpoint and send a cached response instead."""
+
+    def __init__(self, entry: Entry):
+        super().__init__("response is cached")
+        self.entry = entry
+
+
+class ResponseCache:
+    """Cached responses, held until their ttl passes or they are the least recently used when space is needed."""
+
+    def __init__(self, max_bytes: int, max_entry_bytes: int):
+        self.max_entry_bytes = max_entry_bytes
+        # key -> response of the request in progress, None if it can't be shared
+        self._in_flight: dict[str, asyncio.Future[Entry | None]] = {}
+        self._entries = cachetools.TLRUCache(
+            maxsize=max_bytes,
+            ttu=lambda _key, entry, now: now + entry.ttl,
+            timer=time.monotonic,
+            getsizeof=lambda entry: len(entry.body),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        """True if any responses can be cached."""
+        return self._entries.maxsize > 0
+
+    def uses(self, endpoint: Callable) -> bool:
+        """Return True if the responses of an endpoint can be cached or shared."""
+        return hasattr(endpoint, "response_coalesced") or (self.enabled and hasattr(endpoint, "response_cache_ttl"))
+
+    @staticmethod
+    def key(request: Request) -> str:
+        """Return the key of a request, from its path, query and the roles of the user."""
+        query = sorted(parse_qsl(request.scope["query_string"].decode("latin-1"), keep_blank_values=True))
+        roles = sorted(request.state.user_info.roles)
+        return f"{request.scope['path']}\x00{query!r}\x00{roles!r}"
+
+    def get(self, key: str) -> Entry | None:
+        """Return a cached response."""
+        return self._entries.get(key)
+
+    def put(self, key: str, entry: Entry):
+        """Cache a response, unless it is too big."""
+        # cachetools raises for an entry bigger than the whole cache
+        if len(entry.body) <= min(self.max_entry_bytes, self._entries.maxsize):
+            self._entries[key] = entry
+        cached_bytes.set(self._entries.currsize)
+
+    def finish(self, key: str, flight: "asyncio.Future[Entry | None] | None", entry: Entry | None):
+        """Send a response to identical requests waiting on it, or None to have them run the endpoint themselves."""
+        if flight is None:
+            return
+        if self._in_flight.get(key) is flight:
+            del self._in_flight[key]
+        if not flight.done():
+            flight.set_result(entry)
+
+    def clear(self):
+        """Forget all cached responses."""
+        self._entries.clear()
+        cached_bytes.set(0)
+
+    async def __call__(self, request: Request):
+        """Send a cached or shared response to a request, or mark the response to be kept."""
+        endpoint = request.scope.get("endpoint")
+        if not self.uses(endpoint) or request.method != "GET":
+            return
+        route = request.scope.get("root_path", "") + request.scope["route"].path
+        key = self.key(request)
+        ttl = getattr(endpoint, "response_cache_ttl", None) if self.enabled else None
+        if ttl is not None:
+            entry = self.get(key)
+            if entry is not None:
+                hits.labels(route).inc()
+                raise CacheHit(entry)
+            misses.labels(route).inc()
+        flight = None
+        if hasattr(endpoint, "response_coalesced"):
+            leader = self._in_flight.get(key)
+            if leader is None:
+                flight = self._in_flight[key] = asyncio.get_running_loop().create_future()
+            else:
+                # shielded, so a waiting client disconnecting doesn't cancel it for the others
+                entry = await asyncio.shield(leader)
+                if entry is not None:
+                    coalesced_requests.labels(route).inc()
+                    raise CacheHit(entry)
+        request.state.response_cache = (key, ttl, flight)
+
+
+class ResponseCacheMiddleware:
+    """Send cached and shared responses, and keep responses marked by the dependency, see the module docstring.
+
+    Must be the innermost middleware, as other middleware don't expect a CacheHit exception.
+    """
+
+    def __init__(self, app: ASGIApp, cache: "ResponseCache | None" = None) -> None:
+        self.app = app
+        self.cache = cache if cache is not None else get_cache()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """Send the cached or shared response if there is one, otherwise keep the response."""
+        if scope["type"] != "http" or scope["method"] != "GET":
+            await self.app(scope, receive, send)
+            return
+        state = scope.setdefault("state", {})
+        start: Message | None = None
+        body = []
+        size = 0
+
+        def abandon():
+            """Give up on keeping the response, identical requests waiting on it run the endpoint themselves."""
+            key, _, flight = state.pop(_STATE_KEY)
+            self.cache.finish(key, flight, None)
+
+        async def cache_send(message: Message):
+            nonlocal start, size
+            if _STATE_KEY not in state:
+                await send(message)
+                return
+            if message["type"] == "http.response.start":
+                if message["status"] != 200:
+                    abandon()
+                    await send(message)
+                    return
+                # held until the body is complete, to add its ETag
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+            body.append(message.get("body", b""))
+            size += len(body[-1])
+            if size > self.cache.max_entry_bytes:
+                # too big to keep, send what has been held back and the rest as it comes
+                abandon()
+                await send(start)
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": b"".join(body),
+                        "more_body": message.get("more_body", False),
+                    }
+                )
+                return
+            if message.get("more_body", False):
+                return
+            key, ttl, flight = state.pop(_STATE_KEY)
+            entry = Entry(start["status"], start["headers"], b"".join(body), ttl)
+            if ttl is not None:
+                self.cache.put(key, entry)
+            self.cache.finish(key, flight, entry)
+            await entry.send(scope, send)
+
+        try:
+            await self.app(scope, receive, cache_send)
+        except CacheHit as hit:
+            await hit.entry.send(scope, send)
+        finally:
+            if _STATE_KEY in state:
+                # endpoint failed, or the client disconnected
+                abandon()
+
+
+@functools.cache
+def get_cache() -> ResponseCache:
+    """Return the response cache of this worker."""
+    return ResponseCache(settings.restapi.response_cache_bytes, settings.restapi.response_cache_max_entry_bytes)
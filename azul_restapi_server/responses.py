@@ -0,0 +1,46 @@
+"""JSON response classes used as the server wide default.
+
+'orjson' renders with orjson, which is several times faster than the stdlib for large search results
+and serialises Pydantic models it finds in the content without first converting them to dicts.
+'stdlib' is FastAPI's own JSONResponse, for plugins that rely on its behaviour,
+i.e. rejecting NaN rather than writing null.
+"""
+
+from typing import Any
+
+from pydantic import BaseModel
+from starlette.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+RENDERERS = ("orjson", "stdlib")
+
+
+def _default(obj: Any) -> Any:
+    """Serialise values orjson doesn't support natively."""
+    if isinstance(obj, BaseModel):
+        return obj.model_dump(mode="json")
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON response rendered with orjson."""
+
+    def render(self, content: Any) -> bytes:
+        """Render content as compact json."""
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+def get_response_class(renderer: str) -> type[JSONResponse]:
+    """Return the JSON response class for a renderer."""
+    if renderer not in RENDERERS:
+        raise ValueError(f"unknown json renderer {renderer}, must be one of {RENDERERS}")
+    if renderer == "orjson":
+        if orjson is None:
+            print("orjson is not installed, rendering json with the stdlib.")
+            return JSONResponse
+        return FastJSONResponse
+    return JSONResponse
@@ -1,6 +1,6 @@
 """Load the configured security provider."""
 
-from .. import settings
+from .. import settings, stages, threadpool
 
 _provider_name = settings.restapi.security.lower()
 
@@ -13,4 +13,24 @@ elif _provider_name == "none":
 else:
     raise Exception("unknown security provider")
 
-validate_token = security_source.validate_token
+validate_token = stages.timed("auth", threadpool.in_auth_pool(security_source.validate_token))
+
+
+def warm():
+    """Fetch what the provider needs from other services, i.e. in the parent before workers are forked."""
+    if _provider_name in ("oidc", "oidc_legacy"):
+        from . import oidc_shared
+
+        oidc_shared.warm()
+
+
+def begin_startup():
+    """Start any slow setup of the provider in the background, i.e. while plugins load."""
+    if hasattr(security_source, "begin_startup"):
+        security_source.begin_startup()
+
+
+async def startup():
+    """Finish setup of the provider, during lifespan startup."""
+    if hasattr(security_source, "startup"):
+        await security_source.startup()
@@ -0,0 +1,68 @@
+"""Public signing keys published by the IdP, indexed by key id."""
+
+import threading
+from collections.abc import Mapping
+from typing import Any
+
+from jose import jwk, jwt
+from jose.backends.base import Key
+from jose.exceptions import JOSEError
+
+
+class KeySet:
+    """Signing keys from a single fetch of the IdP jwks document.
+
+    Key objects are constructed the first time a kid/algorithm pair is used and then reused until the next fetch,
+    so python-jose does not need to scan and rebuild keys for every token.
+    Key material that is not a JWK set (i.e. a shared secret) is passed through unchanged.
+    """
+
+    def __init__(self, raw: Any):
+        self.raw = raw
+        self.is_jwks = isinstance(raw, Mapping) and isinstance(raw.get("keys"), list)
+        self._jwks: dict[str | None, dict] = {}
+        if self.is_jwks:
+            for key in raw["keys"]:
+                if isinstance(key, Mapping) and key.get("use", "sig") == "sig":
+                    self._jwks[key.get("kid")] = key
+        self._keys: dict[tuple[str | None, str], Key] = {}
+        self._lock = threading.Lock()
+
+    def get(self, kid: str | None, algorithm: str) -> Key | None:
+        """Return the prepared key for the key id and algorithm, or None if it is unknown."""
+        try:
+            return self._keys[(kid, algorithm)]
+        except KeyError:
+            pass
+        data = self._jwks.get(kid)
+        if data is None and kid is None and len(self._jwks) == 1:
+            # token does not name a key, but there is only one it could be
+            data = next(iter(self._jwks.values()))
+        if data is None:
+            return None
+        try:
+            key = jwk.construct(data, algorithm)
+        except JOSEError:
+            # key type does not suit the algorithm
+            return None
+        with self._lock:
+            return self._keys.setdefault((kid, algorithm), key)
+
+    def find(self, token: str, algorithms: list[str] | str) -> Any | None:
+        """Return the key material to verify the token with, or None if the token names an unknown key."""
+        if not self.is_jwks:
+            return self.raw
+        try:
+            header = jwt.get_unverified_header(token)
+        except JOSEError:
+            # malformed token, let verification report the error
+            return self.raw
+        algorithm = header.get("alg")
+        if algorithm not in (algorithms if isinstance(algorithms, list) else [algorithms]):
+            # unsupported algorithm, let verification report the error
+            return self.raw
+        kid = header.get("kid")
+        if kid is None and len(self._jwks) != 1:
+            # token does not name a key, let verification try them all
+            return self.raw
+        return self.get(kid, algorithm)
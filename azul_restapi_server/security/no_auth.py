@@ -3,15 +3,19 @@
 This is insecure.
 """
 
+import functools
+
 from azul_bedrock.models_auth import Credentials, UserInfo
 from fastapi import Depends, Request
 
 from . import oidc_shared
+from .user_context import UserContext
 
 
-def validate_token(request: Request, token: str = Depends(lambda: None)) -> UserInfo:
-    """Ignore input and return static token."""
-    request.state.user_info = oidc_shared.claims_to_user(
+@functools.cache
+def _anonymous() -> UserContext:
+    """Return the static user, built once."""
+    user_info = oidc_shared.claims_to_user(
         {
             "exp": -1,
             "token_type": "Bearer",  # nosec B105
@@ -21,5 +25,12 @@ def validate_token(request: Request, token: str = Depends(lambda: None)) -> User
             "sub": "anony-moose",
         }
     )
-    request.state.user_info.credentials = Credentials(format="none", unique="anony-moose")
+    user_info.credentials = Credentials(format="none", unique="anony-moose")
+    return UserContext(user_info)
+
+
+def validate_token(request: Request, token: str = Depends(lambda: None)) -> UserInfo:
+    """Ignore input and return static token."""
+    request.state.user_context = _anonymous()
+    request.state.user_info = request.state.user_context.user_info()
     return request.state.user_info
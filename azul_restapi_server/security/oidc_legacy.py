@@ -1,33 +1,74 @@
 """OIDC flow authentication.
 
 This uses legacy method of swagger authentication.
+The token and authorization urls shown in swagger are discovered from the IdP during startup.
 """
 
+import asyncio
+import concurrent.futures
+import os
+import threading
+
 from azul_bedrock.models_auth import UserInfo
 from fastapi import Depends, Request
 from fastapi.security import OAuth2AuthorizationCodeBearer
 
 from azul_restapi_server import settings
+from azul_restapi_server import startup as app_startup
 
 from . import oidc_shared
 
-# triggers http request on import - bad - makes testing hard
-_discovered_config = oidc_shared.discover_auth_server(settings.oidc.discovery_url)
+# urls are filled in by startup(), they are only used to describe the flow to swagger
 _authorization_code_flow = OAuth2AuthorizationCodeBearer(
-    tokenUrl=_discovered_config["token_endpoint"],
-    authorizationUrl=_discovered_config["authorization_endpoint"],
-    refreshUrl=_discovered_config["token_endpoint"],
+    tokenUrl="",
+    authorizationUrl="",
+    refreshUrl="",
     scopes={k: "" for k in settings.oidc.scopes.split(" ")},
     auto_error=True,
 )
+# process that started discovery -> its result, so forked workers don't wait on their parent's discovery
+_discovery: dict[int, concurrent.futures.Future] = {}
+_discovery_lock = threading.Lock()
+
+
+def _discover(future: concurrent.futures.Future):
+    """Discover the auth server, completing the future."""
+    try:
+        # timed here, as whoever waits on the future only sees the part that overlapped with them
+        with app_startup.phase("oidc_discovery"):
+            config = oidc_shared.discover_auth_server(settings.oidc.discovery_url)
+        future.set_result(config)
+    except Exception as e:
+        future.set_exception(e)
+
+
+def begin_startup() -> concurrent.futures.Future:
+    """Start discovering the auth server in the background, i.e. while plugins load."""
+    with _discovery_lock:
+        future = _discovery.get(os.getpid())
+        if future is None:
+            future = _discovery[os.getpid()] = concurrent.futures.Future()
+            threading.Thread(target=_discover, args=(future,), name="oidc-discovery", daemon=True).start()
+        return future
+
+
+async def startup():
+    """Wait for discovery and describe the discovered flow to swagger."""
+    config = await asyncio.wrap_future(begin_startup())
+    flow = _authorization_code_flow.model.flows.authorizationCode
+    flow.tokenUrl = config["token_endpoint"]
+    flow.authorizationUrl = config["authorization_endpoint"]
+    flow.refreshUrl = config["token_endpoint"]
 
 
-def validate_token(request: Request, token: str = Depends(_authorization_code_flow)) -> UserInfo:
+async def validate_token(request: Request, token: str = Depends(_authorization_code_flow)) -> UserInfo:
     """Validate the input token.
 
     The dependency here only parses the token out of the http request.
     It describes to swagger how oauth2 is needed. We do the oidc parsing ourselves.
     It does not perform validation.
     """
-    request.state.user_info = oidc_shared.validate(token.split(" ")[-1], settings.oidc.client_id)
+    user = await oidc_shared.validate_context_async(token.split(" ")[-1], settings.oidc.client_id)
+    request.state.user_context = user
+    request.state.user_info = user.user_info()
     return request.state.user_info
@@ -14,12 +14,16 @@ _authorization_code_flow = OpenIdConnect(
 )
 
 
-def validate_token(request: Request, token: str = Depends(_authorization_code_flow)) -> UserInfo:
+async def validate_token(request: Request, token: str = Depends(_authorization_code_flow)) -> UserInfo:
     """Validate the input token.
 
     The dependency here only parses the token out of the http request.
     It describes to swagger how oidc is needed.
     It does not perform validation.
+
+    Validation is async so it never waits on a threadpool slot, and requests to the IdP don't block the event loop.
     """
-    request.state.user_info = oidc_shared.validate(token.split(" ")[-1], settings.oidc.client_id)
+    user = await oidc_shared.validate_context_async(token.split(" ")[-1], settings.oidc.client_id)
+    request.state.user_context = user
+    request.state.user_info = user.user_info()
     return request.state.user_info
@@ -1,8 +1,16 @@
 """Provides common functionality for handling OIDC auth."""
 
+import asyncio
+import hashlib
+import json
 import logging
+import os
+import stat
+import tempfile
+import time
+import weakref
 from threading import RLock
-from typing import Dict
+from typing import Any, Dict
 
 import cachetools
 import httpx
@@ -10,19 +18,86 @@ from azul_bedrock.models_auth import Credentials, UserInfo
 from fastapi import HTTPException
 from jose import exceptions as jwt_exceptions
 from jose import jwt
+from prometheus_client import Counter
 from starlette.status import HTTP_401_UNAUTHORIZED
 
 from azul_restapi_server import settings
 
+from .jwks import KeySet
+from .refresh_cache import RefreshCache
+from .user_context import UserContext
+
 logger = logging.getLogger(__name__)
-# retry getting auth
-client = httpx.Client(
-    mounts={
-        "https://": httpx.HTTPTransport(retries=3),
-        "http://": httpx.HTTPTransport(retries=3),
-    },
-    timeout=5.0,
-)
+
+
+def _new_client() -> httpx.Client:
+    """Return a client that retries getting auth."""
+    return httpx.Client(
+        mounts={
+            "https://": httpx.HTTPTransport(retries=3),
+            "http://": httpx.HTTPTransport(retries=3),
+        },
+        timeout=5.0,
+    )
+
+
+client = _new_client()
+
+
+def _after_fork():
+    """Give a forked worker its own connections, rather than sharing the parent's sockets."""
+    global client
+    client = _new_client()
+    _async_clients.clear()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+# async clients are bound to the event loop they were created in
+_async_clients: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient] = weakref.WeakKeyDictionary()
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """Return the pooled async client for the running event loop."""
+    loop = asyncio.get_running_loop()
+    async_client = _async_clients.get(loop)
+    if async_client is None:
+        async_client = _async_clients[loop] = httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(retries=3),
+            timeout=5.0,
+        )
+    return async_client
+
+
+async def aclose_async_client():
+    """Close the async client for the running event loop, if one was created."""
+    async_client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if async_client is not None:
+        await async_client.aclose()
+
+
+token_cache_hits = Counter("azulapi_oidc_token_cache_hits", "Tokens served from the verified token cache")
+token_cache_misses = Counter("azulapi_oidc_token_cache_misses", "Tokens that required full jwt verification")
+
+
+def _token_ttu(_key, value: tuple[UserContext, float], now: float) -> float:
+    """Expire a cached token at its 'exp' claim or after the cache ttl, whichever is sooner."""
+    return min(value[1], now + settings.oidc.token_cache_ttl)
+
+
+# verified tokens keyed by digest, timer must be wall clock to compare against 'exp'
+_token_cache = cachetools.TLRUCache(maxsize=settings.oidc.token_cache_size, ttu=_token_ttu, timer=time.time)
+_token_cache_lock = RLock()
+
+
+def _token_cache_key(token: str, audience: str) -> tuple[str, bytes]:
+    """Return key for the verified token cache that does not retain the raw token."""
+    return audience, hashlib.sha256(token.encode()).digest()
+
+
+def clear_token_cache():
+    """Forget all previously verified tokens."""
+    with _token_cache_lock:
+        _token_cache.clear()
 
 
 def claims_to_user(claims: dict) -> UserInfo:
@@ -53,39 +128,243 @@ def claims_to_user(claims: dict) -> UserInfo:
     )
 
 
-@cachetools.cached(
-    cache=cachetools.TTLCache(maxsize=1, ttl=settings.oidc.cache_ttl), key=lambda d: d["jwks_uri"], lock=RLock()
-)
-def _get_jwks(openid_config: Dict):
-    """Get the public keys used by IdP for signing."""
-    resp = client.get(openid_config["jwks_uri"])
+# caches are shared between the sync and async implementations
+# stale documents keep being served while they are refreshed in the background
+_jwks_cache = RefreshCache(ttl=settings.oidc.cache_ttl, grace=settings.oidc.cache_grace)
+_discovery_cache = RefreshCache(ttl=settings.oidc.cache_ttl, grace=settings.oidc.cache_grace)
+
+
+def _parse_jwks(resp: httpx.Response) -> KeySet:
+    """Return the public keys from a jwks response."""
     try:
-        keys = resp.json()
+        return KeySet(resp.json())
     except ValueError as e:
         raise Exception("unable to retrieve signing keys from IdP") from e
-    return keys
 
 
-@cachetools.cached(cache=cachetools.TTLCache(maxsize=1, ttl=settings.oidc.cache_ttl), lock=RLock())
-def discover_auth_server(discovery_url: str) -> Dict:
-    """Get auth details from well-known config."""
-    resp = client.get(discovery_url)
+def _parse_discovery(resp: httpx.Response) -> Dict:
+    """Return the auth server details from a well-known config response."""
     try:
-        json = resp.json()
+        return resp.json()
     except ValueError as e:
         raise Exception("unable to discover IdP auth server details") from e
-    return json
+
+
+def _shared_path(url: str) -> str:
+    """Return the file a document fetched from the IdP is shared through."""
+    return os.path.join(settings.oidc.shared_cache_dir, hashlib.sha256(url.encode()).hexdigest()[:32] + ".json")
+
+
+def _shared_dir(create: bool = False) -> str | None:
+    """Return the directory documents are shared through, or None if it is disabled or others could change it."""
+    path = settings.oidc.shared_cache_dir
+    if not path:
+        return None
+    try:
+        if create:
+            os.makedirs(path, mode=0o700, exist_ok=True)
+        info = os.lstat(path)
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        logger.warning(f"not using shared oidc cache {path}: {e!r}")
+        return None
+    # another user that owns or can write to the directory can delete or replace the documents in it
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        logger.warning(f"not using shared oidc cache {path} as it isn't a directory only this user can access")
+        return None
+    return path
+
+
+def _read_shared(url: str) -> Any | None:
+    """Return a document another worker fetched, if it is fresh and safe to trust."""
+    if _shared_dir() is None:
+        return None
+    path = _shared_path(url)
+    try:
+        with open(path, "rb") as f:
+            # documents name the keys tokens are verified with, so only trust a file nobody else could write
+            info = os.fstat(f.fileno())
+            if info.st_uid != os.getuid() or info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+                logger.warning(f"ignoring shared oidc cache {path} as others can write to it")
+                return None
+            saved = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"ignoring unreadable shared oidc cache {path}: {e!r}")
+        return None
+    if saved.get("url") != url or not 0 <= time.time() - saved.get("fetched", 0) < settings.oidc.cache_ttl:
+        return None
+    return saved.get("document")
+
+
+def _write_shared(url: str, document: Any):
+    """Save a document fetched from the IdP for other workers, and for restarts."""
+    directory = _shared_dir(create=True)
+    if directory is None:
+        return
+    path = _shared_path(url)
+    try:
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".fetching-")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"url": url, "fetched": time.time(), "document": document}, f)
+        # readers never see a partial file
+        os.replace(tmp, path)
+    except OSError as e:
+        logger.warning(f"failed to save shared oidc cache {path}: {e!r}")
+
+
+def _get_jwks(openid_config: Dict, refetch: bool = False) -> KeySet:
+    """Get the public keys used by IdP for signing.
+
+    Refetching picks up keys the IdP has rotated in, but happens at most once per jwks_refetch_interval.
+    """
+    uri = openid_config["jwks_uri"]
+
+    def fetch():
+        # refetching is for keys that are newer than any saved copy
+        raw = None if refetch else _read_shared(uri)
+        if raw is not None:
+            return KeySet(raw)
+        keys = _parse_jwks(client.get(uri))
+        _write_shared(uri, keys.raw)
+        return keys
+
+    interval = settings.oidc.jwks_refetch_interval if refetch else None
+    return _jwks_cache.get(uri, fetch, force_interval=interval)
+
+
+def discover_auth_server(discovery_url: str) -> Dict:
+    """Get auth details from well-known config."""
+
+    def fetch():
+        config = _read_shared(discovery_url)
+        if config is None:
+            config = _parse_discovery(client.get(discovery_url))
+            _write_shared(discovery_url, config)
+        return config
+
+    return _discovery_cache.get(discovery_url, fetch)
+
+
+async def _get_jwks_async(openid_config: Dict, refetch: bool = False) -> KeySet:
+    """Get the public keys used by IdP for signing, without blocking the event loop."""
+    uri = openid_config["jwks_uri"]
+
+    async def fetch():
+        raw = None if refetch else _read_shared(uri)
+        if raw is not None:
+            return KeySet(raw)
+        keys = _parse_jwks(await get_async_client().get(uri))
+        _write_shared(uri, keys.raw)
+        return keys
+
+    interval = settings.oidc.jwks_refetch_interval if refetch else None
+    return await _jwks_cache.get_async(uri, fetch, force_interval=interval)
+
+
+async def discover_auth_server_async(discovery_url: str) -> Dict:
+    """Get auth details from well-known config, without blocking the event loop."""
+
+    async def fetch():
+        config = _read_shared(discovery_url)
+        if config is None:
+            config = _parse_discovery(await get_async_client().get(discovery_url))
+            _write_shared(discovery_url, config)
+        return config
+
+    return await _discovery_cache.get_async(discovery_url, fetch)
+
+
+def warm():
+    """Fetch the discovery config and signing keys, i.e. in the parent before workers are forked."""
+    try:
+        _get_jwks(discover_auth_server(settings.oidc.discovery_url))
+    except Exception as e:
+        logger.warning(f"failed to warm oidc caches, workers will fetch for themselves: {e!r}")
+
+
+def _cached_user(token: str, audience: str) -> UserContext | None:
+    """Return the user for a previously verified token."""
+    with _token_cache_lock:
+        cached = _token_cache.get(_token_cache_key(token, audience))
+    if cached is None:
+        token_cache_misses.inc()
+        return None
+    token_cache_hits.inc()
+    return cached[0]
+
+
+def _cache_user(token: str, audience: str, user: UserContext):
+    """Remember a verified token until it expires."""
+    expiry = user.claims.get("exp")
+    # tokens without an expiry are never cached
+    if isinstance(expiry, (int, float)) and _token_cache.maxsize > 0:
+        with _token_cache_lock:
+            _token_cache[_token_cache_key(token, audience)] = (user, expiry)
 
 
 def validate(token: str, audience: str) -> UserInfo:
-    """Check that the supplied token is currently valid."""
-    oidc_config = discover_auth_server(settings.oidc.discovery_url)
-    keys = _get_jwks(oidc_config)
+    """Check that the supplied token is currently valid.
+
+    A new copy of the user info is returned each call, so callers are free to modify it.
+    """
+    return validate_context(token, audience).user_info()
+
+
+def validate_context(token: str, audience: str) -> UserContext:
+    """Check that the supplied token is currently valid, and return the user it belongs to.
+
+    Tokens that have already been verified are served from cache until they expire,
+    every request with the same token shares the same context.
+    """
+    user = _cached_user(token, audience)
+    if user is None:
+        oidc_config = discover_auth_server(settings.oidc.discovery_url)
+        algorithms = oidc_config["id_token_signing_alg_values_supported"]
+        key = _get_jwks(oidc_config).find(token, algorithms)
+        if key is None:
+            # token may be signed with a key the IdP rotated in since keys were last fetched
+            key = _get_jwks(oidc_config, refetch=True).find(token, algorithms)
+        user = UserContext(_verify(token, audience, oidc_config, key))
+        _cache_user(token, audience, user)
+    return user
+
+
+async def validate_async(token: str, audience: str) -> UserInfo:
+    """Check that the supplied token is currently valid, without blocking the event loop.
+
+    Behaves the same as `validate`, but any requests to the IdP are made with the async client.
+    """
+    return (await validate_context_async(token, audience)).user_info()
+
+
+async def validate_context_async(token: str, audience: str) -> UserContext:
+    """Check that the supplied token is currently valid, without blocking the event loop.
+
+    Behaves the same as `validate_context`, but any requests to the IdP are made with the async client.
+    """
+    user = _cached_user(token, audience)
+    if user is None:
+        oidc_config = await discover_auth_server_async(settings.oidc.discovery_url)
+        algorithms = oidc_config["id_token_signing_alg_values_supported"]
+        key = (await _get_jwks_async(oidc_config)).find(token, algorithms)
+        if key is None:
+            key = (await _get_jwks_async(oidc_config, refetch=True)).find(token, algorithms)
+        user = UserContext(_verify(token, audience, oidc_config, key))
+        _cache_user(token, audience, user)
+    return user
+
 
+def _verify(token: str, audience: str, oidc_config: Dict, key) -> UserInfo:
+    """Fully verify the signature and claims of the supplied token."""
     try:
+        if key is None:
+            raise jwt_exceptions.JWTError("JWT is signed with an unknown key.")
         claims = jwt.decode(
             token,
-            keys,
+            key,
             audience=audience,
             algorithms=oidc_config["id_token_signing_alg_values_supported"],
             issuer=oidc_config["issuer"],
@@ -0,0 +1,183 @@
+"""Cache for documents fetched from the IdP that are refreshed in the background.
+
+Once an entry is older than the ttl it is still served while a single refresh runs in the background.
+If refreshing fails, the last good value is served until the grace period runs out.
+Only one fetch per key is in flight at a time, across both sync and async callers.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import math
+import os
+import threading
+import time
+import weakref
+from typing import Any, Awaitable, Callable, Hashable
+
+logger = logging.getLogger(__name__)
+
+# minimum time between attempts to refresh an entry that is stale but still within the grace period
+REFRESH_RETRY_S = 5.0
+
+_MISSING = object()
+# every cache, to be reset in forked workers
+_caches: weakref.WeakSet["RefreshCache"] = weakref.WeakSet()
+
+
+def _in_event_loop() -> bool:
+    """Return True if called from a thread that is running an event loop."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+class RefreshCache:
+    """Serve stale values while a single background refresh runs."""
+
+    def __init__(self, ttl: float, grace: float, timer: Callable[[], float] = time.monotonic):
+        self.ttl = ttl
+        self.grace = grace
+        self.timer = timer
+        self._lock = threading.Lock()
+        # key -> (value, time fetched)
+        self._entries: dict[Hashable, tuple[Any, float]] = {}
+        self._inflight: dict[Hashable, concurrent.futures.Future] = {}
+        self._retry_at: dict[Hashable, float] = {}
+        self._forced_at: dict[Hashable, float] = {}
+        # keep references to background tasks so they are not garbage collected
+        self._tasks: set[asyncio.Task] = set()
+        _caches.add(self)
+
+    def _after_fork(self):
+        """Drop fetches that were in flight in the parent, their threads don't exist in a forked worker."""
+        self._lock = threading.Lock()
+        self._inflight.clear()
+        self._tasks.clear()
+
+    def clear(self):
+        """Forget all cached values."""
+        with self._lock:
+            self._entries.clear()
+            self._retry_at.clear()
+            self._forced_at.clear()
+
+    def _claim(self, key: Hashable, force_interval: float | None) -> tuple[Any, concurrent.futures.Future, bool, bool]:
+        """Return a usable cached value (or _MISSING), the in-flight fetch, whether the caller must fetch and wait.
+
+        A caller that must fetch owns the returned future and is responsible for completing it.
+        """
+        now = self.timer()
+        with self._lock:
+            entry = self._entries.get(key)
+            forced = force_interval is not None and now - self._forced_at.get(key, -math.inf) >= force_interval
+            if forced:
+                self._forced_at[key] = now
+            elif entry is not None and now - entry[1] < self.ttl:
+                return entry[0], None, False, False
+            usable = entry is not None and now - entry[1] < self.ttl + self.grace
+            future = self._inflight.get(key)
+            # usable values are not refreshed more often than REFRESH_RETRY_S after a failure
+            owner = future is None and (forced or not usable or now >= self._retry_at.get(key, 0))
+            if owner:
+                future = self._inflight[key] = concurrent.futures.Future()
+            wait = future is not None and (forced or not usable)
+            return (entry[0] if usable else _MISSING), future, owner, wait
+
+    def _complete(self, key: Hashable, future: concurrent.futures.Future, value: Any = None, error: Exception = None):
+        """Store the result of a fetch and wake anyone waiting on it."""
+        with self._lock:
+            del self._inflight[key]
+            if error is None:
+                self._entries[key] = (value, self.timer())
+                self._retry_at.pop(key, None)
+            else:
+                self._retry_at[key] = self.timer() + REFRESH_RETRY_S
+        if error is not None:
+            logger.warning(f"failed to refresh {key}: {error!r}")
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(value)
+
+    def _run(self, key: Hashable, future: concurrent.futures.Future, fetch: Callable[[], Any]):
+        """Fetch a new value with a blocking call."""
+        try:
+            value = fetch()
+        except Exception as e:
+            self._complete(key, future, error=e)
+        else:
+            self._complete(key, future, value)
+
+    async def _run_async(self, key: Hashable, future: concurrent.futures.Future, fetch: Callable[[], Awaitable]):
+        """Fetch a new value without blocking the event loop."""
+        try:
+            value = await fetch()
+        except Exception as e:
+            self._complete(key, future, error=e)
+        except BaseException:
+            # event loop is shutting down, let other waiters fetch for themselves
+            self._complete(key, future, error=Exception("refresh was cancelled"))
+            raise
+        else:
+            self._complete(key, future, value)
+
+    def get(self, key: Hashable, fetch: Callable[[], Any], force_interval: float | None = None) -> Any:
+        """Return the cached value for key, calling fetch if there is no usable value.
+
+        If force_interval is set, the value is refetched and the caller waits for the result,
+        unless another caller forced a refetch within the last force_interval seconds.
+        Should a forced refetch fail, the older value is returned instead.
+        """
+        value, future, owner, wait = self._claim(key, force_interval)
+        if owner:
+            if wait:
+                self._run(key, future, fetch)
+            else:
+                threading.Thread(target=self._run, args=(key, future, fetch), daemon=True).start()
+        if not wait:
+            return value
+        if not owner and _in_event_loop():
+            # the in-flight fetch may need this event loop to complete, so waiting on it could deadlock
+            return value if value is not _MISSING else fetch()
+        try:
+            return future.result()
+        except Exception:
+            if value is _MISSING:
+                raise
+            return value
+
+    async def get_async(
+        self, key: Hashable, fetch: Callable[[], Awaitable], force_interval: float | None = None
+    ) -> Any:
+        """Return the cached value for key, awaiting fetch if there is no usable value.
+
+        Handles force_interval the same as `get`.
+        """
+        value, future, owner, wait = self._claim(key, force_interval)
+        if owner:
+            task = asyncio.get_running_loop().create_task(self._run_async(key, future, fetch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        if not wait:
+            return value
+        try:
+            # shield so a cancelled request doesn't cancel the fetch other requests are waiting on
+            return await asyncio.shield(asyncio.wrap_future(future))
+        except Exception:
+            if value is _MISSING:
+                raise
+            return value
+
+
+def _after_fork():
+    """Reset every cache in a forked worker, keeping the values fetched by the parent."""
+    for cache in list(_caches):
+        cache._after_fork()
+
+
+os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,104 @@
+"""Verified users, shared between all requests made with the same token.
+
+A UserContext can't be modified, so the verified token cache hands the same one to every request rather than
+deep copying it. Each request still gets its own UserInfo for plugins to use, built without validating it again.
+Its decoded claims are shared with the context and read only, so building it doesn't copy them either.
+The public view, without credentials, is serialised once per context.
+"""
+
+from typing import Any, NoReturn
+
+from azul_bedrock.models_auth import Credentials, UserInfo
+from starlette.requests import Request
+
+
+def _read_only(self, *args, **kwargs) -> NoReturn:
+    """Refuse changes, as the claims are shared between requests."""
+    raise TypeError("claims of a verified user can't be modified, copy them first")
+
+
+class FrozenDict(dict):
+    """A dict of decoded claims that can't be modified. Copies of it are plain dicts that can be."""
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce_ex__(self, protocol):
+        """Copy and pickle as a plain dict."""
+        return dict, (dict(self),)
+
+
+class FrozenList(list):
+    """A list of decoded claims that can't be modified. Copies of it are plain lists that can be."""
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = clear = sort = reverse = _read_only
+
+    def __reduce_ex__(self, protocol):
+        """Copy and pickle as a plain list."""
+        return list, (list(self),)
+
+
+def _freeze(value: Any) -> Any:
+    """Return a read only copy of decoded json."""
+    if isinstance(value, dict):
+        return FrozenDict((k, _freeze(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return FrozenList(_freeze(v) for v in value)
+    return value
+
+
+class UserContext:
+    """A verified user that can't be modified, see the module docstring."""
+
+    __slots__ = ("username", "org", "email", "roles", "unique_id", "claims", "_credentials", "_public_json")
+
+    def __init__(self, user_info: UserInfo):
+        set_ = super().__setattr__
+        set_("username", user_info.username)
+        set_("org", user_info.org)
+        set_("email", user_info.email)
+        set_("roles", tuple(user_info.roles))
+        set_("unique_id", user_info.unique_id)
+        set_("claims", _freeze(user_info.decoded) if user_info.decoded is not None else None)
+        set_("_credentials", user_info.credentials.model_dump() if user_info.credentials is not None else None)
+        set_("_public_json", None)
+
+    def __setattr__(self, name: str, value: Any):
+        """Refuse changes, as the context is shared between requests."""
+        raise AttributeError(f"{type(self).__name__} can't be modified")
+
+    def _fields(self) -> dict:
+        """Return the fields of a new UserInfo, except credentials."""
+        return dict(
+            username=self.username,
+            org=self.org,
+            email=self.email,
+            roles=list(self.roles),
+            unique_id=self.unique_id,
+            decoded=self.claims,
+        )
+
+    def user_info(self) -> UserInfo:
+        """Return a new UserInfo, which the caller is free to modify except for the shared decoded claims."""
+        credentials = None
+        if self._credentials is not None:
+            credentials = Credentials.model_construct(**self._credentials)
+        # fields were validated when the token was verified
+        return UserInfo.model_construct(credentials=credentials, **self._fields())
+
+    def public_json(self) -> bytes:
+        """Return the user as json without credentials, i.e. to show the user who they are logged in as."""
+        if self._public_json is None:
+            # concurrent requests may both serialise it, but get the same result
+            public = UserInfo.model_construct(credentials=None, **self._fields())
+            super().__setattr__("_public_json", public.model_dump_json().encode())
+        return self._public_json
+
+
+def from_request(request: Request) -> UserContext:
+    """Return the context of the user making a request, for providers that only set request.state.user_info."""
+    context = getattr(request.state, "user_context", None)
+    if context is None:
+        context = UserContext(request.state.user_info)
+    return context
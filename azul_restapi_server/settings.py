@@ -23,6 +23,16 @@ class OIDC(BaseSettings):
     roles_key: str = "roles"
     username_key: str = "preferred_username"
     cache_ttl: int = 600
+    # discovery config and signing keys are saved here for other workers and restarts to reuse
+    # until cache_ttl passes, '' to disable. Only used if the directory is owned by and private to the server's user
+    shared_cache_dir: str = ""
+    # keep serving the last good discovery and signing keys for this long if the IdP can't be reached
+    cache_grace: int = 3600
+    # minimum seconds between refetching signing keys when a token names an unknown key id
+    jwks_refetch_interval: int = 30
+    # cache of already verified tokens, entries never outlive the 'exp' claim of the token
+    token_cache_size: int = 4096
+    token_cache_ttl: int = 300
     swagger_redirect_url: str = "/api/oauth2-redirect"
     model_config = SettingsConfigDict(env_prefix="oidc_")
 
@@ -43,12 +53,90 @@ class Restapi(BaseSettings):
     host: str = "localhost"
     port: int = 8080
     workers: int = 1
+    # threads for the asyncio default executor
     asyncio_workers: int = 4
+    # threads for sync plugin endpoints and dependencies
+    handler_threads: int = 40
+    # threads for sync token validation, kept apart so busy endpoints can't hold up auth
+    auth_threads: int = 4
     reload: bool = False
     prefix: str = "/api"
     root_path: str = "/"
     security: str = "none"
     headers: dict[str, str] = dict()
+    # import plugins from this many threads
+    plugin_load_workers: int = 1
+    # import plugins in the master process and fork workers from it, so they share those pages
+    preload: bool = False
+    # seconds 'azul-restapi-server profile-startup' allows for importing the app, 0 to not check
+    startup_budget: float = 0
+    # renders json responses, 'orjson' or 'stdlib' for plugins that depend on the quirks of json.dumps
+    json_renderer: str = "orjson"
+    # build the openapi document during startup, rather than on first request
+    openapi_prebuild: bool = False
+    # serve the openapi document from this file, written by 'azul-restapi-server openapi', rather than building it
+    openapi_file: str = ""
+    # compress responses for clients that accept gzip, zstd or brotli
+    compression: bool = False
+    # responses with a smaller body are sent uncompressed
+    compression_min_size: int = 1024
+    # compression level for each encoding
+    compression_levels: dict[str, int] = {"gzip": 6, "zstd": 3, "br": 4}
+    # responses for paths starting with these are sent uncompressed
+    compression_exclude_paths: list[str] = ["/metrics"]
+    # responses with a content type starting with these are already compressed
+    compression_exclude_types: list[str] = [
+        "image/",
+        "video/",
+        "audio/",
+        "application/octet-stream",
+        "application/zip",
+        "application/gzip",
+        "application/zstd",
+    ]
+    # report request stage timings to browsers in a Server-Timing response header
+    server_timing: bool = False
+    # requests per second each user may make to each plugin route, 0 for no limit
+    rate_limit: float = 0
+    # requests a user may make in quick succession before the rate applies
+    rate_limit_burst: int = 20
+    # requests per second each user may make to particular routes, overriding rate_limit
+    # keyed by route template, as labelled in the azulapi_request_stage_seconds metric
+    rate_limit_routes: dict[str, float] = {}
+    # users with any of these roles are never limited, i.e. service accounts
+    rate_limit_exempt_roles: list[str] = []
+    # 'module:attribute' of a backend that shares rate limits between workers, '' to limit each worker separately
+    rate_limit_backend: str = ""
+    # plugin requests each user may have in progress at once in each worker, 0 for no limit
+    concurrency_limit: int = 0
+    # memory each worker may use for responses of plugin routes that opt in to caching, in bytes, 0 to not cache
+    response_cache_bytes: int = 64 * 1024 * 1024
+    # responses with a larger body are never cached
+    response_cache_max_entry_bytes: int = 1024 * 1024
+    # refuse new requests with a 503 while this many are in progress in a worker, 0 for no limit
+    shed_max_in_flight: int = 0
+    # refuse new requests with a 503 while the event loop of a worker runs this many seconds late, 0 for no limit
+    shed_max_loop_lag: float = 0
+    # requests for paths starting with these are never refused, i.e. metrics and health checks
+    shed_exempt_paths: list[str] = ["/metrics"]
+    # requests for these paths are only refused at twice the limits, paths ending in '/' match any path they start
+    # defaults are the docs, static assets and user details under the default prefix
+    shed_priority_paths: list[str] = [
+        "/",
+        "/docs",
+        "/api",
+        "/api/redoc",
+        "/api/openapi.json",
+        "/api/oauth2-redirect",
+        "/api/static/",
+        "/api/v0/users/me",
+    ]
+    # profile memory allocation and cpu time of one in this many requests, 0 to disable sampling
+    profile_interval: int = 0
+    # requests with an X-Azul-Profile header matching this are always profiled, '' to disable
+    profile_token: str = ""
+    # frames kept for each traced allocation, more find leaks in shared code but use more memory
+    profile_frames: int = 1
     model_config = SettingsConfigDict(env_prefix="restapi_")
 
 
@@ -66,15 +154,25 @@ class Logging(BaseSettings):
     log_backtrace: bool = False
     # get temp dir
     audit_file: str = os.path.join(os.getcwd(), "logs", "restapi-audit.log")
+    # audit_format can also use body_bytes and wire_bytes, the response size before and after compression
     audit_format: str = (
         "full_time={time:%d/%b/%Y:%H:%M:%S.%f} client_ip={client_ip} client_port={client_port} "
         "connection={connection} username={username} method={method} "
         'path={path} generic_path={generic_path} status={status_code} user_agent="{user_agent}" '
         'referer={referer} duration_ms={duration_ms} security="{security}"'
     )
+    # 'text' uses audit_format, 'json' writes a json object per line, 'msgpack' writes length prefixed msgpack
+    audit_output: str = "text"
     audit_retention: str = "1 months"
     audit_rotation: str = "daily"
     audit_path_filter: list[str] = ["/metrics"]
+    # audit records are buffered and written in batches from a background thread
+    audit_buffer_size: int = 10000
+    audit_batch_size: int = 500
+    audit_flush_interval: float = 0.5
+    # what to do with new records while the buffer is full: 'block', 'drop' or 'spill' (to audit_spill_file)
+    audit_full_policy: str = "block"
+    audit_spill_file: str = ""
     model_config = SettingsConfigDict(env_prefix="logger_")
 
 
@@ -0,0 +1,56 @@
+"""Track how long each stage of a request takes.
+
+Timings are collected per request in a context variable, which is set by StageTimingMiddleware.
+Outside of a request nothing is recorded.
+
+Stages:
+
+- auth: validating the token of the user
+- queue: waiting for a thread to run sync endpoints and dependencies, measured by the threadpool module
+- handler: everything else until the response starts, i.e. other dependencies, the endpoint and serialisation
+- send: sending the response body
+"""
+
+import contextvars
+import functools
+import inspect
+import time
+from typing import Callable
+
+# stage -> seconds spent, for the current request
+timings: contextvars.ContextVar[dict[str, float] | None] = contextvars.ContextVar("stage_timings", default=None)
+
+
+def record(stage: str, seconds: float):
+    """Add time spent in a stage to the current request."""
+    current = timings.get()
+    if current is not None:
+        current[stage] = current.get(stage, 0.0) + seconds
+
+
+def timed(stage: str, func: Callable) -> Callable:
+    """Wrap a sync or async function, i.e. a dependency, so that time spent in it is recorded against a stage.
+
+    The signature is preserved so FastAPI resolves parameters of the wrapped function.
+    """
+    if inspect.iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                record(stage, time.perf_counter() - start)
+
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record(stage, time.perf_counter() - start)
+
+    return wrapper
@@ -0,0 +1,110 @@
+"""Record how long each phase of server startup takes, for the startup diagnostic endpoint.
+
+Also profiles a full import of the app in a fresh interpreter, for `azul-restapi-server profile-startup`.
+"""
+
+import asyncio
+import contextlib
+import json
+import os
+import subprocess  # nosec B404
+import sys
+import time
+
+from azul_restapi_server import plugins, settings
+
+# phase -> seconds taken
+phases: dict[str, float] = {}
+
+
+@contextlib.contextmanager
+def phase(name: str):
+    """Time a phase of startup."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases[name] = time.perf_counter() - start
+
+
+def report() -> dict:
+    """Return the startup timing breakdown of this worker."""
+    return {
+        "pid": os.getpid(),
+        "preloaded": plugins.preloaded,
+        "phases": dict(phases),
+        "plugins": dict(plugins.load_times),
+    }
+
+
+# marks the line of the profiled interpreter's output that holds its measurements
+_RESULT_PREFIX = "startup-profile: "
+# run by the profiled interpreter, so that the app is imported from scratch
+_PROFILED = (
+    "import time\n"
+    "start = time.perf_counter()\n"
+    "from azul_restapi_server import main, startup\n"
+    "startup.measure_app(main, time.perf_counter() - start)\n"
+)
+
+
+def measure_app(main, import_seconds: float):
+    """Print the startup measurements of the imported app module, as the profiled interpreter."""
+    from azul_restapi_server import security
+    from azul_restapi_server.security import oidc_shared
+
+    result = {"import_app": import_seconds, **report(), "oidc_discovery": None}
+    if settings.restapi.security.lower() in ("oidc", "oidc_legacy"):
+        start = time.perf_counter()
+        try:
+            # as in lifespan, the openapi document describes the auth flow discovered during startup
+            asyncio.run(security.startup())
+            # already cached if discovery began in the background on import
+            oidc_shared.discover_auth_server(settings.oidc.discovery_url)
+        except Exception as e:
+            result["oidc_error"] = repr(e)
+        # background discovery times itself, as it was partly done while the app was imported
+        result["oidc_discovery"] = phases.get("oidc_discovery", time.perf_counter() - start)
+    start = time.perf_counter()
+    main.openapi_document.render()
+    result["openapi"] = time.perf_counter() - start
+    print(_RESULT_PREFIX + json.dumps(result), flush=True)
+
+
+def parse_importtime(output: str) -> list[dict]:
+    """Return the modules listed in the output of `python -X importtime`."""
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line.removeprefix("import time:").split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            # header line
+            continue
+        modules.append(
+            {
+                "module": fields[2].strip(),
+                "self": int(fields[0]) / 1e6,
+                "cumulative": int(fields[1]) / 1e6,
+            }
+        )
+    return modules
+
+
+def profile(top: int = 20) -> dict:
+    """Import the app in a new interpreter, and return where the time went."""
+    proc = subprocess.run(  # nosec B603
+        [sys.executable, "-X", "importtime", "-c", _PROFILED], capture_output=True, text=True, check=False
+    )
+    result = None
+    for line in proc.stdout.splitlines():
+        if line.startswith(_RESULT_PREFIX):
+            result = json.loads(line.removeprefix(_RESULT_PREFIX))
+    if proc.returncode != 0 or result is None:
+        errors = [line for line in proc.stderr.splitlines() if not line.startswith("import time:")]
+        raise RuntimeError(f"failed to import the app: {' '.join(errors[-10:])}")
+    modules = parse_importtime(proc.stderr)
+    result["slowest_modules"] = sorted(modules, key=lambda m: m["self"], reverse=True)[:top]
+    result["slowest_plugins"] = sorted(result["plugins"].items(), key=lambda p: p[1], reverse=True)[:top]
+    result["total"] = result["import_app"] + result["openapi"] + (result["oidc_discovery"] or 0)
+    return result
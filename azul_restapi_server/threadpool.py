@@ -0,0 +1,125 @@
+"""Limit and measure the worker threads used to run sync code.
+
+Sync plugin endpoints and dependencies run on AnyIO's default limiter (the handler pool).
+Sync token validation runs on a separate, smaller auth pool, so busy endpoints can't hold up authentication.
+The asyncio default executor, used by `loop.run_in_executor(None, ...)`, is sized separately again.
+"""
+
+import asyncio
+import functools
+import inspect
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+import anyio
+import anyio.to_thread
+from prometheus_client import Gauge, Histogram
+
+from azul_restapi_server import settings, stages
+
+AUTH = "auth"
+HANDLER = "handler"
+
+queue_wait = Histogram(
+    "azulapi_threadpool_queue_wait_seconds",
+    "Time sync code waited for a worker thread",
+    ["pool"],
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, float("inf")),
+)
+# updated as calls start and finish, rather than read from the limiters, so they work with several workers
+threads_busy = Gauge(
+    "azulapi_threadpool_busy", "Worker threads currently running sync code", ["pool"], multiprocess_mode="livesum"
+)
+threads_total = Gauge(
+    "azulapi_threadpool_size", "Worker threads available to run sync code", ["pool"], multiprocess_mode="livesum"
+)
+tasks_waiting = Gauge(
+    "azulapi_threadpool_waiting", "Sync calls waiting for a worker thread", ["pool"], multiprocess_mode="livesum"
+)
+
+# pool name -> limiter, set up at startup
+_limiters: dict[str, anyio.CapacityLimiter] = {}
+_run_sync = anyio.to_thread.run_sync
+
+
+def _pool_name(limiter: anyio.CapacityLimiter | None) -> str:
+    """Return the name of the pool a limiter belongs to."""
+    if limiter is None:
+        return HANDLER
+    for name, pool_limiter in _limiters.items():
+        if pool_limiter is limiter:
+            return name
+    return "other"
+
+
+async def _measured_run_sync(func, *args, limiter: anyio.CapacityLimiter | None = None, **kwargs):
+    """Run a sync function in a worker thread, recording how long it waited for a thread."""
+    pool = _pool_name(limiter)
+    waiting = tasks_waiting.labels(pool)
+    busy = threads_busy.labels(pool)
+    started = False
+    submitted = time.perf_counter()
+
+    def run(*func_args):
+        nonlocal started
+        started = True
+        waiting.dec()
+        waited = time.perf_counter() - submitted
+        queue_wait.labels(pool).observe(waited)
+        if pool != AUTH:
+            # context is copied into the worker thread, so this records against the current request
+            # waiting on the auth pool is already part of the auth stage
+            stages.record("queue", waited)
+        busy.inc()
+        try:
+            return func(*func_args)
+        finally:
+            busy.dec()
+
+    waiting.inc()
+    try:
+        return await _run_sync(run, *args, limiter=limiter, **kwargs)
+    finally:
+        if not started:
+            # cancelled while waiting for a thread
+            waiting.dec()
+
+
+def install():
+    """Measure queue wait for everything Starlette and FastAPI run in a worker thread."""
+    anyio.to_thread.run_sync = _measured_run_sync
+
+
+def uninstall():
+    """Stop measuring, restoring AnyIO's own run_sync."""
+    anyio.to_thread.run_sync = _run_sync
+
+
+def configure():
+    """Apply the configured thread limits to the running event loop.
+
+    Must be called from the event loop that serves requests, i.e. during lifespan startup.
+    """
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=settings.restapi.asyncio_workers))
+    handler = anyio.to_thread.current_default_thread_limiter()
+    handler.total_tokens = settings.restapi.handler_threads
+    _limiters[HANDLER] = handler
+    _limiters[AUTH] = anyio.CapacityLimiter(settings.restapi.auth_threads)
+    for pool, limiter in _limiters.items():
+        threads_total.labels(pool).set(limiter.total_tokens)
+
+
+def in_auth_pool(func: Callable) -> Callable:
+    """Wrap a sync dependency so it runs on the auth pool, async functions are returned unchanged.
+
+    The signature is preserved so FastAPI resolves parameters of the wrapped function.
+    """
+    if inspect.iscoroutinefunction(func):
+        return func
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await anyio.to_thread.run_sync(functools.partial(func, *args, **kwargs), limiter=_limiters.get(AUTH))
+
+    return wrapper
@@ -0,0 +1,82 @@
+"""Stand-in identity provider serving discovery and signing keys for real RS256 tokens."""
+
+import datetime
+import http.server
+import json
+import threading
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwk, jwt
+
+KID = "bench"
+
+
+class StandInIdP:
+    """Serve the well-known config and JWKS of a freshly generated RSA key from a background thread."""
+
+    def __init__(self):
+        self.private_pem = (
+            rsa.generate_private_key(public_exponent=65537, key_size=2048)
+            .private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+            .decode()
+        )
+        public = jwk.construct(self.private_pem, "RS256").public_key().to_dict()
+        self.jwks = {"keys": [{**public, "kid": KID, "use": "sig"}]}
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        self.requests = 0
+
+    def _handler(self) -> type[http.server.BaseHTTPRequestHandler]:
+        """Return a request handler bound to this IdP."""
+        idp = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):  # noqa: N802
+                idp.requests += 1
+                documents = {"/.well-known/openid-configuration": idp.discovery(), "/keys": idp.jwks}
+                document = documents.get(self.path)
+                body = json.dumps(document).encode()
+                self.send_response(200 if document else 404)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def discovery(self) -> dict:
+        """Return the well-known config."""
+        return {
+            "issuer": self.url,
+            "jwks_uri": f"{self.url}/keys",
+            "token_endpoint": f"{self.url}/token",
+            "authorization_endpoint": f"{self.url}/auth",
+            "id_token_signing_alg_values_supported": ["RS256"],
+        }
+
+    def mint_token(self, user: str, audience: str = "web") -> str:
+        """Return a signed token for a user, valid for an hour."""
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        claims = {
+            "sub": user,
+            "iss": self.url,
+            "aud": audience,
+            "iat": now,
+            "exp": now + datetime.timedelta(hours=1),
+            "preferred_username": user,
+            "roles": ["validated"],
+        }
+        return jwt.encode(claims, self.private_pem, algorithm="RS256", headers={"kid": KID})
+
+    def start(self):
+        """Start serving in a daemon thread."""
+        threading.Thread(target=self.server.serve_forever, name="stand-in-idp", daemon=True).start()
+
+    def stop(self):
+        """Stop serving."""
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,77 @@
+"""Microbenchmark of redirecting stdlib log records to loguru, before and after InterceptHandler was made cheaper.
+
+Records are sent to a stub in place of loguru, so only the cost of the handler itself is measured.
+
+    python -m benchmarks.intercept
+"""
+
+import logging
+import time
+from unittest import mock
+
+import click
+from loguru import logger as loguru_logger
+
+from azul_restapi_server import logging as app_logging
+
+
+class StubLogger:
+    """Accept what the handler sends to loguru, without the cost of any sinks."""
+
+    level = staticmethod(loguru_logger.level)
+
+    def opt(self, depth, exception):
+        """Ignore the options."""
+        return self
+
+    def log(self, level, message):
+        """Drop the message."""
+
+
+class OriginalInterceptHandler(logging.Handler):
+    """Handler as it was before caching levels, dropping records early and skipping the frame walk."""
+
+    def emit(self, record):
+        """Send the record to loguru."""
+        if record.name == "uvicorn.access":
+            return
+        try:
+            level = app_logging.logger.level(record.levelname).name
+        except ValueError:
+            level = record.levelno
+        frame, depth = logging.currentframe(), 0
+        while frame and (depth == 0 or frame.f_code.co_filename == logging.__file__):
+            frame = frame.f_back
+            depth += 1
+        app_logging.logger.opt(depth=depth, exception=record.exc_info).log(level, record.getMessage())
+
+
+def measure(iterations: int) -> dict[str, float]:
+    """Return the microseconds each handler takes per record."""
+    with mock.patch.object(app_logging, "logger", new=StubLogger()):
+        cases = {
+            "original": OriginalInterceptHandler(),
+            "caller in format": app_logging.InterceptHandler(level="debug", log_format="{name} {message}"),
+            "caller not in format": app_logging.InterceptHandler(level="debug", log_format="{message}"),
+            "below level": app_logging.InterceptHandler(level="info", log_format="{name} {message}"),
+        }
+        record = logging.LogRecord("opensearch", logging.DEBUG, __file__, 1, "request %s finished", (1,), None)
+        results = {}
+        for name, handler in cases.items():
+            start = time.perf_counter_ns()
+            for _ in range(iterations):
+                handler.handle(record)
+            results[name] = (time.perf_counter_ns() - start) / iterations / 1000
+    return results
+
+
+@click.command()
+@click.option("--iterations", default=100000, show_default=True, help="records sent to each handler")
+def run(iterations):
+    """Report the cost per record of each way of redirecting a record to loguru."""
+    for name, us in measure(iterations).items():
+        click.echo(f"{name:<22} {us:8.2f}us per record")
+
+
+if __name__ == "__main__":
+    run()
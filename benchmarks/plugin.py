@@ -0,0 +1,27 @@
+"""Synthetic plugin with a route returning a typical search result page."""
+
+from fastapi import APIRouter
+from pydantic import BaseModel
+
+router = APIRouter()
+
+
+class Entity(BaseModel):
+    """A search result."""
+
+    sha256: str
+    file_format: str
+    size: int
+    tags: list[str]
+
+
+_PAGE = [
+    Entity(sha256=f"{i:064x}", file_format="executable/windows/pe32", size=1000 + i, tags=["bench", f"tag{i % 7}"])
+    for i in range(100)
+]
+
+
+@router.get("/v0/bench/entities", response_model=list[Entity])
+async def find_entities() -> list[Entity]:
+    """Return a page of search results."""
+    return _PAGE
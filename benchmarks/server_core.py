@@ -0,0 +1,246 @@
+"""Load benchmark of the server core, i.e. auth, middleware and serialisation, without any real plugins.
+
+Each scenario runs in a new interpreter, as settings are read once at import.
+A stand-in IdP serves discovery and signing keys, so oidc and oidc_legacy verify real RS256 tokens.
+Requests are sent straight to the ASGI app from concurrent tasks, leaving out the network and http parsing
+so results only vary with the code under test.
+
+Run all scenarios and save the results:
+
+    python -m benchmarks.server_core --output before.json
+
+Then compare another commit against them:
+
+    python -m benchmarks.server_core --output after.json --compare before.json
+"""
+
+import asyncio
+import contextlib
+import importlib.metadata
+import json
+import os
+import platform
+import subprocess  # nosec B404
+import sys
+import tempfile
+import time
+
+import click
+
+SECURITY = ("none", "oidc", "oidc_legacy")
+# middleware that can be left out of a scenario on its own, by class name, the others are in every variant but 'none'
+MIDDLEWARE = ("PrometheusMiddleware", "CORSMiddleware", "AuditMiddleware", "StageTimingMiddleware")
+# 'all', 'none' or all but one middleware
+VARIANTS = ("all", "none", *(f"-{name}" for name in MIDDLEWARE))
+PATHS = ("/v0/users/me", "/v0/bench/entities")
+_RESULT_PREFIX = "benchmark-result: "
+
+
+def _add_bench_plugin():
+    """Make the synthetic plugin discoverable as if it were installed."""
+    entry_points = importlib.metadata.entry_points
+    plugin = importlib.metadata.EntryPoint("bench", "benchmarks.plugin:router", "azul_restapi.plugin")
+
+    def with_bench_plugin(**params):
+        return importlib.metadata.EntryPoints([*entry_points(), plugin]).select(**params)
+
+    importlib.metadata.entry_points = with_bench_plugin
+
+
+def _keep_middleware(variant: str, names: list[str]) -> list[str]:
+    """Return the names of the app's middleware used by a variant, only what the variant names is left out."""
+    if variant == "none":
+        return []
+    return [name for name in names if name != variant.removeprefix("-")]
+
+
+def percentile(latencies: list[float], fraction: float) -> float:
+    """Return a percentile of sorted latencies, by the nearest rank."""
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+
+async def _drive(app, path: str, tokens: list[str], requests: int, concurrency: int) -> dict:
+    """Send requests to an ASGI app from concurrent tasks and return the throughput and latency."""
+    latencies = []
+    errors = 0
+    remaining = requests
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def client(index: int):
+        nonlocal errors, remaining
+        while remaining > 0:
+            remaining -= 1
+            headers = [(b"host", b"bench"), (b"user-agent", b"benchmark")]
+            if tokens:
+                headers.append((b"authorization", b"Bearer " + tokens[(index + remaining) % len(tokens)].encode()))
+            scope = {
+                "type": "http",
+                "asgi": {"version": "3.0"},
+                "http_version": "1.1",
+                "method": "GET",
+                "scheme": "http",
+                "path": path,
+                "raw_path": path.encode(),
+                "root_path": "",
+                "query_string": b"",
+                "headers": headers,
+                "client": ("127.0.0.1", 50000 + index),
+                "server": ("bench", 80),
+            }
+            status = 0
+
+            async def send(message):
+                nonlocal status
+                if message["type"] == "http.response.start":
+                    status = message["status"]
+
+            start = time.perf_counter_ns()
+            await app(scope, receive, send)
+            latencies.append((time.perf_counter_ns() - start) / 1e6)
+            if status != 200:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(i) for i in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "rps": round(requests / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50), 3),
+        "p99_ms": round(percentile(latencies, 0.99), 3),
+        "errors": errors,
+    }
+
+
+def run_scenario(security: str, variant: str, requests: int, concurrency: int, users: int) -> list[dict]:
+    """Run one scenario in this interpreter, which must not have imported the app yet."""
+    from benchmarks.idp import StandInIdP
+
+    idp = StandInIdP()
+    idp.start()
+    audit_dir = tempfile.mkdtemp(prefix="azul-bench-")
+    os.environ.update(
+        RESTAPI_SECURITY=security,
+        OIDC_AUTHORITY_URL=idp.url,
+        OIDC_CLIENT_ID="web",
+        # every scenario starts with a cold cache
+        OIDC_SHARED_CACHE_DIR="",
+        LOGGER_AUDIT_FILE=os.path.join(audit_dir, "audit.log"),
+    )
+    _add_bench_plugin()
+    with contextlib.redirect_stdout(sys.stderr):
+        from azul_restapi_server import main
+
+    keep = _keep_middleware(variant, [m.cls.__name__ for m in main.app.user_middleware])
+    main.app.user_middleware = [m for m in main.app.user_middleware if m.cls.__name__ in keep]
+    main.app.middleware_stack = None
+    # several users, so the token cache holds more than one entry
+    tokens = [idp.mint_token(f"bench{i}") for i in range(users)] if security != "none" else []
+
+    async def run() -> list[dict]:
+        results = []
+        async with main.lifespan(main.app):
+            for path in PATHS:
+                full_path = f"/{main.api_prefix}{path}"
+                # warm up caches and lazily built routes
+                await _drive(main.app, full_path, tokens, min(requests, 200), concurrency)
+                result = await _drive(main.app, full_path, tokens, requests, concurrency)
+                results.append({"security": security, "middleware": variant, "path": path, **result})
+        return results
+
+    with contextlib.redirect_stdout(sys.stderr):
+        results = asyncio.run(run())
+    idp.stop()
+    return results
+
+
+def _spawn(security: str, variant: str, requests: int, concurrency: int, users: int) -> list[dict]:
+    """Run one scenario in a new interpreter and return its results."""
+    proc = subprocess.run(  # nosec B603
+        [
+            sys.executable,
+            "-m",
+            "benchmarks.server_core",
+            "--scenario",
+            f"{security}:{variant}",
+            "--requests",
+            str(requests),
+            "--concurrency",
+            str(concurrency),
+            "--users",
+            str(users),
+        ],
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    for line in proc.stdout.splitlines():
+        if line.startswith(_RESULT_PREFIX):
+            return json.loads(line.removeprefix(_RESULT_PREFIX))
+    raise RuntimeError(f"scenario {security}:{variant} failed: {' '.join(proc.stderr.splitlines()[-10:])}")
+
+
+def _git_commit() -> str:
+    """Return the commit being benchmarked, or '' outside of a git checkout."""
+    proc = subprocess.run(  # nosec B603 B607
+        ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=False
+    )
+    return proc.stdout.strip()
+
+
+def compare(old: dict, new: dict) -> list[str]:
+    """Return a line for each result of new, with the change from the same scenario in old."""
+    previous = {(r["security"], r["middleware"], r["path"]): r for r in old["results"]}
+    lines = [f"{'security':<12} {'middleware':<24} {'path':<20} {'rps':>18} {'p99_ms':>18}"]
+    for result in new["results"]:
+        before = previous.get((result["security"], result["middleware"], result["path"]))
+        rps, p99 = f"{result['rps']:.1f}", f"{result['p99_ms']:.3f}"
+        if before is not None:
+            rps += f" ({(result['rps'] / before['rps'] - 1) * 100:+.1f}%)"
+            p99 += f" ({(result['p99_ms'] / before['p99_ms'] - 1) * 100:+.1f}%)"
+        lines.append(f"{result['security']:<12} {result['middleware']:<24} {result['path']:<20} {rps:>18} {p99:>18}")
+    return lines
+
+
+@click.command()
+@click.option("--security", "securities", multiple=True, default=SECURITY, type=click.Choice(SECURITY))
+@click.option("--middleware", "variants", multiple=True, default=VARIANTS, type=click.Choice(VARIANTS))
+@click.option("--requests", default=2000, help="requests per path in each scenario")
+@click.option("--concurrency", default=32, help="requests in flight at once")
+@click.option("--users", default=16, help="distinct users to mint tokens for")
+@click.option("--output", type=click.Path(dir_okay=False, writable=True), help="write the results as json")
+@click.option("--compare", "baseline", type=click.Path(exists=True, dir_okay=False), help="results to compare to")
+@click.option("--scenario", hidden=True, help="run a single 'security:middleware' scenario in this interpreter")
+def run(securities, variants, requests, concurrency, users, output, baseline, scenario):
+    """Measure requests/s and latency of the server core for each security provider and middleware."""
+    if scenario:
+        security, variant = scenario.split(":", 1)
+        results = run_scenario(security, variant, requests, concurrency, users)
+        print(_RESULT_PREFIX + json.dumps(results), flush=True)
+        return
+    report = {
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "requests": requests,
+        "concurrency": concurrency,
+        "users": users,
+        "results": [],
+    }
+    for security in securities:
+        for variant in variants:
+            click.echo(f"running {security}:{variant}", err=True)
+            report["results"].extend(_spawn(security, variant, requests, concurrency, users))
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+    if baseline:
+        with open(baseline) as f:
+            click.echo("\n".join(compare(json.load(f), report)))
+    else:
+        click.echo(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    run()
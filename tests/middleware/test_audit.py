@@ -0,0 +1,192 @@
+import asyncio
+import json
+import struct
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from azul_restapi_server import audit as audit_writer
+from azul_restapi_server.middleware import logging as audit
+
+_FORMAT = (
+    "full_time={time:%d/%b/%Y:%H:%M:%S.%f} client_ip={client_ip} client_port={client_port} "
+    "connection={connection} username={username} method={method} "
+    'path={path} generic_path={generic_path} status={status_code} user_agent="{user_agent}" '
+    'referer={referer} duration_ms={duration_ms} security="{security}" custom={headers[x-custom]}'
+)
+
+
+class Logger:
+    def __init__(self):
+        self.lines = []
+
+    async def write_async(self, line):
+        self.lines.append(line)
+
+
+def make_scope(logger, path="/api/v0/things/1"):
+    return {
+        "type": "http",
+        "app": SimpleNamespace(audit_writer=logger),
+        "method": "GET",
+        "path": path,
+        "root_path": "/root",
+        "client": ("10.0.0.1", 1234),
+        "headers": [
+            (b"user-agent", b"tests"),
+            (b"x-custom", b"value"),
+            (b"user-agent", b"ignored"),
+        ],
+    }
+
+
+async def endpoint(scope, receive, send):
+    scope["route"] = SimpleNamespace(path="/api/v0/things/{id}")
+    scope["state"]["user_info"] = SimpleNamespace(username="llama")
+    await send({"type": "http.response.start", "status": 200, "headers": [(b"x-azul-security", b"OFFICIAL")]})
+    await send({"type": "http.response.body", "body": b"{}"})
+
+
+async def plain_endpoint(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"{}"})
+
+
+def call(app, scope):
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app(scope, None, send))
+    return sent
+
+
+class TestAuditMiddleware(unittest.TestCase):
+    def test_template_fields(self):
+        self.assertEqual(
+            {"time", "path", "headers", "user_agent"},
+            audit.template_fields("{time:%H} {path} {headers[x-a]} {user_agent.upper} {{literal}}"),
+        )
+
+    @mock.patch.object(audit.log_config, "audit_format", _FORMAT)
+    def test_log_event(self):
+        logger = Logger()
+        sent = call(audit.AuditMiddleware(endpoint), make_scope(logger))
+        self.assertIn((b"X-Username", b"llama"), sent[0]["headers"])
+        self.assertEqual(1, len(logger.lines))
+        line = logger.lines[0]
+        for expected in (
+            "client_ip=10.0.0.1 client_port=1234",
+            "connection=- username=llama method=GET",
+            "path=/api/v0/things/1 generic_path=/root/api/v0/things/{id} status=200",
+            'user_agent="tests" referer=-',
+            'security="OFFICIAL" custom=value',
+        ):
+            self.assertIn(expected, line)
+
+    @mock.patch.object(audit.log_config, "audit_format", "{username} {status_code}")
+    def test_anonymous(self):
+        logger = Logger()
+        sent = call(audit.AuditMiddleware(plain_endpoint), make_scope(logger))
+        self.assertEqual(["- 200"], logger.lines)
+        self.assertIn((b"X-Username", b"-"), sent[0]["headers"])
+
+    @mock.patch.object(audit.log_config, "audit_output", "json")
+    def test_json(self):
+        logger = Logger()
+        scope = make_scope(logger)
+        scope["headers"].append((b"x-request-id", b"abc123"))
+        call(audit.AuditMiddleware(endpoint), scope)
+        record = json.loads(logger.lines[0])
+        self.assertEqual("abc123", record["request_id"])
+        self.assertEqual("OFFICIAL", record["security"])
+        self.assertEqual("/root/api/v0/things/{id}", record["generic_path"])
+        self.assertEqual(1234, record["client_port"])
+        self.assertNotIn("headers", record)
+        self.assertEqual(
+            {
+                "username",
+                "method",
+                "path",
+                "status_code",
+                "duration_s",
+                "duration_ms",
+                "duration_us",
+                "security",
+                "client_ip",
+                "client_port",
+                "connection",
+                "user_agent",
+                "referer",
+                "request_id",
+                "generic_path",
+                "time",
+                "body_bytes",
+                "wire_bytes",
+            },
+            set(record),
+        )
+
+        # an id is generated when the client doesn't send one
+        logger.lines.clear()
+        call(audit.AuditMiddleware(endpoint), make_scope(logger))
+        self.assertEqual(32, len(json.loads(logger.lines[0])["request_id"]))
+
+    @unittest.skipIf(audit_writer.msgpack is None, "msgpack is not installed")
+    @mock.patch.object(audit.log_config, "audit_output", "msgpack")
+    def test_msgpack(self):
+        logger = Logger()
+        call(audit.AuditMiddleware(endpoint), make_scope(logger))
+        data = logger.lines[0]
+        (length,) = struct.unpack(">I", data[:4])
+        self.assertEqual(len(data) - 4, length)
+        record = audit_writer.msgpack.unpackb(data[4:])
+        self.assertEqual("llama", record["username"])
+        self.assertEqual(200, record["status_code"])
+
+    @mock.patch.object(audit.log_config, "audit_format", "{body_bytes} {wire_bytes}")
+    def test_bytes(self):
+        async def streaming(scope, receive, send):
+            scope["state"]["response_wire_bytes"] = 0
+            await send({"type": "http.response.start", "status": 200, "headers": []})
+            for chunk in (b"abc", b"defg"):
+                scope["state"]["response_wire_bytes"] += 2
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+
+        logger = Logger()
+        call(audit.AuditMiddleware(streaming), make_scope(logger))
+        self.assertEqual(["7 4"], logger.lines)
+
+        logger.lines.clear()
+        call(audit.AuditMiddleware(plain_endpoint), make_scope(logger))
+        self.assertEqual(["2 2"], logger.lines)
+
+    def test_disconnect(self):
+        async def disconnecting(scope, receive, send):
+            await send({"type": "http.response.start", "status": 200, "headers": []})
+            raise OSError("client went away")
+
+        logger = Logger()
+        with self.assertRaises(OSError):
+            call(audit.AuditMiddleware(disconnecting), make_scope(logger))
+        self.assertEqual(1, len(logger.lines))
+
+    def test_path_filter(self):
+        logger = Logger()
+        call(audit.AuditMiddleware(plain_endpoint), make_scope(logger, path="/metrics"))
+        self.assertEqual([], logger.lines)
+
+    @mock.patch.object(audit.log_config, "audit_format", "{username} {status_code}")
+    def test_unused_fields(self):
+        """Values the format doesn't use aren't gathered, the overhead is measured by benchmarks.server_core."""
+        middleware = audit.AuditMiddleware(plain_endpoint)
+        self.assertEqual({}, middleware.header_fields)
+        self.assertFalse(middleware.use_client)
+        self.assertFalse(middleware.use_generic_path)
+        self.assertFalse(middleware.use_headers)
+        self.assertFalse(middleware.use_time)
+        logger = Logger()
+        call(middleware, make_scope(logger))
+        self.assertEqual(["- 200"], logger.lines)
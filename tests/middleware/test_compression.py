@@ -0,0 +1,134 @@
+import asyncio
+import gzip
+import json
+import unittest
+import zlib
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from azul_restapi_server.middleware import compression
+
+_DOC = {"entities": [{"id": i, "name": f"entity {i}", "features": ["a", "b", "c"]} for i in range(500)]}
+
+
+async def stream(request):
+    async def chunks():
+        for i in range(100):
+            yield json.dumps({"line": i}).encode() + b"\n"
+
+    return StreamingResponse(chunks(), media_type="application/x-ndjson")
+
+
+def tagged(request):
+    tags = {tag.strip().removeprefix("W/") for tag in request.headers.get("if-none-match", "").split(",")}
+    if '"v1"' in tags:
+        return Response(status_code=304, headers={"ETag": '"v1"'})
+    return JSONResponse(_DOC, headers={"ETag": '"v1"'})
+
+
+routes = [
+    Route("/doc", lambda request: JSONResponse(_DOC)),
+    Route("/tagged", tagged),
+    Route("/small", lambda request: JSONResponse({"ok": True})),
+    Route("/stream", stream),
+    Route("/binary", lambda request: Response(b"\0" * 10000, media_type="application/octet-stream")),
+    Route("/metrics", lambda request: Response("metric 1\n" * 1000)),
+    Route("/encoded", lambda request: Response(gzip.compress(b"x" * 10000), headers={"Content-Encoding": "gzip"})),
+]
+
+
+class TestCompressionMiddleware(unittest.TestCase):
+    def setUp(self):
+        app = Starlette(routes=routes)
+        app.add_middleware(
+            compression.CompressionMiddleware,
+            exclude_paths=["/metrics"],
+            exclude_types=["application/octet-stream"],
+        )
+        self.client = TestClient(app)
+
+    def test_compressed(self):
+        resp = self.client.get("/doc", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual("gzip", resp.headers["content-encoding"])
+        self.assertEqual("Accept-Encoding", resp.headers["vary"])
+        self.assertEqual(_DOC, resp.json())
+
+        resp = self.client.get("/stream", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual("gzip", resp.headers["content-encoding"])
+        self.assertEqual(100, len(resp.text.splitlines()))
+
+    def test_etag(self):
+        # the compressed body is a different representation, so the tag is weak
+        resp = self.client.get("/tagged", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual("gzip", resp.headers["content-encoding"])
+        self.assertEqual('W/"v1"', resp.headers["etag"])
+        resp = self.client.get("/tagged", headers={"Accept-Encoding": "gzip", "If-None-Match": 'W/"v1"'})
+        self.assertEqual(304, resp.status_code)
+        self.assertEqual('W/"v1"', resp.headers["etag"])
+
+        resp = self.client.get("/tagged", headers={"Accept-Encoding": "identity"})
+        self.assertEqual('"v1"', resp.headers["etag"])
+
+    @unittest.skipIf(compression.zstandard is None, "zstandard is not installed")
+    def test_zstd(self):
+        resp = self.client.get("/doc", headers={"Accept-Encoding": "gzip, zstd"})
+        self.assertEqual("zstd", resp.headers["content-encoding"])
+
+    def test_uncompressed(self):
+        for path, accept in (
+            ("/doc", "identity"),
+            ("/small", "gzip"),
+            ("/binary", "gzip"),
+            ("/metrics", "gzip"),
+        ):
+            resp = self.client.get(path, headers={"Accept-Encoding": accept})
+            self.assertNotIn("content-encoding", resp.headers, path)
+            self.assertEqual(resp.headers["content-length"], str(len(resp.content)), path)
+
+        # already encoded responses are left alone
+        resp = self.client.get("/encoded", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(b"x" * 10000, resp.content)
+
+    def test_wire_bytes(self):
+        sent = []
+        scope = {"type": "http", "path": "/doc", "headers": [(b"accept-encoding", b"gzip")]}
+
+        async def app(scope, receive, send):
+            await send({"type": "http.response.start", "status": 200, "headers": [(b"content-length", b"20000")]})
+            for _ in range(2):
+                await send({"type": "http.response.body", "body": b"a" * 10000, "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(compression.CompressionMiddleware(app)(scope, None, send))
+        body = b"".join(m.get("body", b"") for m in sent)
+        self.assertEqual(b"a" * 20000, gzip.decompress(body))
+        self.assertEqual(len(body), scope["state"][compression.WIRE_BYTES])
+        self.assertNotIn(b"content-length", dict(sent[0]["headers"]))
+
+    def test_flush_chunks(self):
+        sent = []
+        scope = {"type": "http", "path": "/events", "headers": [(b"accept-encoding", b"gzip")]}
+        events = [f"data: event {i}\n\n".encode() for i in range(3)]
+
+        async def app(scope, receive, send):
+            await send(
+                {"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"text/event-stream")]}
+            )
+            for event in events:
+                await send({"type": "http.response.body", "body": event, "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(compression.CompressionMiddleware(app)(scope, None, send))
+        # each small event can be decompressed as soon as it is sent
+        decompressor = zlib.decompressobj(31)
+        for event, message in zip(events, sent[1:]):
+            self.assertEqual(event, decompressor.decompress(message["body"]))
@@ -0,0 +1,87 @@
+import tracemalloc
+import unittest
+from unittest import mock
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+
+from azul_restapi_server import main, settings
+from azul_restapi_server.middleware import profiling
+
+_leaked = []
+
+app = FastAPI()
+
+
+@app.get("/v0/leaky/{size}")
+def leaky(size: int):
+    _leaked.append(bytearray(size))
+    return {"size": size}
+
+
+@app.get("/v0/fine")
+def fine():
+    return {}
+
+
+def make_client(interval: int) -> TestClient:
+    profiled = FastAPI()
+    profiled.mount("/", app)
+    profiled.add_middleware(profiling.ProfilingMiddleware, interval=interval, token="secret")
+    return TestClient(profiled)
+
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        profiling._routes.clear()
+        _leaked.clear()
+        self.addCleanup(tracemalloc.stop)
+
+    def test_sampling(self):
+        client = make_client(2)
+        for _ in range(4):
+            client.get("/v0/fine")
+        report = profiling.report()
+        self.assertTrue(report["tracing"])
+        self.assertEqual(2, report["routes"]["GET /v0/fine"]["count"])
+        self.assertEqual(2, REGISTRY.get_sample_value("azulapi_profile_requests", {"route": "GET /v0/fine"}))
+
+    def test_token(self):
+        client = make_client(0)
+        self.assertFalse(tracemalloc.is_tracing())
+        client.get("/v0/fine", headers={"X-Azul-Profile": "wrong"})
+        client.get("/v0/fine", headers={"X-Azul-Profile": "wrong"})
+        client.get("/v0/fine", headers={"X-Azul-Profile": "secret"})
+        self.assertEqual(1, profiling.report()["routes"]["GET /v0/fine"]["count"])
+
+    def test_leak(self):
+        client = make_client(0)
+        for _ in range(3):
+            client.get("/v0/leaky/1000000", headers={"X-Azul-Profile": "secret"})
+        report = profiling.report(top=5)
+        route = report["routes"]["GET /v0/leaky/{size}"]
+        self.assertEqual(3, route["count"])
+        self.assertGreater(route["retained_bytes"], 2_000_000)
+        self.assertGreater(route["max_retained_bytes"], 900_000)
+        self.assertGreater(route["mean_wall_seconds"], 0)
+        self.assertTrue(any(__file__ in a["location"] for a in report["top_allocations"]))
+        self.assertGreater(REGISTRY.get_sample_value("azulapi_profile_traced_bytes"), 2_000_000)
+
+    def test_not_tracing(self):
+        report = profiling.report()
+        self.assertEqual({}, report["routes"])
+        self.assertFalse(report["tracing"])
+        self.assertEqual([], report["top_allocations"])
+
+    def test_endpoint(self):
+        profiling.record("GET /api/v0/users/me", 0.01, 0.005, 100)
+        with TestClient(main.app) as client, mock.patch.object(settings.restapi, "profile_token", "secret"):
+            resp = client.get("/api/diagnostics/memory", params={"top": 3}, headers={"X-Azul-Profile": "secret"})
+            # only users with the token can see where the server holds memory
+            self.assertEqual(403, client.get("/api/diagnostics/memory").status_code)
+            self.assertEqual(
+                403, client.get("/api/diagnostics/memory", headers={"X-Azul-Profile": "guess"}).status_code
+            )
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(1, resp.json()["routes"]["GET /api/v0/users/me"]["count"])
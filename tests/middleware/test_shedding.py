@@ -0,0 +1,118 @@
+import asyncio
+import time
+import unittest
+
+import httpx
+from fastapi import FastAPI
+from prometheus_client import REGISTRY
+
+from azul_restapi_server.middleware.shedding import LoadSheddingMiddleware
+
+app = FastAPI()
+release = asyncio.Event()
+
+
+@app.get("/slow")
+async def slow():
+    await release.wait()
+    return {}
+
+
+@app.get("/fast")
+async def fast():
+    return {}
+
+
+@app.get("/v0/users/me")
+async def me():
+    return {}
+
+
+@app.get("/metrics")
+async def metrics():
+    return {}
+
+
+def shed_count(reason: str) -> float:
+    return REGISTRY.get_sample_value("azulapi_shed_requests_total", {"reason": reason}) or 0.0
+
+
+async def get(shedding: LoadSheddingMiddleware, path: str) -> httpx.Response:
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=shedding), base_url="http://test") as client:
+        return await client.get(path)
+
+
+class TestLoadShedding(unittest.TestCase):
+    def test_in_flight(self):
+        shedding = LoadSheddingMiddleware(app, max_in_flight=2)
+        shed = shed_count("in_flight")
+
+        async def run():
+            release.clear()
+            admitted = [asyncio.create_task(get(shedding, "/slow")) for _ in range(2)]
+            while shedding.in_flight < 2:
+                await asyncio.sleep(0.01)
+            refused = await get(shedding, "/fast")
+            exempt = await get(shedding, "/metrics")
+            release.set()
+            return refused, exempt, await asyncio.gather(*admitted), await get(shedding, "/fast")
+
+        refused, exempt, admitted, after = asyncio.run(run())
+        self.assertEqual(503, refused.status_code)
+        self.assertEqual("1", refused.headers["Retry-After"])
+        self.assertEqual(200, exempt.status_code)
+        # already admitted requests finish as normal
+        self.assertEqual([200, 200], [r.status_code for r in admitted])
+        self.assertEqual(200, after.status_code)
+        self.assertEqual(0, shedding.in_flight)
+        self.assertEqual(shed + 1, shed_count("in_flight"))
+
+    def test_priority(self):
+        shedding = LoadSheddingMiddleware(app, max_in_flight=1, priority_paths=["/v0/users/me", "/static/"])
+        self.assertTrue(shedding.priority("/static/app.js"))
+        self.assertFalse(shedding.priority("/v0/users/me/other"))
+
+        async def run():
+            global release
+            # bound to the event loop of this test
+            release = asyncio.Event()
+            admitted = asyncio.create_task(get(shedding, "/slow"))
+            while shedding.in_flight < 1:
+                await asyncio.sleep(0.01)
+            low = await get(shedding, "/fast")
+            # admitted until twice the limit
+            high = await get(shedding, "/v0/users/me")
+            release.set()
+            await admitted
+            return low, high
+
+        low, high = asyncio.run(run())
+        self.assertEqual(503, low.status_code)
+        self.assertEqual(200, high.status_code)
+
+        shedding.in_flight = 2
+        self.assertEqual("in_flight", shedding.overloaded(2))
+        shedding.in_flight = 0
+
+    def test_loop_lag(self):
+        shedding = LoadSheddingMiddleware(app, max_loop_lag=0.2)
+        shed = shed_count("loop_lag")
+
+        async def run():
+            self.assertEqual(200, (await get(shedding, "/fast")).status_code)
+            await asyncio.sleep(0.05)
+            # blocks the event loop, as slow sync code would
+            time.sleep(0.3)
+            # lets the monitor, which is overdue, run first
+            await asyncio.sleep(0.01)
+            self.assertGreaterEqual(shedding.lag, 0.2)
+            self.assertEqual(503, (await get(shedding, "/fast")).status_code)
+            self.assertEqual(200, (await get(shedding, "/metrics")).status_code)
+            # recovers once the loop catches up
+            await asyncio.sleep(0.25)
+            self.assertEqual(200, (await get(shedding, "/fast")).status_code)
+            shedding._monitor.cancel()
+
+        asyncio.run(run())
+        self.assertEqual(shed + 1, shed_count("loop_lag"))
+        self.assertGreater(REGISTRY.get_sample_value("azulapi_event_loop_lag_seconds"), -1)
@@ -0,0 +1,93 @@
+import asyncio
+import time
+import unittest
+
+from fastapi import APIRouter, Depends, FastAPI, Request
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+
+from azul_restapi_server import plugins, stages, threadpool
+from azul_restapi_server.middleware.stages import StageTimingMiddleware
+
+
+def validate_token(request: Request):
+    time.sleep(0.01)
+    return "llama"
+
+
+router = APIRouter()
+
+
+@router.get("/v0/things/{thing_id}")
+def read_thing(thing_id: str):
+    time.sleep(0.02)
+    return {"id": thing_id}
+
+
+app = FastAPI()
+app.include_router(router, dependencies=[Depends(stages.timed("auth", validate_token))])
+app.add_middleware(StageTimingMiddleware, server_timing=True)
+client = TestClient(app)
+
+
+def sample_count(stage: str, route: str, plugin: str) -> float:
+    labels = {"stage": stage, "route": route, "plugin": plugin}
+    return REGISTRY.get_sample_value("azulapi_request_stage_seconds_count", labels) or 0.0
+
+
+def sample_sum(stage: str, route: str, plugin: str) -> float:
+    labels = {"stage": stage, "route": route, "plugin": plugin}
+    return REGISTRY.get_sample_value("azulapi_request_stage_seconds_sum", labels) or 0.0
+
+
+class TestStageTiming(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.addClassCleanup(threadpool.uninstall)
+        threadpool.install()
+        plugins.plugin_endpoints[read_thing] = "things"
+
+    def test_stages(self):
+        route = "/v0/things/{thing_id}"
+        all_stages = ("auth", "queue", "handler", "send")
+        counts = {s: sample_count(s, route, "things") for s in all_stages}
+        sums = {s: sample_sum(s, route, "things") for s in all_stages}
+        resp = client.get("/v0/things/1")
+        self.assertEqual(200, resp.status_code)
+        for stage in all_stages:
+            self.assertEqual(counts[stage] + 1, sample_count(stage, route, "things"), stage)
+        self.assertGreaterEqual(sample_sum("auth", route, "things") - sums["auth"], 0.01)
+        self.assertGreaterEqual(sample_sum("handler", route, "things") - sums["handler"], 0.02)
+
+        header = resp.headers["Server-Timing"]
+        self.assertEqual({"auth", "queue", "handler"}, {part.split(";")[0] for part in header.split(", ")})
+
+    def test_unmatched(self):
+        before = sample_count("handler", "unknown", "")
+        self.assertEqual(404, client.get("/nowhere").status_code)
+        self.assertEqual(before + 1, sample_count("handler", "unknown", ""))
+
+    def test_outside_request(self):
+        # nothing is recorded without a request in progress
+        stages.record("auth", 1.0)
+        self.assertIsNone(stages.timings.get())
+
+    def test_shared_headers(self):
+        # a response's headers may be a list the app reuses, so it must not gain a header per request
+        headers = [(b"content-type", b"text/plain")]
+
+        async def shared(scope, receive, send):
+            await send({"type": "http.response.start", "status": 200, "headers": headers})
+            await send({"type": "http.response.body", "body": b"ok"})
+
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        middleware = StageTimingMiddleware(shared, server_timing=True)
+        scope = {"type": "http", "method": "GET", "path": "/", "headers": []}
+        for _ in range(2):
+            asyncio.run(middleware(scope, None, send))
+        self.assertEqual([(b"content-type", b"text/plain")], headers)
+        self.assertEqual(["content-type", "server-timing"], [k.decode() for k, _ in sent[2]["headers"]])
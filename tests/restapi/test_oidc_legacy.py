@@ -0,0 +1,54 @@
+import asyncio
+import time
+import unittest
+from unittest import mock
+
+from fastapi import Depends, FastAPI
+
+from azul_restapi_server import startup
+from azul_restapi_server.security import oidc_legacy, oidc_shared
+
+_CONFIG = {
+    "token_endpoint": "http://localhost:8080/token",
+    "authorization_endpoint": "http://localhost:8080/auth",
+}
+
+
+class TestOIDCLegacy(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(oidc_legacy._discovery.clear)
+        oidc_legacy._discovery.clear()
+
+    def test_startup(self):
+        with mock.patch.object(oidc_shared, "discover_auth_server", return_value=_CONFIG) as discover:
+            # discovery only runs once per process
+            self.assertIs(oidc_legacy.begin_startup(), oidc_legacy.begin_startup())
+            asyncio.run(oidc_legacy.startup())
+        discover.assert_called_once()
+
+        app = FastAPI()
+        app.get("/me")(lambda user=Depends(oidc_legacy.validate_token): user)
+        flows = app.openapi()["components"]["securitySchemes"]["OAuth2AuthorizationCodeBearer"]["flows"]
+        self.assertEqual(
+            {"tokenUrl": "http://localhost:8080/token", "authorizationUrl": "http://localhost:8080/auth"},
+            {k: v for k, v in flows["authorizationCode"].items() if k in ("tokenUrl", "authorizationUrl")},
+        )
+
+    def test_startup_failure(self):
+        with mock.patch.object(oidc_shared, "discover_auth_server", side_effect=Exception("no IdP")):
+            with self.assertRaisesRegex(Exception, "no IdP"):
+                asyncio.run(oidc_legacy.startup())
+
+    def test_startup_phase(self):
+        self.addCleanup(startup.phases.pop, "oidc_discovery", None)
+
+        def discover(url):
+            time.sleep(0.05)
+            return _CONFIG
+
+        with mock.patch.object(oidc_shared, "discover_auth_server", side_effect=discover):
+            oidc_legacy.begin_startup()
+            # the app is imported while discovery runs, so waiting for it afterwards takes less than it did
+            time.sleep(0.1)
+            asyncio.run(oidc_legacy.startup())
+        self.assertGreaterEqual(startup.phases["oidc_discovery"], 0.05)
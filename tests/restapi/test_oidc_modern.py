@@ -2,8 +2,10 @@ import datetime
 import json
 import os
 import unittest
+from unittest import mock
 
 import httpretty
+import httpx
 from fastapi import Depends, FastAPI
 from fastapi.testclient import TestClient
 from jose import jwt
@@ -11,6 +13,7 @@ from jose import jwt
 from azul_restapi_server import security, settings
 from azul_restapi_server.api.v1 import users
 from azul_restapi_server.security import oidc_modern as oidc
+from azul_restapi_server.security import oidc_shared
 
 app = FastAPI()
 app.include_router(users.router, dependencies=[Depends(security.validate_token)])
@@ -37,23 +40,27 @@ def gen_token(labels: list[str], user: str):
     )
 
 
-def register_well_known():
-    wellknown = json.dumps(
+_WELL_KNOWN = {
+    "http://localhost:8080/.well-known/openid-configuration": json.dumps(
         {
             "jwks_uri": "http://localhost:8080/keys",
             "id_token_signing_alg_values_supported": "HS256",
             "issuer": "http://localhost:8080",
         }
-    )
-    httpretty.register_uri(
-        httpretty.GET,
-        "http://localhost:8080/.well-known/openid-configuration",
-        body=wellknown,
-    )
-    httpretty.register_uri(
-        httpretty.GET,
-        "http://localhost:8080/keys",
-        body=json.dumps("secret.secret.secret.secret.secret.secret."),
+    ),
+    "http://localhost:8080/keys": json.dumps("secret.secret.secret.secret.secret.secret."),
+}
+
+
+def register_well_known():
+    for uri, body in _WELL_KNOWN.items():
+        httpretty.register_uri(httpretty.GET, uri, body=body)
+
+
+def mock_async_client():
+    """Serve the well known config to the async client, as httpretty can't mock async sockets."""
+    return httpx.AsyncClient(
+        transport=httpx.MockTransport(lambda r: httpx.Response(200, text=_WELL_KNOWN[str(r.url)]))
     )
 
 
@@ -62,12 +69,17 @@ class TestOIDC(unittest.TestCase):
     def setUpClass(cls) -> None:
         os.environ["OIDC_AUTHORITY_URL"] = "http://localhost:8080"
         os.environ["OIDC_CLIENT_ID"] = "web"
+        os.environ["OIDC_SHARED_CACHE_DIR"] = ""
         app.dependency_overrides[security.validate_token] = oidc.validate_token
         settings.reset()
 
-    @httpretty.activate(verbose=True, allow_net_connect=False)
+    def setUp(self):
+        oidc_shared.clear_token_cache()
+        oidc_shared._discovery_cache.clear()
+        oidc_shared._jwks_cache.clear()
+
+    @mock.patch.object(oidc_shared, "get_async_client", mock_async_client)
     def test_good_token(self):
-        register_well_known()
         token = gen_token(labels=["test1", "test2", "test3"], user="llama")
         resp = client.get("/v0/users/me", headers={"Authorization": token})
         self.assertEqual(200, resp.status_code)
@@ -82,3 +94,11 @@ class TestOIDC(unittest.TestCase):
         # no token
         resp = client.get("/v0/users/me")
         self.assertEqual(401, resp.status_code)
+
+    @httpretty.activate(verbose=True, allow_net_connect=False)
+    def test_sync_validate(self):
+        register_well_known()
+        token = gen_token(labels=["test1"], user="llama")
+        user_info = oidc_shared.validate(token, "web")
+        self.assertEqual("llama", user_info.username)
+        self.assertEqual(["test1"], user_info.roles)
@@ -0,0 +1,95 @@
+import datetime
+import json
+import unittest
+from unittest import mock
+
+import httpx
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from fastapi import HTTPException
+from jose import jwk, jwt
+
+from azul_restapi_server import settings
+from azul_restapi_server.security import jwks, oidc_shared
+
+_CONFIG = {
+    "jwks_uri": "http://localhost:8080/keys",
+    "id_token_signing_alg_values_supported": ["RS256"],
+    "issuer": "http://localhost:8080",
+}
+
+
+def gen_key(kid: str) -> tuple[str, dict]:
+    """Return a private key in pem format and the matching public jwk."""
+    pem = (
+        rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        .private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+        .decode()
+    )
+    public = jwk.construct(pem, "RS256").public_key().to_dict()
+    public.pop("alg")
+    return pem, {**public, "kid": kid, "use": "sig"}
+
+
+def gen_token(pem: str, kid: str, user: str = "llama") -> str:
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    return jwt.encode(
+        {
+            "sub": user,
+            "iss": "http://localhost:8080",
+            "exp": now + datetime.timedelta(hours=1),
+            "preferred_username": user,
+            "aud": "web",
+        },
+        pem,
+        algorithm="RS256",
+        headers={"kid": kid},
+    )
+
+
+class TestKeySet(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.pem1, cls.jwk1 = gen_key("k1")
+        cls.pem2, cls.jwk2 = gen_key("k2")
+
+    def test_find(self):
+        keys = jwks.KeySet({"keys": [self.jwk1, self.jwk2, {**self.jwk1, "kid": "enc", "use": "enc"}]})
+        key = keys.find(gen_token(self.pem2, "k2"), ["RS256"])
+        self.assertEqual(self.jwk2["n"], key.to_dict()["n"])
+        # key objects are only constructed once
+        self.assertIs(key, keys.find(gen_token(self.pem2, "k2", user="other"), ["RS256"]))
+        self.assertIsNone(keys.find(gen_token(self.pem1, "k3"), ["RS256"]))
+        self.assertIsNone(keys.find(gen_token(self.pem1, "enc"), ["RS256"]))
+        # malformed and unsupported tokens are left for verification to reject
+        self.assertIs(keys.raw, keys.find("not-a-token", ["RS256"]))
+        self.assertIs(keys.raw, keys.find(gen_token(self.pem1, "k1"), ["ES256"]))
+
+    def test_single_key_without_kid(self):
+        keys = jwks.KeySet({"keys": [{k: v for k, v in self.jwk1.items() if k != "kid"}]})
+        token = jwt.encode({"sub": "llama"}, self.pem1, algorithm="RS256")
+        self.assertIsNotNone(keys.find(token, "RS256"))
+
+    def test_shared_secret(self):
+        keys = jwks.KeySet("secret")
+        self.assertEqual("secret", keys.find("anything", ["HS256"]))
+
+    @mock.patch.object(oidc_shared, "discover_auth_server", return_value=_CONFIG)
+    def test_rotation(self, _discover):
+        self.enterContext(mock.patch.object(settings.oidc, "shared_cache_dir", ""))
+        oidc_shared.clear_token_cache()
+        oidc_shared._jwks_cache.clear()
+        responses = [{"keys": [self.jwk1]}, {"keys": [self.jwk1, self.jwk2]}]
+        with mock.patch.object(
+            oidc_shared.client, "get", side_effect=lambda url: httpx.Response(200, text=json.dumps(responses.pop(0)))
+        ) as get:
+            self.assertEqual("llama", oidc_shared.validate(gen_token(self.pem1, "k1"), "web").username)
+            self.assertEqual(1, get.call_count)
+            # token signed with a key rotated in after the last fetch
+            self.assertEqual("llama", oidc_shared.validate(gen_token(self.pem2, "k2"), "web").username)
+            self.assertEqual(2, get.call_count)
+            # refetching is rate limited for unknown keys
+            with self.assertRaises(HTTPException) as e:
+                oidc_shared.validate(gen_token(self.pem2, "k3"), "web")
+            self.assertEqual(401, e.exception.status_code)
+            self.assertEqual(2, get.call_count)
@@ -1,6 +1,40 @@
+import datetime
+import json
+import os
+import tempfile
 import unittest
+from unittest import mock
 
-from azul_restapi_server.security import oidc_shared
+import httpx
+from jose import jwt
+from prometheus_client import REGISTRY
+
+from azul_restapi_server import settings
+from azul_restapi_server.security import jwks, oidc_shared
+
+_SECRET = "secret.secret.secret.secret.secret.secret."
+_CONFIG = {
+    "jwks_uri": "http://localhost:8080/keys",
+    "id_token_signing_alg_values_supported": "HS256",
+    "issuer": "http://localhost:8080",
+}
+
+
+def gen_token(user: str, expires: datetime.timedelta = datetime.timedelta(weeks=1)):
+    """Generate a tests jwt token using a preshared secret."""
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    return jwt.encode(
+        {
+            "sub": user,
+            "iss": "http://localhost:8080",
+            "iat": now - datetime.timedelta(weeks=1),
+            "exp": now + expires,
+            "preferred_username": user,
+            "aud": "web",
+        },
+        _SECRET,
+        algorithm="HS256",
+    )
 
 
 class TestOIDC(unittest.TestCase):
@@ -60,3 +94,124 @@ class TestOIDC(unittest.TestCase):
         self.assertEqual(user.email, "maraka@klombine.com")
         self.assertEqual(user.roles, ["a", "b", "c"])
         self.assertEqual(user.unique_id, "my_service_id")
+
+    @mock.patch.object(oidc_shared, "_get_jwks", return_value=jwks.KeySet(_SECRET))
+    @mock.patch.object(oidc_shared, "discover_auth_server", return_value=_CONFIG)
+    def test_token_cache(self, _discover, _jwks):
+        oidc_shared.clear_token_cache()
+        hits = REGISTRY.get_sample_value("azulapi_oidc_token_cache_hits_total")
+        misses = REGISTRY.get_sample_value("azulapi_oidc_token_cache_misses_total")
+        token = gen_token("llama")
+        with mock.patch.object(oidc_shared.jwt, "decode", wraps=jwt.decode) as decode:
+            first = oidc_shared.validate(token, "web")
+            first.credentials = None
+            first.roles.append("modified")
+            second = oidc_shared.validate(token, "web")
+            self.assertEqual(1, decode.call_count)
+            # a cached token is a fresh copy and unaffected by changes to earlier results
+            self.assertEqual("llama", second.username)
+            self.assertEqual([], second.roles)
+            self.assertEqual(token, second.credentials.token)
+
+            # a different audience is verified again
+            with self.assertRaises(oidc_shared.HTTPException):
+                oidc_shared.validate(token, "other")
+            self.assertEqual(2, decode.call_count)
+        self.assertEqual(hits + 1, REGISTRY.get_sample_value("azulapi_oidc_token_cache_hits_total"))
+        self.assertEqual(misses + 2, REGISTRY.get_sample_value("azulapi_oidc_token_cache_misses_total"))
+
+    @mock.patch.object(oidc_shared, "_get_jwks", return_value=jwks.KeySet(_SECRET))
+    @mock.patch.object(oidc_shared, "discover_auth_server", return_value=_CONFIG)
+    def test_token_cache_expiry(self, _discover, _jwks):
+        oidc_shared.clear_token_cache()
+        token = gen_token("llama", expires=datetime.timedelta(seconds=30))
+        oidc_shared.validate(token, "web")
+        key = oidc_shared._token_cache_key(token, "web")
+        self.assertIn(key, oidc_shared._token_cache)
+        # entry is gone as soon as the token expires, even though the cache ttl is longer
+        oidc_shared._token_cache.expire(oidc_shared.time.time() + 31)
+        self.assertNotIn(key, oidc_shared._token_cache)
+
+
+class TestSharedCache(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = os.path.join(tmp.name, "shared")
+        self.enterContext(mock.patch.object(settings.oidc, "shared_cache_dir", self.dir))
+        for cache in (oidc_shared._discovery_cache, oidc_shared._jwks_cache):
+            cache.clear()
+            self.addCleanup(cache.clear)
+
+    def test_shared(self):
+        url = "http://localhost:8080/.well-known/openid-configuration"
+        responses = {url: _CONFIG, _CONFIG["jwks_uri"]: {"keys": []}}
+        with mock.patch.object(
+            oidc_shared.client, "get", side_effect=lambda u: httpx.Response(200, json=responses[u])
+        ) as get:
+            self.assertEqual(_CONFIG, oidc_shared.discover_auth_server(url))
+            self.assertEqual({"keys": []}, oidc_shared._get_jwks(_CONFIG).raw)
+            self.assertEqual(2, get.call_count)
+            self.assertEqual(0o700, os.stat(self.dir).st_mode & 0o777)
+            self.assertEqual(0o600, os.stat(oidc_shared._shared_path(url)).st_mode & 0o777)
+
+            # another worker, or a restart, reads the saved documents
+            oidc_shared._discovery_cache.clear()
+            oidc_shared._jwks_cache.clear()
+            self.assertEqual(_CONFIG, oidc_shared.discover_auth_server(url))
+            self.assertEqual({"keys": []}, oidc_shared._get_jwks(_CONFIG).raw)
+            self.assertEqual(2, get.call_count)
+
+            # refetching for a rotated key goes to the IdP
+            oidc_shared._get_jwks(_CONFIG, refetch=True)
+            self.assertEqual(3, get.call_count)
+
+    def test_expired(self):
+        os.makedirs(self.dir, mode=0o700)
+        with open(oidc_shared._shared_path("http://idp"), "w") as f:
+            json.dump({"url": "http://idp", "fetched": 0, "document": _CONFIG}, f)
+        self.assertIsNone(oidc_shared._read_shared("http://idp"))
+        oidc_shared._write_shared("http://idp", _CONFIG)
+        self.assertEqual(_CONFIG, oidc_shared._read_shared("http://idp"))
+
+    def test_untrusted(self):
+        oidc_shared._write_shared("http://idp", _CONFIG)
+        path = oidc_shared._shared_path("http://idp")
+        os.chmod(path, 0o666)
+        self.assertIsNone(oidc_shared._read_shared("http://idp"))
+
+        with open(path, "w") as f:
+            f.write("not json")
+        os.chmod(path, 0o600)
+        self.assertIsNone(oidc_shared._read_shared("http://idp"))
+
+    def test_untrusted_dir(self):
+        os.makedirs(self.dir, mode=0o700)
+        oidc_shared._write_shared("http://idp", _CONFIG)
+        # i.e. created by another user, who could replace the documents in it
+        os.chmod(self.dir, 0o777)
+        self.assertIsNone(oidc_shared._read_shared("http://idp"))
+        os.remove(oidc_shared._shared_path("http://idp"))
+        oidc_shared._write_shared("http://idp", _CONFIG)
+        self.assertEqual([], os.listdir(self.dir))
+
+        os.rmdir(self.dir)
+        os.symlink(tempfile.gettempdir(), self.dir)
+        self.assertIsNone(oidc_shared._shared_dir(create=True))
+
+    def test_disabled(self):
+        with mock.patch.object(settings.oidc, "shared_cache_dir", ""):
+            oidc_shared._write_shared("http://idp", _CONFIG)
+            self.assertIsNone(oidc_shared._read_shared("http://idp"))
+        self.assertFalse(os.path.exists(self.dir))
+
+    def test_warm(self):
+        with (
+            mock.patch.object(oidc_shared, "discover_auth_server", return_value=_CONFIG),
+            mock.patch.object(oidc_shared, "_get_jwks") as get_jwks,
+        ):
+            oidc_shared.warm()
+        get_jwks.assert_called_once_with(_CONFIG)
+        # failures are left for workers to retry
+        with mock.patch.object(oidc_shared, "discover_auth_server", side_effect=Exception("no IdP")):
+            oidc_shared.warm()
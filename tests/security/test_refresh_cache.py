@@ -0,0 +1,120 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from azul_restapi_server.security import refresh_cache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestRefreshCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = refresh_cache.RefreshCache(ttl=10, grace=100, timer=self.clock)
+
+    def wait_for_refresh(self):
+        for _ in range(500):
+            if not self.cache._inflight:
+                return
+            time.sleep(0.01)
+        self.fail("refresh did not complete")
+
+    def test_fresh_value(self):
+        calls = []
+        self.assertEqual(1, self.cache.get("k", lambda: calls.append(1) or 1))
+        self.assertEqual(1, self.cache.get("k", lambda: calls.append(2) or 2))
+        self.assertEqual([1], calls)
+
+    def test_stale_served_while_refreshing(self):
+        self.cache.get("k", lambda: "old")
+        self.clock.now += 11
+        release = threading.Event()
+
+        def slow_fetch():
+            release.wait(5)
+            return "new"
+
+        # stale value is returned straight away, refresh happens in the background
+        self.assertEqual("old", self.cache.get("k", slow_fetch))
+        self.assertEqual("old", self.cache.get("k", lambda: self.fail("second refresh started")))
+        release.set()
+        self.wait_for_refresh()
+        self.assertEqual("new", self.cache.get("k", lambda: "newer"))
+
+    def test_failed_refresh_uses_grace(self):
+        self.cache.get("k", lambda: "old")
+        self.clock.now += 11
+
+        def broken():
+            raise Exception("idp down")
+
+        self.assertEqual("old", self.cache.get("k", broken))
+        self.wait_for_refresh()
+        # retries are rate limited while inside grace period
+        self.assertEqual("old", self.cache.get("k", lambda: self.fail("retried too soon")))
+        self.clock.now += refresh_cache.REFRESH_RETRY_S
+        self.assertEqual("old", self.cache.get("k", broken))
+        self.wait_for_refresh()
+
+        # once grace is exhausted the error is raised to the caller
+        self.clock.now += 100
+        with self.assertRaisesRegex(Exception, "idp down"):
+            self.cache.get("k", broken)
+        self.assertEqual("back", self.cache.get("k", lambda: "back"))
+
+    def test_single_flight_sync(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def slow_fetch():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return "value"
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.cache.get("k", slow_fetch)))]
+        threads[0].start()
+        started.wait(5)
+        for _ in range(5):
+            thread = threading.Thread(target=lambda: results.append(self.cache.get("k", slow_fetch)))
+            thread.start()
+            threads.append(thread)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(["value"] * 6, results)
+        self.assertEqual([1], calls)
+
+    def test_single_flight_async(self):
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "value"
+
+        async def run():
+            return await asyncio.gather(*[self.cache.get_async("k", fetch) for _ in range(10)])
+
+        self.assertEqual(["value"] * 10, asyncio.run(run()))
+        self.assertEqual([1], calls)
+
+        # stale value is served to async callers too
+        self.clock.now += 11
+
+        async def refresh():
+            value = await self.cache.get_async("k", fetch)
+            await asyncio.sleep(0.05)
+            return value, await self.cache.get_async("k", fetch)
+
+        self.assertEqual(("value", "value"), asyncio.run(refresh()))
+        self.assertEqual([1, 1], calls)
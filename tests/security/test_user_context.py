@@ -0,0 +1,66 @@
+import copy
+import json
+import unittest
+
+from azul_bedrock.models_auth import Credentials, UserInfo
+
+from azul_restapi_server.security.user_context import UserContext
+
+
+def make_user() -> UserInfo:
+    return UserInfo(
+        username="llama",
+        org="farm",
+        email="llama@farm",
+        roles=["a", "b"],
+        unique_id="llama-sub",
+        decoded={"sub": "llama-sub", "groups": [{"name": "x"}], "exp": 10},
+        credentials=Credentials(format="oauth", unique="llama-sub", token="secret-token"),
+    )
+
+
+class TestUserContext(unittest.TestCase):
+    def test_immutable(self):
+        user = UserContext(make_user())
+        with self.assertRaises(AttributeError):
+            user.username = "alpaca"
+        with self.assertRaises(TypeError):
+            user.claims["sub"] = "alpaca"
+        with self.assertRaises(AttributeError):
+            user.roles.append("c")
+        with self.assertRaises(AttributeError):
+            user.other = 1
+
+    def test_user_info(self):
+        original = make_user()
+        user = UserContext(original)
+        first = user.user_info()
+        self.assertEqual(original, first)
+        # each copy can be changed without affecting the next
+        first.roles.append("c")
+        first.credentials.token = None
+        second = user.user_info()
+        self.assertEqual(original, second)
+        self.assertIsNot(first.credentials, second.credentials)
+
+        # claims are shared rather than copied for each request, so can't be changed
+        self.assertIs(first.decoded, second.decoded)
+        with self.assertRaises(TypeError):
+            first.decoded["groups"][0]["name"] = "y"
+        with self.assertRaises(TypeError):
+            first.decoded["groups"].append({})
+        # but copies of them can
+        copied = first.model_copy(deep=True)
+        copied.decoded["groups"][0]["name"] = "y"
+        self.assertEqual("x", second.decoded["groups"][0]["name"])
+        self.assertIs(dict, type(copy.copy(first.decoded)))
+        self.assertEqual(original.model_dump_json(), second.model_dump_json())
+
+    def test_public_json(self):
+        original = make_user()
+        user = UserContext(original)
+        public = user.public_json()
+        self.assertIs(public, user.public_json())
+        self.assertNotIn(b"secret-token", public)
+        original.credentials = None
+        self.assertEqual(original.model_dump(mode="json"), json.loads(public))
@@ -0,0 +1,96 @@
+import gzip
+import os
+import tempfile
+import unittest
+
+from starlette.applications import Starlette
+from starlette.routing import Mount
+from starlette.testclient import TestClient
+
+from azul_restapi_server import assets
+from azul_restapi_server.main import app, static_assets
+
+
+class TestAcceptEncoding(unittest.TestCase):
+    def test_choose_encoding(self):
+        self.assertEqual("gzip", assets.choose_encoding("gzip, deflate, br", ["gzip"]))
+        self.assertEqual("br", assets.choose_encoding("gzip, deflate, br", ["br", "gzip"]))
+        self.assertEqual("gzip", assets.choose_encoding("br;q=0.5, gzip", ["br", "gzip"]))
+        self.assertEqual("identity", assets.choose_encoding("gzip;q=0", ["gzip"]))
+        self.assertEqual("identity", assets.choose_encoding("", ["gzip"]))
+        self.assertEqual("gzip", assets.choose_encoding("*", ["gzip"]))
+
+
+class TestStaticAssets(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.content = b"function hello() { return 'world'; }\n" * 100
+        with open(os.path.join(tmp.name, "hello.js"), "wb") as f:
+            f.write(self.content)
+        with open(os.path.join(tmp.name, "__init__.py"), "w") as f:
+            f.write("")
+        self.assets = assets.StaticAssets(tmp.name)
+        self.client = TestClient(Starlette(routes=[Mount("/static", self.assets)]))
+
+    def test_hashed(self):
+        self.assertEqual(["hello.js"], list(self.assets.assets))
+        name = self.assets.url_name("hello.js")
+        self.assertRegex(name, r"^hello\.[0-9a-f]{16}\.js$")
+
+        resp = self.client.get(f"/static/{name}", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(assets.IMMUTABLE, resp.headers["cache-control"])
+        self.assertEqual("gzip", resp.headers["content-encoding"])
+        self.assertEqual("Accept-Encoding", resp.headers["vary"])
+        self.assertLess(int(resp.headers["content-length"]), len(self.content))
+        self.assertEqual(self.content, resp.content)
+
+        # revalidation of the same representation
+        resp = self.client.get(
+            f"/static/{name}", headers={"Accept-Encoding": "gzip", "If-None-Match": resp.headers["etag"]}
+        )
+        self.assertEqual(304, resp.status_code)
+        self.assertEqual(b"", resp.content)
+
+        # a different representation has a different etag
+        resp = self.client.get(
+            f"/static/{name}", headers={"Accept-Encoding": "identity", "If-None-Match": resp.headers["etag"]}
+        )
+        self.assertEqual(200, resp.status_code)
+        self.assertNotIn("content-encoding", resp.headers)
+        self.assertEqual(self.content, resp.content)
+
+    def test_plain(self):
+        resp = self.client.get("/static/hello.js", headers={"Accept-Encoding": "identity"})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(assets.REVALIDATE, resp.headers["cache-control"])
+        self.assertIn("javascript", resp.headers["content-type"])
+        self.assertEqual(str(len(self.content)), resp.headers["content-length"])
+
+        resp = self.client.head("/static/hello.js", headers={"Accept-Encoding": "identity"})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(str(len(self.content)), resp.headers["content-length"])
+
+        self.assertEqual(404, self.client.get("/static/__init__.py").status_code)
+        self.assertEqual(404, self.client.get("/static/missing.js").status_code)
+        self.assertEqual(405, self.client.post("/static/hello.js").status_code)
+
+    def test_precompressed(self):
+        precompressed = gzip.compress(b"prebuilt" * 1000)
+        with open(self.assets.assets["hello.js"].path + ".gz", "wb") as f:
+            f.write(precompressed)
+        resp = self.client.get("/static/hello.js", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(str(len(precompressed)), resp.headers["content-length"])
+        self.assertEqual(b"prebuilt" * 1000, resp.content)
+
+
+class TestDocs(unittest.TestCase):
+    def test_hashed_urls(self):
+        client = TestClient(app)
+        for page, name in (("/api", "swagger-ui-bundle.js"), ("/api/redoc", "redoc.standalone.js")):
+            resp = client.get(page)
+            self.assertIn(f"/api/static/{static_assets.url_name(name)}", resp.text)
+        resp = client.get(f"/api/static/{static_assets.url_name('swagger-ui.css')}")
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(assets.IMMUTABLE, resp.headers["cache-control"])
@@ -0,0 +1,157 @@
+import asyncio
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from prometheus_client import REGISTRY
+
+from azul_restapi_server import audit
+
+
+class Sink:
+    def __init__(self):
+        self.batches = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, text):
+        self.release.wait(5)
+        self.batches.append(text)
+
+
+class TestAuditWriter(unittest.TestCase):
+    def test_batches(self):
+        sink = Sink()
+        writer = audit.AuditWriter(sink, batch_size=100, interval=60)
+        for i in range(250):
+            writer.write(f"line {i}")
+        writer.flush()
+        # full batches are written straight away, flushing writes the remainder
+        self.assertEqual([100, 100, 50], [len(b.split("\n")) for b in sink.batches])
+        self.assertEqual([f"line {i}" for i in range(250)], "\n".join(sink.batches).split("\n"))
+        writer.close()
+        # records written after close go straight to the sink
+        writer.write("late")
+        self.assertEqual("late", sink.batches[-1])
+
+    def test_interval(self):
+        sink = Sink()
+        writer = audit.AuditWriter(sink, batch_size=100, interval=0.01)
+        writer.write("line")
+        for _ in range(500):
+            if sink.batches:
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual(["line"], sink.batches)
+        writer.close()
+
+    def test_drop(self):
+        sink = Sink()
+        sink.release.clear()
+        writer = audit.AuditWriter(sink, capacity=2, batch_size=1, interval=60, policy="drop")
+        before = REGISTRY.get_sample_value("azulapi_audit_dropped_total")
+        depth = REGISTRY.get_sample_value("azulapi_audit_queue_depth")
+        writer.write("written")
+        # wait until the first record is taken by the (stalled) writer thread
+        while writer._buffer:
+            threading.Event().wait(0.001)
+        for i in range(5):
+            writer.write(f"line {i}")
+        # shared by all writers
+        self.assertEqual(depth + 2, REGISTRY.get_sample_value("azulapi_audit_queue_depth"))
+        self.assertEqual(before + 3, REGISTRY.get_sample_value("azulapi_audit_dropped_total"))
+        sink.release.set()
+        writer.close()
+        self.assertEqual(["written", "line 0", "line 1"], sink.batches)
+
+    def test_spill(self):
+        sink = Sink()
+        sink.release.clear()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            spill_file = os.path.join(tmpdir, "audit.spill")
+            writer = audit.AuditWriter(
+                sink, capacity=1, batch_size=1, interval=60, policy="spill", spill_file=spill_file
+            )
+            writer.write("written")
+            while writer._buffer:
+                threading.Event().wait(0.001)
+            before = REGISTRY.get_sample_value("azulapi_audit_dropped_total")
+            writer.write("line 0")
+            # spilled while the sink is stalled
+            writer.write("line 1")
+            writer.flush(timeout=0.05)
+            with open(spill_file) as f:
+                self.assertEqual("line 1\n", f.read())
+            # dropped while the spill file is behind too
+            writer._spill_cond.acquire()
+            writer._spill_buffer.append("held")
+            writer.write("line 2")
+            writer._spill_buffer.clear()
+            writer._spill_cond.release()
+            self.assertEqual(before + 1, REGISTRY.get_sample_value("azulapi_audit_dropped_total"))
+            sink.release.set()
+            writer.close()
+            self.assertEqual(["written", "line 0"], sink.batches)
+
+    def test_block(self):
+        sink = Sink()
+        sink.release.clear()
+        writer = audit.AuditWriter(sink, capacity=1, batch_size=1, interval=60, policy="block")
+        writer.write("written")
+        while writer._buffer:
+            threading.Event().wait(0.001)
+        writer.write("line 0")
+        blocked = threading.Thread(target=writer.write, args=("line 1",))
+        blocked.start()
+        blocked.join(0.05)
+        self.assertTrue(blocked.is_alive())
+        sink.release.set()
+        blocked.join(5)
+        writer.close()
+        self.assertEqual(["written", "line 0", "line 1"], sink.batches)
+
+    def test_block_async(self):
+        sink = Sink()
+        sink.release.clear()
+        writer = audit.AuditWriter(sink, capacity=1, batch_size=1, interval=60, policy="block")
+        writer.write("written")
+        while writer._buffer:
+            threading.Event().wait(0.001)
+        writer.write("line 0")
+
+        async def write():
+            blocked = asyncio.create_task(writer.write_async("line 1"))
+            # the event loop keeps running while the write waits for space
+            await asyncio.sleep(0.05)
+            self.assertFalse(blocked.done())
+            sink.release.set()
+            await blocked
+
+        # the handler thread pool isn't used, so a stalled disk can't take threads plugins need
+        with mock.patch("anyio.to_thread.run_sync", side_effect=AssertionError("handler pool used")):
+            asyncio.run(write())
+        writer.close()
+        self.assertEqual(["written", "line 0", "line 1"], sink.batches)
+
+    def test_bad_policy(self):
+        with self.assertRaises(ValueError):
+            audit.AuditWriter(print, policy="explode")
+        with self.assertRaises(ValueError):
+            audit.AuditWriter(print, policy="spill")
+
+    def test_binary(self):
+        sink = Sink()
+        writer = audit.AuditWriter(sink, batch_size=10, interval=60, binary=True)
+        writer.write(b"\x00\x01")
+        writer.write(b"\x02")
+        writer.flush()
+        writer.close()
+        self.assertEqual([b"\x00\x01\x02"], sink.batches)
+
+    def test_encoder(self):
+        self.assertIsNone(audit.get_encoder("text"))
+        self.assertEqual('{"a":1}', audit.get_encoder("json")({"a": 1}))
+        with self.assertRaises(ValueError):
+            audit.get_encoder("xml")
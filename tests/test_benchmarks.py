@@ -0,0 +1,40 @@
+import unittest
+
+from benchmarks import intercept, server_core
+
+
+class TestServerCore(unittest.TestCase):
+    def test_variants(self):
+        names = ["ResponseCacheMiddleware", *server_core.MIDDLEWARE]
+        # middleware that isn't listed, e.g. the response cache, is still used
+        self.assertEqual(names, server_core._keep_middleware("all", names))
+        self.assertEqual([], server_core._keep_middleware("none", names))
+        self.assertEqual(
+            ["ResponseCacheMiddleware", "PrometheusMiddleware", "CORSMiddleware", "StageTimingMiddleware"],
+            server_core._keep_middleware("-AuditMiddleware", names),
+        )
+
+    def test_percentile(self):
+        latencies = [float(i) for i in range(1, 101)]
+        self.assertEqual(51.0, server_core.percentile(latencies, 0.5))
+        self.assertEqual(100.0, server_core.percentile(latencies, 0.99))
+        self.assertEqual(5.0, server_core.percentile([5.0], 0.99))
+
+    def test_compare(self):
+        result = {"security": "none", "middleware": "all", "path": "/v0/users/me", "rps": 100.0, "p99_ms": 2.0}
+        old = {"results": [result]}
+        new = {"results": [{**result, "rps": 150.0, "p99_ms": 1.0}, {**result, "middleware": "none"}]}
+        lines = server_core.compare(old, new)
+        self.assertEqual(3, len(lines))
+        self.assertIn("150.0 (+50.0%)", lines[1])
+        self.assertIn("1.000 (-50.0%)", lines[1])
+        # no baseline for this scenario
+        self.assertNotIn("%", lines[2])
+
+
+class TestIntercept(unittest.TestCase):
+    def test_measure(self):
+        self.assertEqual(
+            ["original", "caller in format", "caller not in format", "below level"],
+            list(intercept.measure(10)),
+        )
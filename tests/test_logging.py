@@ -0,0 +1,103 @@
+"""Tests of redirecting stdlib logging and of the audit sinks, the cost per record of InterceptHandler is measured by benchmarks.intercept."""
+
+import logging
+import unittest
+from unittest import mock
+
+from loguru import logger as loguru_logger
+
+from azul_restapi_server import logging as app_logging
+
+
+class StubLogger:
+    """Record what the handler sends to loguru, without the cost of any sinks."""
+
+    level = staticmethod(loguru_logger.level)
+
+    def __init__(self):
+        self.calls = []
+
+    def opt(self, depth, exception):
+        self.depth = depth
+        return self
+
+    def log(self, level, message):
+        self.calls.append((level, message, self.depth))
+
+
+def make_logger(handler: logging.Handler) -> logging.Logger:
+    """Return a logger that only sends to the handler."""
+    log = logging.Logger("tests.intercept", level=logging.DEBUG)
+    log.addHandler(handler)
+    return log
+
+
+class TestInterceptHandler(unittest.TestCase):
+    @mock.patch.object(app_logging, "logger", new_callable=StubLogger)
+    def test_emit(self, stub):
+        handler = app_logging.InterceptHandler(level="info", log_format="{name} {message}")
+        log = make_logger(handler)
+        log.debug("dropped %s", "early")
+        log.info("hello %s", "world")
+        log.log(25, "custom")
+        handler.handle(logging.LogRecord("uvicorn.access", logging.INFO, __file__, 1, "ignored", None, None))
+        self.assertEqual([("INFO", "hello world"), (25, "custom")], [c[:2] for c in stub.calls])
+        # caller is found, as the format needs it
+        self.assertGreater(stub.calls[0][2], 0)
+
+    @mock.patch.object(app_logging, "logger", new_callable=StubLogger)
+    def test_no_caller(self, stub):
+        log = make_logger(app_logging.InterceptHandler(level="debug", log_format="{time} {level} {message}"))
+        log.debug("message")
+        self.assertEqual([("DEBUG", "message", 0)], stub.calls)
+
+    @mock.patch.object(app_logging, "logger", new_callable=StubLogger)
+    def test_below_level(self, stub):
+        class Unformattable:
+            def __str__(self):
+                raise AssertionError("message was formatted")
+
+        handler = app_logging.InterceptHandler(level="info", log_format="{name} {message}")
+        record = logging.LogRecord(
+            "opensearch", logging.DEBUG, __file__, 1, "request %s finished", (Unformattable(),), None
+        )
+        # dropped before the message is formatted or the caller is found
+        with mock.patch.object(app_logging.logging, "currentframe") as currentframe:
+            handler.handle(record)
+        currentframe.assert_not_called()
+        self.assertEqual([], stub.calls)
+
+
+class TestAuditSink(unittest.TestCase):
+    def sink(self, feed: str, **kwargs) -> list:
+        """Capture what loguru writes for a feed."""
+        writes = []
+        sink_id = loguru_logger.add(
+            writes.append, filter=lambda record: record["extra"].get("feed") == feed, colorize=False, **kwargs
+        )
+        self.addCleanup(loguru_logger.remove, sink_id)
+        return writes
+
+    @mock.patch.object(app_logging.config, "log_format", "level={level} {message}")
+    def test_file_and_stdout(self):
+        batches = self.sink("audit_batch", format="{message}")
+        stdout = self.sink("audit_stdout", format=app_logging.RestAPILogger.format_audit_batch)
+        app_logging.RestAPILogger._audit_sink(to_file=True)("first {x}\nsecond")
+        # the batch goes to the audit file
+        self.assertEqual(["first {x}\nsecond\n"], batches)
+        # and to stdout in a single write, formatted like other logs
+        self.assertEqual(["level=INFO first {x}\nlevel=INFO second\n"], stdout)
+
+    def test_stdout_only(self):
+        batches = self.sink("audit_batch", format="{message}")
+        stdout = self.sink("audit_stdout", format=app_logging.RestAPILogger.format_audit_batch)
+        app_logging.RestAPILogger._audit_sink(to_file=False)("first")
+        self.assertEqual([], batches)
+        self.assertEqual(1, len(stdout))
+        self.assertIn("function=", stdout[0])
+
+    @mock.patch.object(app_logging.config, "audit_output", "msgpack")
+    @mock.patch.object(app_logging.config, "audit_file", "")
+    def test_msgpack_needs_file(self):
+        with self.assertRaisesRegex(ValueError, "audit file"):
+            app_logging.RestAPILogger()
@@ -0,0 +1,57 @@
+import gzip
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from click.testing import CliRunner
+from fastapi import FastAPI
+from starlette.testclient import TestClient
+
+from azul_restapi_server import cli, openapi, security
+from azul_restapi_server.main import app
+
+
+class TestOpenAPIDocument(unittest.TestCase):
+    def test_served(self):
+        client = TestClient(app)
+        resp = client.get("/api/openapi.json", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual("gzip", resp.headers["content-encoding"])
+        self.assertEqual("application/json", resp.headers["content-type"])
+        self.assertEqual(app.openapi(), resp.json())
+
+        resp = client.get(
+            "/api/openapi.json", headers={"Accept-Encoding": "gzip", "If-None-Match": resp.headers["etag"]}
+        )
+        self.assertEqual(304, resp.status_code)
+
+    def test_built_once(self):
+        calls = []
+        test_app = FastAPI(openapi_url=None, root_path="/azul")
+        test_app.get("/hello")(lambda: "world")
+        openapi_fn = test_app.openapi
+        test_app.openapi = lambda: calls.append(1) or openapi_fn()
+        document = openapi.OpenAPIDocument(test_app)
+        for _ in range(3):
+            asset = document.build()
+        self.assertEqual(1, len(calls))
+        doc = json.loads(gzip.decompress(asset.variants["gzip"]))
+        self.assertIn("/hello", doc["paths"])
+        self.assertEqual([{"url": "/azul"}], doc["servers"])
+
+    def test_from_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "openapi.json")
+            with mock.patch.object(security, "startup", new_callable=mock.AsyncMock) as startup:
+                result = CliRunner().invoke(cli.run, ["openapi", path])
+            self.assertEqual(0, result.exit_code, result.output)
+            # the discovered auth flow is filled in before the document is written
+            startup.assert_awaited_once()
+            with open(path) as f:
+                self.assertEqual(app.openapi(), json.load(f))
+
+            document = openapi.OpenAPIDocument(FastAPI(), path)
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), document.build().content)
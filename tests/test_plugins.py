@@ -0,0 +1,39 @@
+import unittest
+from unittest import mock
+
+from fastapi.testclient import TestClient
+
+from azul_restapi_server import plugins, startup
+from azul_restapi_server.main import app
+
+
+class TestPlugins(unittest.TestCase):
+    def test_load_times(self):
+        self.assertIn("users", plugins.load_times)
+        self.assertIn("plugins", startup.phases)
+        # plugins are only imported once
+        with mock.patch.object(plugins, "_load") as load:
+            self.assertEqual(["users"], [name for name, _ in plugins.load_plugins()])
+            load.assert_not_called()
+
+    def test_parallel(self):
+        eps = [mock.Mock(load=mock.Mock(return_value=f"router {name}")) for name in ("b", "a", "c")]
+        for ep, name in zip(eps, ("b", "a", "c")):
+            ep.name = name
+        with (
+            mock.patch.dict(plugins._loaded, clear=True),
+            mock.patch.object(plugins.importlib.metadata, "entry_points") as entry_points,
+        ):
+            entry_points.return_value.select.return_value = eps
+            loaded = plugins.load_plugins(workers=3)
+        self.assertEqual([("a", "router a"), ("b", "router b"), ("c", "router c")], loaded)
+        self.assertTrue({"a", "b", "c"} <= set(plugins.load_times))
+
+    def test_startup_endpoint(self):
+        with TestClient(app) as client:
+            resp = client.get("/api/diagnostics/startup")
+        self.assertEqual(200, resp.status_code)
+        report = resp.json()
+        self.assertFalse(report["preloaded"])
+        self.assertIn("users", report["plugins"])
+        self.assertTrue({"logging", "plugins", "lifespan"} <= set(report["phases"]))
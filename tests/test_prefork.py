@@ -0,0 +1,126 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+import unittest
+from unittest import mock
+
+import httpx
+from click.testing import CliRunner
+
+from azul_restapi_server import cli, plugins, prefork, security
+from azul_restapi_server.security import oidc_shared
+
+_SERVER = textwrap.dedent("""
+    import os
+    import sys
+
+    import uvicorn
+    from starlette.applications import Starlette
+    from starlette.responses import PlainTextResponse
+    from starlette.routing import Route
+
+    from azul_restapi_server import prefork
+
+    prefork.prepare_metrics()
+    from prometheus_client import Counter
+    from starlette_exporter import handle_metrics
+
+    hits = Counter("test_hits", "Requests served")
+
+
+    def hello(request):
+        hits.inc()
+        return PlainTextResponse(str(os.getpid()))
+
+
+    app = Starlette(routes=[Route("/", hello), Route("/metrics", handle_metrics)])
+    prefork.serve(uvicorn.Config(app, port=int(sys.argv[1]), log_level="warning"), 2)
+    """)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class TestPrefork(unittest.TestCase):
+    def test_serve(self):
+        port = free_port()
+        proc = subprocess.Popen([sys.executable, "-c", _SERVER, str(port)])
+        self.addCleanup(proc.kill)
+        pids = set()
+        hits = 0
+        deadline = time.monotonic() + 20
+        while len(pids) < 2 and time.monotonic() < deadline:
+            try:
+                # new connection each time, so requests spread over the workers
+                pids.add(int(httpx.get(f"http://127.0.0.1:{port}/").text))
+                hits += 1
+            except httpx.TransportError:
+                time.sleep(0.1)
+        self.assertEqual(2, len(pids))
+        self.assertNotIn(proc.pid, pids)
+        # metrics are collected from every worker
+        self.assertIn(f"test_hits_total {float(hits)}", httpx.get(f"http://127.0.0.1:{port}/metrics").text)
+
+        # workers are replaced when they exit
+        killed = pids.pop()
+        os.kill(killed, signal.SIGKILL)
+        time.sleep(2)
+        self.assertEqual(200, httpx.get(f"http://127.0.0.1:{port}/").status_code)
+
+        proc.send_signal(signal.SIGTERM)
+        self.assertEqual(0, proc.wait(timeout=10))
+
+
+class TestSharedState(unittest.TestCase):
+    def test_prepare_metrics(self):
+        with tempfile.TemporaryDirectory() as tmp, mock.patch.dict(os.environ, {"PROMETHEUS_MULTIPROC_DIR": tmp}):
+            for name in ("counter_12.db", "gauge_livesum_12.db", "notes.txt"):
+                open(os.path.join(tmp, name), "w").close()
+            prefork.prepare_metrics()
+            # values from an earlier run are removed
+            self.assertEqual(["notes.txt"], os.listdir(tmp))
+
+        with mock.patch.dict(os.environ, clear=True):
+            prefork.prepare_metrics()
+            path = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+        self.assertTrue(os.path.isdir(path))
+        os.rmdir(path)
+
+    def test_metrics_only_when_forked(self):
+        runner = CliRunner()
+        with mock.patch.object(prefork, "prepare_metrics") as prepare, mock.patch.object(cli.uvicorn, "run"):
+            # uvicorn's workers exit without their live gauges being dropped
+            self.assertEqual(0, runner.invoke(cli.run, ["--workers", "2", "--no-preload"]).exit_code)
+            prepare.assert_not_called()
+            with (
+                mock.patch.object(prefork, "serve") as serve,
+                mock.patch.object(plugins, "preload"),
+                mock.patch.object(security, "warm"),
+            ):
+                self.assertEqual(0, runner.invoke(cli.run, ["--workers", "2", "--preload"]).exit_code)
+            prepare.assert_called_once()
+            serve.assert_called_once()
+
+    def test_fork(self):
+        parent_client = oidc_shared.client
+        oidc_shared._discovery_cache._inflight["stuck"] = object()
+        self.addCleanup(oidc_shared._discovery_cache._inflight.pop, "stuck")
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # workers get their own connections, and don't wait on fetches from the parent
+            ok = oidc_shared.client is not parent_client and not oidc_shared._discovery_cache._inflight
+            os.write(write, b"1" if ok else b"0")
+            os._exit(0)
+        os.close(write)
+        self.assertEqual(b"1", os.read(read, 1))
+        os.close(read)
+        os.waitpid(pid, 0)
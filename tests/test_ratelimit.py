@@ -0,0 +1,145 @@
+import asyncio
+import time
+import unittest
+from unittest import mock
+
+import httpx
+from azul_bedrock.models_auth import UserInfo
+from fastapi import APIRouter, Depends, FastAPI, Request
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+
+from azul_restapi_server import ratelimit
+
+router = APIRouter()
+release = asyncio.Event()
+
+
+@router.get("/v0/search")
+def search():
+    return {}
+
+
+@router.get("/v0/heavy")
+def heavy():
+    return {}
+
+
+@router.get("/v0/slow")
+async def slow():
+    await release.wait()
+    return {}
+
+
+def validate_token(request: Request):
+    user = request.headers.get("x-user", "llama")
+    request.state.user_info = UserInfo(username=user, unique_id=user, roles=[request.headers.get("x-role", "user")])
+
+
+def make_app(limiter: ratelimit.Limiter) -> FastAPI:
+    app = FastAPI()
+    app.include_router(router, dependencies=[Depends(validate_token), Depends(limiter)])
+    return app
+
+
+class AsyncBackend:
+    def __init__(self):
+        self.keys = []
+
+    async def take(self, key: str, rate: float, burst: int) -> tuple[float, float]:
+        self.keys.append(key)
+        return 0.0, 2.5
+
+
+class TestRateLimit(unittest.TestCase):
+    def test_rate(self):
+        labels = {"route": "/v0/search", "reason": "rate"}
+        rejected = REGISTRY.get_sample_value("azulapi_ratelimit_rejected_total", labels) or 0
+        client = TestClient(make_app(ratelimit.Limiter(rate=0.5, burst=3, route_rates={"/v0/heavy": 0.1})))
+        for _ in range(3):
+            self.assertEqual(200, client.get("/v0/search").status_code)
+        resp = client.get("/v0/search")
+        self.assertEqual(429, resp.status_code)
+        self.assertEqual("2", resp.headers["Retry-After"])
+        # each user and route has its own bucket
+        self.assertEqual(200, client.get("/v0/search", headers={"x-user": "alpaca"}).status_code)
+        self.assertEqual(200, client.get("/v0/heavy").status_code)
+        # metrics are by route, only llama's bucket is empty
+        self.assertEqual(1, REGISTRY.get_sample_value("azulapi_ratelimit_limited_users", {"route": "/v0/search"}))
+        self.assertEqual(rejected + 1, REGISTRY.get_sample_value("azulapi_ratelimit_rejected_total", labels))
+
+        for _ in range(2):
+            client.get("/v0/heavy")
+        resp = client.get("/v0/heavy")
+        self.assertEqual(429, resp.status_code)
+        # slower route takes longer to refill
+        self.assertEqual("10", resp.headers["Retry-After"])
+
+    def test_exempt(self):
+        client = TestClient(make_app(ratelimit.Limiter(rate=1, burst=1, exempt_roles=["service"])))
+        for _ in range(3):
+            self.assertEqual(200, client.get("/v0/search", headers={"x-user": "bot", "x-role": "service"}).status_code)
+
+    def test_async_backend(self):
+        backend = AsyncBackend()
+        client = TestClient(make_app(ratelimit.Limiter(rate=5, backend=backend)))
+        resp = client.get("/v0/search")
+        self.assertEqual(429, resp.status_code)
+        self.assertEqual("3", resp.headers["Retry-After"])
+        self.assertEqual(["llama\x00/v0/search"], backend.keys)
+
+    def test_load_backend(self):
+        self.assertIsInstance(ratelimit._load_backend(""), ratelimit.MemoryBackend)
+        self.assertIsInstance(ratelimit._load_backend(f"{__name__}:AsyncBackend"), AsyncBackend)
+
+    def test_concurrency(self):
+        limiter = ratelimit.Limiter(concurrency=2)
+        app = make_app(limiter)
+        in_progress = REGISTRY.get_sample_value("azulapi_ratelimit_in_progress")
+
+        async def run():
+            release.clear()
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+                slow = [asyncio.create_task(client.get("/v0/slow")) for _ in range(2)]
+                while limiter._in_progress.get("llama") != 2:
+                    await asyncio.sleep(0.01)
+                limited = await client.get("/v0/search")
+                other = await client.get("/v0/search", headers={"x-user": "alpaca"})
+                release.set()
+                done = await asyncio.gather(*slow)
+                after = await client.get("/v0/search")
+            return limited, other, done, after
+
+        limited, other, done, after = asyncio.run(run())
+        self.assertEqual(429, limited.status_code)
+        self.assertEqual("1", limited.headers["Retry-After"])
+        self.assertEqual(200, other.status_code)
+        self.assertEqual([200, 200], [r.status_code for r in done])
+        self.assertEqual(200, after.status_code)
+        self.assertEqual({}, limiter._in_progress)
+        self.assertEqual(in_progress, REGISTRY.get_sample_value("azulapi_ratelimit_in_progress"))
+
+    def test_prune(self):
+        backend = ratelimit.MemoryBackend()
+        now = time.monotonic()
+        with mock.patch.object(ratelimit.time, "monotonic", return_value=now):
+            backend.take("a", 1, 2)
+            backend.take("b", 0.01, 2)
+        with mock.patch.object(ratelimit.time, "monotonic", return_value=now + 5):
+            backend._prune(now + 5, 2)
+        # only the faster bucket has refilled
+        self.assertEqual(["b"], list(backend._buckets))
+
+    def test_limited_users(self):
+        limiter = ratelimit.Limiter(rate=1, burst=1)
+        labels = {"route": "/v0/limited"}
+        now = time.monotonic()
+        with mock.patch.object(ratelimit.time, "monotonic", return_value=now):
+            limiter._count_limited("llama", "/v0/limited", 0.0, 1)
+            limiter._count_limited("alpaca", "/v0/limited", 0.5, 1)
+        self.assertEqual(2, REGISTRY.get_sample_value("azulapi_ratelimit_limited_users", labels))
+        with mock.patch.object(ratelimit.time, "monotonic", return_value=now + 0.6):
+            limiter._count_limited("vicuna", "/v0/limited", 1.0, 1)
+        # alpaca's bucket has a token again
+        self.assertEqual(1, REGISTRY.get_sample_value("azulapi_ratelimit_limited_users", labels))
+        self.assertEqual(["llama"], list(limiter._limited["/v0/limited"]))
@@ -0,0 +1,179 @@
+import asyncio
+import unittest
+
+import httpx
+from azul_bedrock.models_auth import UserInfo
+from fastapi import APIRouter, Depends, FastAPI, Request, Response
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+
+from azul_restapi_server import response_cache
+from azul_restapi_server.middleware.stages import StageTimingMiddleware
+
+router = APIRouter()
+calls = []
+
+
+@router.get("/v0/entities/{sha256}")
+@response_cache.cached(ttl=60)
+def read_entity(sha256: str, request: Request, response: Response, detail: bool = False):
+    calls.append(sha256)
+    response.headers["x-azul-security"] = "OFFICIAL"
+    return {"sha256": sha256, "roles": request.state.user_info.roles, "detail": detail}
+
+
+@router.get("/v0/missing")
+@response_cache.cached(ttl=60)
+def read_missing():
+    calls.append("missing")
+    return Response(status_code=404)
+
+
+@router.get("/v0/big")
+@response_cache.cached(ttl=60)
+def read_big():
+    calls.append("big")
+    return Response(b"x" * 2000, media_type="text/plain")
+
+
+@router.get("/v0/live")
+def read_live():
+    calls.append("live")
+    return {"call": len(calls)}
+
+
+def validate_token(request: Request):
+    roles = request.headers.get("x-roles", "a").split(",")
+    request.state.user_info = UserInfo(username=request.headers.get("x-user", "llama"), unique_id="u", roles=roles)
+
+
+cache = response_cache.ResponseCache(max_bytes=100_000, max_entry_bytes=1000)
+app = FastAPI()
+app.include_router(router, dependencies=[Depends(validate_token), Depends(cache)])
+app.add_middleware(response_cache.ResponseCacheMiddleware, cache=cache)
+app.add_middleware(StageTimingMiddleware)
+client = TestClient(app)
+
+
+def hits(route: str) -> float:
+    return REGISTRY.get_sample_value("azulapi_response_cache_hits_total", {"route": route}) or 0.0
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        cache.clear()
+        calls.clear()
+
+    def test_hit(self):
+        route = "/v0/entities/{sha256}"
+        before = hits(route)
+        first = client.get("/v0/entities/abc", params={"detail": "true", "x": "1"})
+        self.assertEqual(200, first.status_code)
+        self.assertEqual("private, max-age=60", first.headers["cache-control"])
+        # query order doesn't matter, and users with the same roles share a response
+        second = client.get("/v0/entities/abc?x=1&detail=true", headers={"x-user": "alpaca"})
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(first.headers["etag"], second.headers["etag"])
+        self.assertEqual("OFFICIAL", second.headers["x-azul-security"])
+        self.assertEqual("application/json", second.headers["content-type"])
+        self.assertEqual(["abc"], calls)
+        self.assertEqual(before + 1, hits(route))
+
+    def test_keys(self):
+        client.get("/v0/entities/abc")
+        client.get("/v0/entities/def")
+        client.get("/v0/entities/abc", params={"detail": "true"})
+        # never shared between users with different roles
+        other = client.get("/v0/entities/abc", headers={"x-roles": "a,b"})
+        self.assertEqual(["a", "b"], other.json()["roles"])
+        self.assertEqual(4, len(calls))
+        # roles in any order are the same access
+        client.get("/v0/entities/abc", headers={"x-roles": "b,a"})
+        self.assertEqual(4, len(calls))
+
+    def test_etag(self):
+        first = client.get("/v0/entities/abc")
+        resp = client.get("/v0/entities/abc", headers={"if-none-match": first.headers["etag"]})
+        self.assertEqual(304, resp.status_code)
+        self.assertEqual(b"", resp.content)
+        self.assertEqual(first.headers["etag"], resp.headers["etag"])
+        cache.clear()
+        # a response that wasn't cached yet is still a 304 if the client has it
+        resp = client.get("/v0/entities/abc", headers={"if-none-match": first.headers["etag"]})
+        self.assertEqual(304, resp.status_code)
+
+    def test_not_cached(self):
+        for _ in range(2):
+            self.assertEqual(404, client.get("/v0/missing").status_code)
+            self.assertEqual(2000, len(client.get("/v0/big").content))
+            self.assertNotIn("etag", client.get("/v0/live").headers)
+        self.assertEqual(["missing", "big", "live"] * 2, calls)
+
+    def test_bigger_than_cache(self):
+        # allowed as an entry, but doesn't fit in the cache at all
+        small = response_cache.ResponseCache(max_bytes=100, max_entry_bytes=1000)
+        small.put("key", response_cache.Entry(200, [], b"x" * 500, ttl=60))
+        self.assertIsNone(small.get("key"))
+
+
+coalesce_router = APIRouter()
+release: asyncio.Event | None = None
+
+
+@coalesce_router.get("/v0/samples/{sha256}")
+@response_cache.coalesced
+async def read_sample(sha256: str, fail: bool = False):
+    calls.append(sha256)
+    await release.wait()
+    if fail:
+        return Response(status_code=500)
+    return {"sha256": sha256, "call": len(calls)}
+
+
+coalesce_cache = response_cache.ResponseCache(max_bytes=0, max_entry_bytes=1000)
+coalesce_app = FastAPI()
+coalesce_app.include_router(coalesce_router, dependencies=[Depends(validate_token), Depends(coalesce_cache)])
+coalesce_app.add_middleware(response_cache.ResponseCacheMiddleware, cache=coalesce_cache)
+
+
+async def get_many(paths: list[tuple[str, dict]]) -> list[httpx.Response]:
+    transport = httpx.ASGITransport(app=coalesce_app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        global release
+        release = asyncio.Event()
+        requests = [asyncio.create_task(client.get(path, headers=headers)) for path, headers in paths]
+        while len(calls) < len({(p, h.get("x-roles")) for p, h in paths}):
+            await asyncio.sleep(0.01)
+        # let waiting requests find the one in progress
+        await asyncio.sleep(0.05)
+        release.set()
+        return await asyncio.gather(*requests)
+
+
+class TestCoalescing(unittest.TestCase):
+    def setUp(self):
+        calls.clear()
+
+    def test_coalesced(self):
+        route = "/v0/samples/{sha256}"
+        saved = REGISTRY.get_sample_value("azulapi_coalesced_requests_total", {"route": route}) or 0.0
+        responses = asyncio.run(
+            get_many([("/v0/samples/abc", {})] * 5 + [("/v0/samples/abc", {"x-roles": "b"}), ("/v0/samples/def", {})])
+        )
+        self.assertEqual([200] * 7, [r.status_code for r in responses])
+        # identical requests share one response
+        self.assertEqual(1, len({r.content for r in responses[:5]}))
+        self.assertNotIn("etag", responses[0].headers)
+        self.assertEqual(["abc", "abc", "def"], sorted(calls))
+        self.assertEqual(saved + 4, REGISTRY.get_sample_value("azulapi_coalesced_requests_total", {"route": route}))
+        # nothing is kept once they are done
+        self.assertEqual({}, coalesce_cache._in_flight)
+        asyncio.run(get_many([("/v0/samples/abc", {})]))
+        self.assertEqual(4, len(calls))
+
+    def test_failure(self):
+        # waiting requests run the endpoint themselves if the response can't be shared
+        responses = asyncio.run(get_many([("/v0/samples/abc?fail=true", {})] * 3))
+        self.assertEqual([500] * 3, [r.status_code for r in responses])
+        self.assertEqual(3, len(calls))
+        self.assertEqual({}, coalesce_cache._in_flight)
@@ -0,0 +1,42 @@
+import datetime
+import json
+import unittest
+
+from pydantic import BaseModel
+from starlette.responses import JSONResponse
+from starlette.testclient import TestClient
+
+from azul_restapi_server import responses
+from azul_restapi_server.api.v1 import users
+from azul_restapi_server.main import app
+
+
+class Item(BaseModel):
+    name: str
+    seen: datetime.datetime
+
+
+class TestResponses(unittest.TestCase):
+    def test_render(self):
+        seen = datetime.datetime(2024, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+        body = responses.FastJSONResponse({"items": [Item(name="a", seen=seen)], 1: None}).body
+        self.assertEqual(
+            {"items": [{"name": "a", "seen": "2024-01-02T03:04:05Z"}], "1": None},
+            json.loads(body),
+        )
+        with self.assertRaises(TypeError):
+            responses.FastJSONResponse({"bad": object()})
+
+    def test_get_response_class(self):
+        self.assertIs(responses.FastJSONResponse, responses.get_response_class("orjson"))
+        self.assertIs(JSONResponse, responses.get_response_class("stdlib"))
+        with self.assertRaises(ValueError):
+            responses.get_response_class("ujson")
+
+    def test_app_default(self):
+        # plugin routes that don't choose a class use the configured default
+        self.assertIs(responses.FastJSONResponse, users.router.routes[0].response_class.value)
+        resp = TestClient(app).get("/api/v0/users/me")
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual("application/json", resp.headers["content-type"])
+        self.assertEqual("anony-moose", resp.json()["username"])
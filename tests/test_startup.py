@@ -0,0 +1,39 @@
+import json
+import unittest
+
+from click.testing import CliRunner
+
+from azul_restapi_server import cli, startup
+
+_IMPORTTIME = """import time: self [us] | cumulative | imported package
+import time:       464 |        464 |   _io
+import time:      1500 |       2000 | azul_restapi_server.main
+loaded plugin: users
+"""
+
+
+class TestStartupProfile(unittest.TestCase):
+    def test_parse_importtime(self):
+        self.assertEqual(
+            [
+                {"module": "_io", "self": 0.000464, "cumulative": 0.000464},
+                {"module": "azul_restapi_server.main", "self": 0.0015, "cumulative": 0.002},
+            ],
+            startup.parse_importtime(_IMPORTTIME),
+        )
+
+    def test_profile_startup(self):
+        runner = CliRunner()
+        result = runner.invoke(cli.run, ["profile-startup", "--top", "5", "--budget", "600"])
+        self.assertEqual(0, result.exit_code, result.output)
+        report = json.loads(result.output)
+        self.assertEqual(5, len(report["slowest_modules"]))
+        self.assertEqual("users", report["slowest_plugins"][0][0])
+        self.assertGreater(report["import_app"], 0)
+        self.assertGreater(report["openapi"], 0)
+        self.assertIsNone(report["oidc_discovery"])
+        self.assertAlmostEqual(report["import_app"] + report["openapi"], report["total"])
+
+        result = runner.invoke(cli.run, ["profile-startup", "--budget", "0.001"])
+        self.assertEqual(1, result.exit_code)
+        self.assertIn("over the budget", result.output)
@@ -0,0 +1,71 @@
+import asyncio
+import inspect
+import threading
+import unittest
+from unittest import mock
+
+import anyio.to_thread
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+
+from azul_restapi_server import main, settings, threadpool
+
+
+class TestThreadpool(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(threadpool.uninstall)
+        self.addCleanup(threadpool._limiters.clear)
+        threadpool.install()
+
+    def test_configure(self):
+        async def main():
+            with (
+                mock.patch.object(settings.restapi, "handler_threads", 3),
+                mock.patch.object(settings.restapi, "auth_threads", 1),
+            ):
+                threadpool.configure()
+            self.assertEqual(3, anyio.to_thread.current_default_thread_limiter().total_tokens)
+            self.assertEqual(1, threadpool._limiters[threadpool.AUTH].total_tokens)
+            self.assertEqual(3, REGISTRY.get_sample_value("azulapi_threadpool_size", {"pool": "handler"}))
+            self.assertEqual(1, REGISTRY.get_sample_value("azulapi_threadpool_size", {"pool": "auth"}))
+
+        asyncio.run(main())
+
+    def test_lifespan(self):
+        # only measured while the app is serving, rather than from import
+        threadpool.uninstall()
+        with TestClient(main.app):
+            self.assertIs(threadpool._measured_run_sync, anyio.to_thread.run_sync)
+        self.assertIs(threadpool._run_sync, anyio.to_thread.run_sync)
+
+    def test_auth_pool(self):
+        release = threading.Event()
+        threads = []
+
+        def validate(token: str):
+            threads.append(threading.current_thread())
+            release.wait(5)
+            return token
+
+        wrapped = threadpool.in_auth_pool(validate)
+        self.assertTrue(inspect.iscoroutinefunction(wrapped))
+        self.assertIs(wrapped, threadpool.in_auth_pool(wrapped))
+
+        async def main():
+            with mock.patch.object(settings.restapi, "auth_threads", 1):
+                threadpool.configure()
+            before = REGISTRY.get_sample_value("azulapi_threadpool_queue_wait_seconds_count", {"pool": "auth"}) or 0
+            tasks = [asyncio.create_task(wrapped(token=str(i))) for i in range(2)]
+            await asyncio.sleep(0.05)
+            # only one auth thread, so the second call waits
+            self.assertEqual(1, REGISTRY.get_sample_value("azulapi_threadpool_busy", {"pool": "auth"}))
+            self.assertEqual(1, REGISTRY.get_sample_value("azulapi_threadpool_waiting", {"pool": "auth"}))
+            # the handler pool is unaffected
+            self.assertEqual("free", await anyio.to_thread.run_sync(lambda: "free"))
+            release.set()
+            self.assertEqual(["0", "1"], await asyncio.gather(*tasks))
+            after = REGISTRY.get_sample_value("azulapi_threadpool_queue_wait_seconds_count", {"pool": "auth"})
+            self.assertEqual(2, after - before)
+
+        asyncio.run(main())
+        self.assertEqual(2, len(threads))